@@ -1,7 +1,7 @@
 # backend/config/settings.py
 from pathlib import Path
 import os
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlparse
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -67,7 +67,8 @@ if DATABASE_URL:
             "NAME": os.path.basename(url.path),
             "USER": url.username,
             "PASSWORD": url.password,
-            "HOST": url.hostname,
+            # A Unix socket directory may be given as ?host=/path instead
+            "HOST": url.hostname or parse_qs(url.query).get("host", [""])[0],
             "PORT": url.port or 5432,
         }
     }
@@ -79,6 +80,161 @@ else:
         }
     }
 
+# Model artifacts written by engine/train_model.py
+MODELS_DIR = os.getenv('MODELS_DIR', '/app/models')
+
+# Loan application scoring: concurrent requests are coalesced into one predict_proba call
+LOAN_SCORING_BATCH_WINDOW_MS = float(os.getenv('LOAN_SCORING_BATCH_WINDOW_MS', '5'))
+LOAN_SCORING_MAX_BATCH_SIZE = int(os.getenv('LOAN_SCORING_MAX_BATCH_SIZE', '512'))
+LOAN_SCORING_MAX_APPLICATIONS = int(os.getenv('LOAN_SCORING_MAX_APPLICATIONS', '1000'))
+
+# Shared-memory customer feature store (engine/feature_store.py)
+FEATURE_STORE_ENABLED = os.getenv('FEATURE_STORE_ENABLED', 'true').lower() == 'true'
+FEATURE_STORE_NAME = os.getenv('FEATURE_STORE_NAME', 'revenue_maximizer_features')
+FEATURE_STORE_REFRESH_SECONDS = float(os.getenv('FEATURE_STORE_REFRESH_SECONDS', '30'))
+FEATURE_STORE_HEADROOM = 1.25
+# Backstop for changes the change log never recorded (such as card rewrites made while the
+# listener was down): the store is rebuilt from a full scan at least this often (0 disables)
+FEATURE_STORE_REBUILD_SECONDS = float(os.getenv('FEATURE_STORE_REBUILD_SECONDS', '21600'))
+
+# Incremental cluster assignment (engine/segmentation.py); a refit is recommended when
+# customers assigned since the last fit sit further from their centroids than the fit's
+# own customers, shift the cluster mix, or make up too large a share of the book
+SEGMENTATION_ASSIGN_BATCH_SIZE = int(os.getenv('SEGMENTATION_ASSIGN_BATCH_SIZE', '10000'))
+SEGMENTATION_DRIFT_DISPERSION_RATIO = 1.5
+SEGMENTATION_DRIFT_SHARE_SHIFT = 0.15
+SEGMENTATION_DRIFT_NEW_FRACTION = 0.2
+SEGMENTATION_DRIFT_MIN_ASSIGNED = 100
+
+# Analytics response cache (engine/cache.py). Entries are keyed on the data version, which
+# every process reads from Postgres, so they never go stale even though each worker has its
+# own LocMemCache; it evicts least-recently-used entries past MAX_ENTRIES.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'engine-responses',
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '256'))},
+    }
+}
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', '3600'))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRY_BYTES', str(20 * 1024 * 1024)))
+# How long a request may reuse the last table watermark check before re-reading it
+RESPONSE_CACHE_VERSION_TTL = float(os.getenv('RESPONSE_CACHE_VERSION_TTL', '2'))
+
+# How long scoring reuses the book-wide median age it fills missing ages with
+AGE_MEDIAN_TTL = float(os.getenv('AGE_MEDIAN_TTL', '300'))
+
+# Card window features end on this date (YYYY-MM-DD); empty means today
+CARD_FEATURES_AS_OF = os.getenv('CARD_FEATURES_AS_OF', '')
+
+# Incremental refreshes find new rows by transaction_id and updated_at, but a transaction can
+# commit after a refresh has moved past its ids or timestamps, so each refresh re-reads this
+# many ids / seconds below its watermarks (the card rollups and the feature store)
+CARD_WATERMARK_LAG_IDS = int(os.getenv('CARD_WATERMARK_LAG_IDS', '1000'))
+UPDATED_AT_LAG_SECONDS = float(os.getenv('UPDATED_AT_LAG_SECONDS', '300'))
+
+# ?approx= dashboard summaries: default/maximum sample rows, interval confidence, TABLESAMPLE seed
+APPROX_SAMPLE_SIZE = int(os.getenv('APPROX_SAMPLE_SIZE', '5000'))
+APPROX_MAX_SAMPLE_SIZE = int(os.getenv('APPROX_MAX_SAMPLE_SIZE', '100000'))
+APPROX_CONFIDENCE = float(os.getenv('APPROX_CONFIDENCE', '0.95'))
+APPROX_SAMPLE_SEED = int(os.getenv('APPROX_SAMPLE_SEED', '42'))
+# BERNOULLI samples rows independently, as the intervals assume; SYSTEM samples whole pages,
+# which is cheaper but understates the intervals when page order correlates with the metrics
+APPROX_SAMPLE_METHOD = os.getenv('APPROX_SAMPLE_METHOD', 'BERNOULLI')
+
+# Change listener (manage.py listen_changes): quiet period before recomputing a burst of
+# changes, the longest a change may wait, and the pause before reconnecting
+CHANGE_FEED_DEBOUNCE_SECONDS = float(os.getenv('CHANGE_FEED_DEBOUNCE_SECONDS', '0.5'))
+CHANGE_FEED_MAX_DELAY_SECONDS = float(os.getenv('CHANGE_FEED_MAX_DELAY_SECONDS', '5'))
+CHANGE_FEED_RECONNECT_SECONDS = float(os.getenv('CHANGE_FEED_RECONNECT_SECONDS', '5'))
+# Hours of data_changes rows kept for feature store refreshers that fell behind (engine/changelog.py)
+CHANGE_LOG_RETENTION_HOURS = float(os.getenv('CHANGE_LOG_RETENTION_HOURS', '24'))
+
+# Analytics frames: estimated working-set budget per request before switching to chunked
+# processing, and the rows fetched per round trip
+ANALYTICS_MEMORY_BUDGET_MB = int(os.getenv('ANALYTICS_MEMORY_BUDGET_MB', '512'))
+ANALYTICS_CHUNK_ROWS = int(os.getenv('ANALYTICS_CHUNK_ROWS', '100000'))
+# How analytics queries are read: 'copy' decodes binary COPY straight into NumPy columns,
+# 'cursor' fetches rows through psycopg2 and pandas
+ANALYTICS_READER = os.getenv('ANALYTICS_READER', 'copy')
+
+# Where the whole-table analytics reads come from: 'postgres', or 'snapshot' for the latest
+# Arrow files written by export_snapshot (memory-mapped, shared by every worker); views also
+# take ?source=. Snapshots live under SNAPSHOT_DIR, of which the newest SNAPSHOT_KEEP are kept
+ANALYTICS_SOURCE = os.getenv('ANALYTICS_SOURCE', 'postgres')
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', '/app/snapshots')
+SNAPSHOT_KEEP = int(os.getenv('SNAPSHOT_KEEP', '2'))
+
+# Optional in-process columnar engine (engine/columnar.py): 'duckdb' runs the feature joins and
+# cluster aggregations in DuckDB over the snapshot or the attached database; 'pandas' does not
+ANALYTICS_ENGINE = os.getenv('ANALYTICS_ENGINE', 'pandas')
+COLUMNAR_THREADS = int(os.getenv('COLUMNAR_THREADS', str(os.cpu_count() or 1)))
+
+# Partitioned summaries: worker processes, and the customer count below which partitions run in-process
+SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', str(min(4, os.cpu_count() or 1))))
+SUMMARY_PARALLEL_MIN_ROWS = int(os.getenv('SUMMARY_PARALLEL_MIN_ROWS', '50000'))
+
+# Rows per batch (one NDJSON line) in ?stream=ndjson responses
+STREAM_BATCH_ROWS = int(os.getenv('STREAM_BATCH_ROWS', '1000'))
+
+# Feature drift monitor (engine/drift.py): how often each process writes its histogram counts,
+# the default comparison window, PSI levels reported as moderate / retrain-worthy, and the
+# fewest scored rows before a retrain is recommended
+DRIFT_FLUSH_SECONDS = float(os.getenv('DRIFT_FLUSH_SECONDS', '30'))
+DRIFT_WINDOW_DAYS = int(os.getenv('DRIFT_WINDOW_DAYS', '7'))
+DRIFT_PSI_WARN = float(os.getenv('DRIFT_PSI_WARN', '0.1'))
+DRIFT_PSI_RETRAIN = float(os.getenv('DRIFT_PSI_RETRAIN', '0.25'))
+DRIFT_MIN_SAMPLES = int(os.getenv('DRIFT_MIN_SAMPLES', '500'))
+
+# Single-flight recomputes (engine/locks.py): how long a caller waits for the same job running
+# on another node (0 waits forever), and whether it waits ('wait') or takes the last
+# completed result ('snapshot')
+RECOMPUTE_LOCK_TIMEOUT_SECONDS = float(os.getenv('RECOMPUTE_LOCK_TIMEOUT_SECONDS', '600'))
+RECOMPUTE_WAIT_MODE = os.getenv('RECOMPUTE_WAIT_MODE', 'wait')
+
+# Background jobs (engine/jobqueue.py, manage.py run_jobs): idle poll interval, attempts per
+# job, retry backoff (doubling from BASE up to MAX), heartbeat interval and the silence after
+# which a running job is requeued, days finished jobs are kept, and the priority of jobs
+# queued by API requests (higher runs first)
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', '5'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETRY_BASE_SECONDS = float(os.getenv('JOB_RETRY_BASE_SECONDS', '30'))
+JOB_RETRY_MAX_SECONDS = float(os.getenv('JOB_RETRY_MAX_SECONDS', '1800'))
+JOB_HEARTBEAT_SECONDS = float(os.getenv('JOB_HEARTBEAT_SECONDS', '15'))
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', '120'))
+JOB_RETENTION_DAYS = int(os.getenv('JOB_RETENTION_DAYS', '7'))
+JOB_REQUEST_PRIORITY = int(os.getenv('JOB_REQUEST_PRIORITY', '10'))
+
+# Production serving (gunicorn.conf.py): GET paths requested once in the master before forking,
+# and where the worker that refreshes the feature store holds its lock
+SERVE_WARMUP_PATHS = [p for p in os.getenv(
+    'SERVE_WARMUP_PATHS',
+    '/health/,/api/loan-risk/?summary=1,/api/fee-optimization/?summary=1,/api/segmentation/?summary=1'
+).split(',') if p]
+SERVE_LOCK_DIR = os.getenv('SERVE_LOCK_DIR', '/tmp')
+
+# Loan explanations: most loans per request and default number of drivers per loan
+EXPLAIN_MAX_LOANS = int(os.getenv('EXPLAIN_MAX_LOANS', '500'))
+EXPLAIN_TOP_K = int(os.getenv('EXPLAIN_TOP_K', '5'))
+
+# Fee-policy simulator: grid size limit, (policies x customers) cells per chunk, process fan-out
+FEE_SIMULATOR_MAX_POLICIES = int(os.getenv('FEE_SIMULATOR_MAX_POLICIES', '5000'))
+FEE_SIMULATOR_CHUNK_CELLS = int(os.getenv('FEE_SIMULATOR_CHUNK_CELLS', '2000000'))
+FEE_SIMULATOR_PARALLEL_MIN_CELLS = int(os.getenv('FEE_SIMULATOR_PARALLEL_MIN_CELLS', '20000000'))
+FEE_SIMULATOR_WORKERS = int(os.getenv('FEE_SIMULATOR_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Churn probability added per unit of fee/income when a simulation grid does not set fee_elasticity
+FEE_SIMULATOR_FEE_ELASTICITY = float(os.getenv('FEE_SIMULATOR_FEE_ELASTICITY', '2.0'))
+
+# Fee solver (engine/pricing.py): fewest customers to fit a cluster's own churn curve, the
+# churn log-odds slope per unit of fee/income that a curve's slope less FEE_RESPONSE_SLOPE_Z
+# standard errors must exceed to be priced on (other customers keep the current rule's
+# fee), and the most bisection steps
+FEE_RESPONSE_MIN_CUSTOMERS = int(os.getenv('FEE_RESPONSE_MIN_CUSTOMERS', '50'))
+FEE_RESPONSE_MIN_SLOPE = float(os.getenv('FEE_RESPONSE_MIN_SLOPE', '0.0'))
+FEE_RESPONSE_SLOPE_Z = float(os.getenv('FEE_RESPONSE_SLOPE_Z', '1.96'))
+FEE_SOLVER_ITERATIONS = int(os.getenv('FEE_SOLVER_ITERATIONS', '40'))
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -1,7 +1,8 @@
 from django.urls import path, include
-from engine.views import health_check
+from engine.views import health_check, readiness
 
 urlpatterns = [
     path('api/', include('engine.urls')),
     path('health/', health_check, name='health'),
+    path('health/ready/', readiness, name='health-ready'),
 ]
\ No newline at end of file
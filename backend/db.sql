@@ -11,6 +11,8 @@ CREATE TABLE customers (
     CONSTRAINT valid_segment CHECK (segment IN ('Low Income', 'Middle Class', 'High Net Worth')) -- Example segments
 );
 
+CREATE INDEX customers_updated_at_idx ON customers (updated_at);
+
 CREATE TABLE loans (
     loan_id SERIAL PRIMARY KEY,
     customer_id INTEGER NOT NULL REFERENCES customers(customer_id) ON DELETE RESTRICT,
@@ -22,6 +24,8 @@ CREATE TABLE loans (
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX loans_updated_at_idx ON loans (updated_at);
+
 CREATE TABLE savings_accounts (
     account_id SERIAL PRIMARY KEY,
     customer_id INTEGER NOT NULL REFERENCES customers(customer_id) ON DELETE RESTRICT,
@@ -32,6 +36,8 @@ CREATE TABLE savings_accounts (
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX savings_accounts_updated_at_idx ON savings_accounts (updated_at);
+
 CREATE TABLE fx_transactions (
     fx_id SERIAL PRIMARY KEY,
     customer_id INTEGER NOT NULL REFERENCES customers(customer_id) ON DELETE RESTRICT,
@@ -40,12 +46,18 @@ CREATE TABLE fx_transactions (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Range-partitioned by month of transaction_date; monthly partitions are created by
+-- `manage.py partition_card_transactions`, and rows outside them land in the default partition
 CREATE TABLE card_transactions (
-    transaction_id SERIAL PRIMARY KEY,
+    transaction_id SERIAL,
     customer_id INTEGER NOT NULL REFERENCES customers(customer_id) ON DELETE RESTRICT,
     transaction_value DECIMAL(12,2) CHECK (transaction_value >= 0),
     category VARCHAR(50) NOT NULL,
     is_fx_transaction BOOLEAN NOT NULL DEFAULT FALSE,
-    transaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+    transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, -- Partition key
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (transaction_id, transaction_date)
+) PARTITION BY RANGE (transaction_date);
+
+CREATE TABLE card_transactions_default PARTITION OF card_transactions DEFAULT;
+CREATE INDEX card_transactions_customer_date_idx ON card_transactions (customer_id, transaction_date);
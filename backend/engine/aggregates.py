@@ -0,0 +1,297 @@
+import logging
+
+from django.db import connection, transaction
+from django.db.models import Count
+
+from . import schema, snapshots
+from .models import Customer
+
+logger = logging.getLogger(__name__)
+
+# Summaries computed with GROUP BY so summary-only calls move O(clusters) rows, not O(customers)
+
+# Every watermark is an index lookup: updated_at is indexed on the three tables, and card
+# transactions, which have no updated_at, are read newest-first by primary key
+SCORES_FRESHNESS_QUERY = """
+SELECT COUNT(*) FILTER (WHERE s.loan_id IS NULL) AS unscored,
+       MIN(s.scored_at) AS oldest_score,
+       GREATEST(
+           (SELECT MAX(updated_at) FROM customers),
+           (SELECT MAX(updated_at) FROM loans),
+           (SELECT MAX(updated_at) FROM savings_accounts),
+           (SELECT created_at FROM card_transactions ORDER BY transaction_id DESC LIMIT 1)
+       ) AS last_change
+FROM loans l
+LEFT JOIN loan_scores s ON s.loan_id = l.loan_id AND s.model_version = %s
+"""
+
+LOAN_CLUSTER_RISK_QUERY = """
+SELECT c.cluster,
+       AVG(s.default_probability) AS avg_default_probability,
+       COUNT(*) AS loan_count,
+       AVG(l.loan_amount) AS avg_loan_amount,
+       AVG(c.credit_score) AS avg_credit_score,
+       AVG(c.income) AS avg_income
+FROM loan_scores s
+JOIN loans l ON l.loan_id = s.loan_id
+JOIN customers c ON c.customer_id = l.customer_id
+WHERE s.model_version = %s AND c.cluster IS NOT NULL
+GROUP BY c.cluster
+ORDER BY c.cluster
+"""
+
+# Row-level LoanRiskView output from the persisted scores
+LOAN_ROWS_QUERY = """
+SELECT s.loan_id, s.customer_id, l.loan_amount::float8 AS loan_amount, s.default_probability,
+       s.risk_category, COALESCE(c.cluster, -1) AS cluster
+FROM loan_scores s
+JOIN loans l ON l.loan_id = s.loan_id
+JOIN customers c ON c.customer_id = l.customer_id
+WHERE s.model_version = %s
+ORDER BY s.loan_id
+"""
+
+LOAN_CUSTOMER_ROWS_QUERY = """
+SELECT s.customer_id, AVG(s.default_probability) AS avg_default_probability,
+       (array_agg(s.risk_category ORDER BY s.loan_id))[1] AS risk_category,
+       COALESCE(MIN(c.cluster), -1) AS cluster
+FROM loan_scores s
+JOIN loans l ON l.loan_id = s.loan_id
+JOIN customers c ON c.customer_id = l.customer_id
+WHERE s.model_version = %s
+GROUP BY s.customer_id
+ORDER BY s.customer_id
+"""
+
+PORTFOLIO_QUERY = """
+SELECT COUNT(*) AS total_loans,
+       COUNT(*) FILTER (WHERE s.risk_category = 'High') AS high_risk_loans,
+       COUNT(*) FILTER (WHERE s.risk_category = 'Medium') AS medium_risk_loans,
+       COUNT(*) FILTER (WHERE s.risk_category = 'Low') AS low_risk_loans,
+       ROUND(AVG(s.default_probability)::numeric, 3)::float8 AS avg_default_probability
+FROM loan_scores s
+JOIN loans l ON l.loan_id = s.loan_id
+WHERE s.model_version = %s
+"""
+
+# Per-customer segmentation inputs, shared by the summary and the streamed rows
+SEGMENTATION_FEATURES = """
+WITH features AS (
+    SELECT c.customer_id, c.cluster, c.income, c.credit_score, c.is_diaspora,
+           COALESCE(s.savings_balance, 0) AS savings_balance,
+           COALESCE(s.activity_score, 0) AS activity_score,
+           COALESCE(ct.total_card_value, 0) AS total_card_value,
+           COALESCE(ct.transaction_count, 0) AS transaction_count,
+           COALESCE(l.total_loan_amount, 0) AS total_loan_amount
+    FROM customers c
+    LEFT JOIN savings_accounts s ON s.customer_id = c.customer_id
+    LEFT JOIN (
+        SELECT customer_id, SUM(transaction_value) AS total_card_value, COUNT(*) AS transaction_count
+        FROM card_transactions GROUP BY customer_id
+    ) ct ON ct.customer_id = c.customer_id
+    LEFT JOIN (
+        SELECT customer_id, SUM(loan_amount) AS total_loan_amount FROM loans GROUP BY customer_id
+    ) l ON l.customer_id = c.customer_id
+)
+"""
+
+SEGMENTATION_SUMMARY_QUERY = SEGMENTATION_FEATURES + """
+SELECT cluster,
+       AVG(income)::float8 AS income,
+       AVG(credit_score)::float8 AS credit_score,
+       AVG(savings_balance)::float8 AS savings_balance,
+       AVG(total_card_value)::float8 AS total_card_value,
+       AVG(total_loan_amount)::float8 AS total_loan_amount,
+       AVG(activity_score)::float8 AS activity_score,
+       AVG(CASE WHEN activity_score < 0.3 OR transaction_count < 5 THEN 1 ELSE 0 END)::float8 AS churn_risk,
+       AVG(LEAST(GREATEST((income + savings_balance + total_card_value) * 0.001, 100), 1000))::float8 AS fee_target,
+       COUNT(*) AS count,
+       COUNT(*) FILTER (WHERE is_diaspora) AS diaspora_count
+FROM features
+WHERE cluster IS NOT NULL
+GROUP BY cluster
+ORDER BY cluster
+"""
+
+SEGMENTATION_CUSTOMER_ROWS_QUERY = SEGMENTATION_FEATURES + """
+SELECT customer_id, cluster, income, credit_score,
+       savings_balance::float8 AS savings_balance,
+       total_card_value::float8 AS total_card_value,
+       total_loan_amount::float8 AS total_loan_amount,
+       is_diaspora
+FROM features
+ORDER BY customer_id
+"""
+
+# The FeeOptimizationView fee rule evaluated per customer in SQL
+FEE_CUSTOMERS = """
+WITH risk AS (
+    SELECT customer_id, AVG(default_probability) AS avg_default_probability
+    FROM loan_scores WHERE model_version = %(model_version)s GROUP BY customer_id
+), base AS (
+    SELECT c.customer_id, COALESCE(c.cluster, -1) AS cluster,
+           COALESCE(c.income, (SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY income) FROM customers)) AS income,
+           COALESCE(s.savings_balance, 0) AS savings_balance,
+           COALESCE(ct.total_card_value, 0) AS total_card_value,
+           CASE WHEN COALESCE(s.activity_score, 0) < 0.3 THEN 1 ELSE 0 END AS churn_risk,
+           COALESCE(r.avg_default_probability, 0) AS avg_default_probability
+    FROM customers c
+    LEFT JOIN savings_accounts s ON s.customer_id = c.customer_id
+    LEFT JOIN (
+        SELECT customer_id, SUM(transaction_value) AS total_card_value FROM card_transactions GROUP BY customer_id
+    ) ct ON ct.customer_id = c.customer_id
+    LEFT JOIN risk r ON r.customer_id = c.customer_id
+), fees AS (
+    SELECT *, ROUND(GREATEST(100, LEAST(1000, LEAST(
+               (income + savings_balance + total_card_value) * 0.001
+               * CASE WHEN avg_default_probability > 0.5 THEN 1.2
+                      WHEN avg_default_probability > 0.2 THEN 1.1 ELSE 1.0 END
+               * CASE WHEN cluster = 0 THEN 0.8 WHEN cluster = 2 THEN 1.2 ELSE 1.0 END,
+               CASE WHEN churn_risk > 0.5 THEN income * 0.05 ELSE income * 0.1 END
+           )))::numeric, 2)::float8 AS recommended_fee
+    FROM base
+), revenue AS (
+    SELECT *, recommended_fee * (1 - churn_risk * 0.5) AS expected_revenue FROM fees
+)
+"""
+
+FEE_SUMMARY_QUERY = FEE_CUSTOMERS + """
+SELECT cluster,
+       AVG(recommended_fee) AS avg_recommended_fee,
+       SUM(expected_revenue) AS total_revenue,
+       AVG(churn_risk)::float8 AS avg_churn_risk,
+       COUNT(*) AS customer_count,
+       AVG(avg_default_probability) AS avg_default_probability
+FROM revenue
+GROUP BY ROLLUP (cluster)
+ORDER BY cluster
+"""
+
+FEE_CUSTOMER_ROWS_QUERY = FEE_CUSTOMERS + """
+SELECT customer_id, cluster, recommended_fee, expected_revenue, churn_risk, avg_default_probability
+FROM revenue
+ORDER BY customer_id
+"""
+
+
+def _fetch_dicts(query, params=None):
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def customer_counts_by_cluster(k=3):
+    if snapshots.serving() is not None:
+        # Count the snapshot's labels, like the rest of a snapshot response
+        clusters = schema.read_columns(snapshots.CUSTOMERS_TABLE_QUERY)['cluster']
+        counts = clusters.dropna().astype(int).value_counts().to_dict()
+    else:
+        counts = {
+            row['cluster']: row['customer_count']
+            for row in Customer.objects.values('cluster').annotate(customer_count=Count('customer_id'))
+        }
+    return {f'Cluster {i}': {'customer_count': counts.get(i, 0)} for i in range(k)}
+
+
+def persist_scores(loan_ids, customer_ids, probabilities, categories, model_version):
+    """Upsert the latest score of each loan in one statement.
+
+    Scores of a snapshot's rows are not saved; they would overwrite newer ones.
+    """
+    if snapshots.serving() is not None:
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO loan_scores (loan_id, customer_id, model_version, default_probability, risk_category, scored_at)
+            SELECT u.loan_id, u.customer_id, %s, u.default_probability, u.risk_category, now()
+            FROM unnest(%s::int[], %s::int[], %s::float8[], %s::text[])
+                 AS u(loan_id, customer_id, default_probability, risk_category)
+            ON CONFLICT (loan_id) DO UPDATE SET
+                customer_id = EXCLUDED.customer_id,
+                model_version = EXCLUDED.model_version,
+                default_probability = EXCLUDED.default_probability,
+                risk_category = EXCLUDED.risk_category,
+                scored_at = EXCLUDED.scored_at
+            """,
+            [model_version, [int(i) for i in loan_ids], [int(i) for i in customer_ids],
+             [float(p) for p in probabilities], [str(c) for c in categories]]
+        )
+
+
+def scores_current(model_version):
+    """True when every loan has a score from this model newer than any change to its inputs."""
+    row = _fetch_dicts(SCORES_FRESHNESS_QUERY, [model_version])[0]
+    if row['unscored'] or row['oldest_score'] is None:
+        return False
+    if row['last_change'] is None:
+        return True
+    oldest_score, last_change = row['oldest_score'], row['last_change']
+    # Source tables use naive timestamps in the session time zone (UTC)
+    if oldest_score.tzinfo is not None and last_change.tzinfo is None:
+        oldest_score = oldest_score.replace(tzinfo=None)
+    return last_change <= oldest_score
+
+
+def loan_risk_summary(model_version):
+    return {
+        'clusters': [
+            {**row, 'cluster': int(row['cluster']),
+             'avg_loan_amount': float(row['avg_loan_amount']),
+             'avg_credit_score': float(row['avg_credit_score']),
+             'avg_income': float(row['avg_income'])}
+            for row in _fetch_dicts(LOAN_CLUSTER_RISK_QUERY, [model_version])
+        ],
+        'portfolio': _fetch_dicts(PORTFOLIO_QUERY, [model_version])[0],
+    }
+
+
+def segmentation_summary(fee_model=None, k=3):
+    """Per-cluster averages; recommended_fee uses the persisted fee regression when available.
+
+    The regression is linear, so the mean of its predictions over a cluster equals its
+    prediction at the cluster's mean income, savings balance and card value.
+    """
+    rows = {row['cluster']: row for row in _fetch_dicts(SEGMENTATION_SUMMARY_QUERY)}
+    summary = {}
+    for i in range(k):
+        row = rows.get(i, {})
+        if row and fee_model:
+            recommended_fee = fee_model['intercept'] + sum(
+                coef * row[feature] for feature, coef in zip(fee_model['features'], fee_model['coef'])
+            )
+        else:
+            recommended_fee = row.get('fee_target', 0)
+        summary[f'Cluster {i}'] = {
+            'avg_income': row.get('income', 0),
+            'avg_credit_score': row.get('credit_score', 0),
+            'avg_savings_balance': row.get('savings_balance', 0),
+            'avg_card_value': row.get('total_card_value', 0),
+            'avg_loan_amount': row.get('total_loan_amount', 0),
+            'avg_activity_score': row.get('activity_score', 0),
+            'churn_risk': row.get('churn_risk', 0),
+            'recommended_fee': recommended_fee,
+            'count': row.get('count', 0),
+            'diaspora_count': row.get('diaspora_count', 0),
+        }
+    return summary
+
+
+def fee_summary(model_version):
+    rows = _fetch_dicts(FEE_SUMMARY_QUERY, {'model_version': model_version})
+    # ROLLUP adds the portfolio-wide row with cluster = NULL
+    total = next(row for row in rows if row['cluster'] is None)
+    clusters = [
+        {**row, 'cluster': int(row['cluster'])}
+        for row in rows if row['cluster'] is not None and row['cluster'] != -1
+    ]
+    return {
+        'clusters': clusters,
+        'portfolio': {
+            'total_customers': total['customer_count'],
+            'total_revenue': round(total['total_revenue'] or 0, 2),
+            'avg_recommended_fee': round(total['avg_recommended_fee'] or 0, 2),
+            'avg_churn_risk': round(total['avg_churn_risk'] or 0, 3),
+        },
+    }
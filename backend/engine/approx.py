@@ -0,0 +1,320 @@
+import logging
+import math
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection
+
+from . import aggregates, fees, schema
+from .scoring import FEATURES, book_age_median, feature_importance, prepare_loan_features, risk_category
+
+logger = logging.getLogger(__name__)
+
+# Dashboard summaries estimated from a fixed-size TABLESAMPLE, so their cost does not grow
+# with the book. Every estimate comes with a <name>_ci [low, high] interval. Whole-table
+# estimates are stratified (customers by cluster, loans by tenure) on the pg_stats shares.
+
+CUSTOMER_SAMPLE_QUERY = """
+SELECT c.customer_id, COALESCE(c.cluster, -1) AS cluster, c.income::float8 AS income,
+       c.credit_score::float8 AS credit_score, c.is_diaspora,
+       COALESCE(s.savings_balance, 0)::float8 AS savings_balance,
+       COALESCE(s.activity_score, 0)::float8 AS activity_score,
+       COALESCE(ct.total_card_value, 0)::float8 AS total_card_value,
+       COALESCE(ct.transaction_count, 0) AS transaction_count,
+       COALESCE(l.total_loan_amount, 0)::float8 AS total_loan_amount
+FROM customers c {sample}
+LEFT JOIN savings_accounts s ON s.customer_id = c.customer_id
+LEFT JOIN LATERAL (
+    SELECT SUM(transaction_value) AS total_card_value, COUNT(*) AS transaction_count
+    FROM card_transactions WHERE customer_id = c.customer_id
+) ct ON true
+LEFT JOIN LATERAL (
+    SELECT SUM(loan_amount) AS total_loan_amount FROM loans WHERE customer_id = c.customer_id
+) l ON true
+"""
+
+LOAN_SAMPLE_QUERY = """
+SELECT l.loan_id, l.customer_id, l.loan_amount, l.interest_rate, l.loan_tenure_months,
+       c.income, c.credit_score, c.cluster, s.activity_score,
+       c.is_diaspora, c.age, c.segment,
+       COALESCE((
+           SELECT SUM(ct.transaction_value)
+           FROM card_transactions ct
+           WHERE ct.customer_id = c.customer_id
+       ), 0) as total_card_value
+FROM loans l {sample}
+JOIN customers c ON l.customer_id = c.customer_id
+LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
+"""
+
+STATS_QUERY = """
+SELECT null_frac, most_common_vals::text, most_common_freqs
+FROM pg_stats
+WHERE schemaname = 'public' AND tablename = %s AND attname = %s
+"""
+
+
+def requested_sample_size(request):
+    """Sample size asked for with ?approx=: a number of rows, or true/1/yes for the default."""
+    params = getattr(request, 'query_params', {})
+    value = str(params.get('approx', '')).strip().lower()
+    if not value or value in ('0', 'false', 'no'):
+        return None
+    if value in ('true', 'yes'):
+        return settings.APPROX_SAMPLE_SIZE
+    try:
+        size = int(value)
+    except ValueError:
+        raise ValueError('approx must be true or a sample size')
+    if size < 1:
+        raise ValueError('approx must be true or a sample size')
+    # approx=1 reads as a flag rather than a one-row sample
+    return settings.APPROX_SAMPLE_SIZE if size == 1 else min(size, settings.APPROX_MAX_SAMPLE_SIZE)
+
+
+def population(table):
+    """Row count from the planner statistics, counted only if the table was never analyzed."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", [table])
+        row = cursor.fetchone()
+        if row and row[0] > 0:
+            return int(row[0])
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        return int(cursor.fetchone()[0])
+
+
+def plan(table, target):
+    """Return (population, TABLESAMPLE clause, sampled fraction) for roughly ``target`` rows."""
+    size = population(table)
+    fraction = min(1.0, target / size) if size else 1.0
+    if fraction >= 1.0:
+        return size, '', 1.0
+    # BERNOULLI samples rows independently, which the interval formulas below assume. SYSTEM
+    # reads only the sampled pages, but a page is a cluster of related rows, so it is opt-in
+    method = 'SYSTEM' if settings.APPROX_SAMPLE_METHOD.upper() == 'SYSTEM' else 'BERNOULLI'
+    clause = f'TABLESAMPLE {method} ({fraction * 100:.6f}) REPEATABLE ({int(settings.APPROX_SAMPLE_SEED)})'
+    return size, clause, fraction
+
+
+def stratum_weights(table, column):
+    """Population share of each value of ``column`` from pg_stats, or None if the stats do not cover it."""
+    with connection.cursor() as cursor:
+        cursor.execute(STATS_QUERY, [table, column])
+        row = cursor.fetchone()
+    if not row or row[1] is None:
+        return None
+    null_frac, values, freqs = row
+    weights = {float(value): float(freq) for value, freq in zip(values.strip('{}').split(','), freqs)}
+    if null_frac:
+        weights[-1.0] = weights.get(-1.0, 0.0) + float(null_frac)
+    # Only usable when every value is a most-common value
+    if abs(sum(weights.values()) - 1.0) > 0.01:
+        return None
+    return weights
+
+
+def _z():
+    return NormalDist().inv_cdf(0.5 + settings.APPROX_CONFIDENCE / 2)
+
+
+def _interval(estimate, half_width, digits=3):
+    estimate = float(estimate)
+    if half_width is None or not math.isfinite(half_width):
+        return round(estimate, digits), None
+    return round(estimate, digits), [round(estimate - half_width, digits), round(estimate + half_width, digits)]
+
+
+def mean_ci(values, fpc):
+    """Sample mean and the half-width of its confidence interval (finite population corrected)."""
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n == 0:
+        return 0.0, None
+    if fpc == 0:
+        # The whole table was read, so the mean is exact
+        return values.mean(), 0.0
+    if n == 1:
+        return values.mean(), None
+    return values.mean(), _z() * math.sqrt(values.var(ddof=1) / n * fpc)
+
+
+def stratified_mean_ci(values, strata, weights, fpc):
+    """Stratified estimate of the population mean.
+
+    Uses the known stratum weights when they cover every sampled stratum, otherwise falls
+    back to the plain sample mean and its interval.
+    """
+    frame = pd.DataFrame({'value': np.asarray(values, dtype=float), 'stratum': np.asarray(strata, dtype=float)})
+    groups = frame.groupby('stratum')['value'].agg(['mean', 'var', 'count'])
+    if not len(groups) or not weights or any(stratum not in weights for stratum in groups.index):
+        return mean_ci(frame['value'], fpc)
+    shares = pd.Series({stratum: weights[stratum] for stratum in groups.index})
+    shares = shares / shares.sum()
+    estimate = float((shares * groups['mean']).sum())
+    variance = float((shares ** 2 * groups['var'].fillna(0) / groups['count']).sum()) * fpc
+    return estimate, _z() * math.sqrt(variance)
+
+
+def _total_ci(values, strata, weights, size, fpc):
+    """Stratified estimate of a population total (a count when ``values`` is a mask), with its interval."""
+    mean, half = stratified_mean_ci(np.asarray(values, dtype=float), strata, weights, fpc)
+    return mean * size, half * size if half is not None else None
+
+
+def _population_correction(size, fraction, sample_rows):
+    """Population size and finite population correction for a sample of ``sample_rows`` rows.
+
+    TABLESAMPLE keeps a random number of rows, so the realised sample size is used rather
+    than the requested fraction.
+    """
+    if fraction >= 1.0:
+        return sample_rows, 0.0
+    return size, max(0.0, 1.0 - sample_rows / size) if size else 0.0
+
+
+def _with_intervals(target, key, estimate, half_width, digits=3):
+    target[key], target[f'{key}_ci'] = _interval(estimate, half_width, digits)
+
+
+def _approximation(table, size, fraction, sample_rows):
+    return {
+        'table': table,
+        'population': size,
+        'sample_rows': int(sample_rows),
+        'sample_percent': round(100.0 * sample_rows / size, 4) if size else 100.0,
+        'confidence': settings.APPROX_CONFIDENCE,
+        'exact': fraction >= 1.0,
+    }
+
+
+def segmentation_summary(target, fee_model=None, k=3):
+    size, clause, fraction = plan('customers', target)
+    data = schema.read_columns(CUSTOMER_SAMPLE_QUERY.format(sample=clause))
+    size, fpc = _population_correction(size, fraction, len(data))
+    logger.info(f"Sampled {len(data)} of ~{size} customers for approximate segmentation")
+
+    wealth = data['income'].fillna(0) + data['savings_balance'] + data['total_card_value']
+    if fee_model:
+        # Mean of per-row predictions equals the linear fee model at the cluster means
+        data['recommended_fee'] = fee_model['intercept'] + sum(
+            coef * data[feature].fillna(0) for feature, coef in zip(fee_model['features'], fee_model['coef'])
+        )
+    else:
+        data['recommended_fee'] = (wealth * 0.001).clip(100, 1000)
+    data['churn_risk'] = ((data['activity_score'] < 0.3) | (data['transaction_count'] < 5)).astype(float)
+
+    metrics = {
+        'avg_income': 'income', 'avg_credit_score': 'credit_score', 'avg_savings_balance': 'savings_balance',
+        'avg_card_value': 'total_card_value', 'avg_loan_amount': 'total_loan_amount',
+        'avg_activity_score': 'activity_score', 'churn_risk': 'churn_risk', 'recommended_fee': 'recommended_fee',
+    }
+    # Clusters are the strata, so a cluster's means are its stratum means and its counts
+    # follow from the pg_stats shares
+    weights = stratum_weights('customers', 'cluster')
+    summary = {}
+    for i in range(k):
+        in_cluster = data['cluster'] == i
+        rows = data[in_cluster]
+        entry = {}
+        for key, column in metrics.items():
+            _with_intervals(entry, key, *mean_ci(rows[column].dropna(), fpc))
+        _with_intervals(entry, 'count', *_total_ci(in_cluster, data['cluster'], weights, size, fpc), digits=0)
+        _with_intervals(entry, 'diaspora_count', *_total_ci(in_cluster & data['is_diaspora'], data['cluster'],
+                                                            weights, size, fpc), digits=0)
+        summary[f'Cluster {i}'] = entry
+    return {'summary': summary, 'approximation': _approximation('customers', size, fraction, len(data))}
+
+
+def loan_risk_summary(target, artifacts):
+    size, clause, fraction = plan('loans', target)
+    data = schema.read_columns(LOAN_SAMPLE_QUERY.format(sample=clause))
+    size, fpc = _population_correction(size, fraction, len(data))
+    logger.info(f"Sampled {len(data)} of ~{size} loans for approximate loan risk")
+
+    clusters = []
+    portfolio = {'total_loans': size}
+    if len(data):
+        data = prepare_loan_features(data, book_age_median())
+        X_scaled = artifacts.scaler.transform(data[FEATURES].astype(float))
+        data['default_probability'] = artifacts.model.predict_proba(X_scaled)[:, 1].round(3)
+        data['risk_category'] = risk_category(data['default_probability'])
+        for col in ['loan_amount', 'credit_score', 'income']:
+            data[col] = pd.to_numeric(data[col], errors='coerce').astype(float)
+
+        # Loans carry no cluster of their own, so the book is stratified by tenure
+        weights, tenure = stratum_weights('loans', 'loan_tenure_months'), data['loan_tenure_months']
+        for category in ('High', 'Medium', 'Low'):
+            _with_intervals(portfolio, f'{category.lower()}_risk_loans',
+                            *_total_ci(data['risk_category'] == category, tenure, weights, size, fpc), digits=0)
+        _with_intervals(portfolio, 'avg_default_probability',
+                        *stratified_mean_ci(data['default_probability'], tenure, weights, fpc))
+
+        for cluster in sorted(data.loc[data['cluster'] != -1, 'cluster'].dropna().unique()):
+            in_cluster = data['cluster'] == cluster
+            rows = data[in_cluster]
+            entry = {'cluster': int(cluster)}
+            _with_intervals(entry, 'avg_default_probability', *mean_ci(rows['default_probability'], fpc))
+            _with_intervals(entry, 'loan_count', *_total_ci(in_cluster, tenure, weights, size, fpc), digits=0)
+            for key, column in (('avg_loan_amount', 'loan_amount'), ('avg_credit_score', 'credit_score'),
+                                ('avg_income', 'income')):
+                _with_intervals(entry, key, *mean_ci(rows[column].dropna(), fpc), digits=2)
+            clusters.append(entry)
+
+    # Customer counts from planner statistics when they cover the clusters, to stay off a full count
+    weights = stratum_weights('customers', 'cluster')
+    if weights:
+        customers = population('customers')
+        cluster_summary = {f'Cluster {i}': {'customer_count': round(weights.get(float(i), 0) * customers)}
+                           for i in range(3)}
+    else:
+        cluster_summary = aggregates.customer_counts_by_cluster()
+
+    return {
+        'clusters': clusters,
+        'portfolio': portfolio,
+        'feature_importance': feature_importance(artifacts.model),
+        'cluster_summary': cluster_summary,
+        'approximation': _approximation('loans', size, fraction, len(data)),
+    }
+
+
+def fee_summary(target):
+    size, clause, fraction = plan('customers', target)
+    data = fees.customer_frame(sample=clause)
+    size, fpc = _population_correction(size, fraction, len(data))
+    logger.info(f"Sampled {len(data)} of ~{size} customers for approximate fee optimization")
+
+    portfolio = {'total_customers': size}
+    clusters = []
+    if len(data):
+        data = fees.apply_policy(data)
+        # Stratify the portfolio estimates by cluster, weighted by the population shares
+        weights = stratum_weights('customers', 'cluster')
+        _with_intervals(portfolio, 'total_revenue',
+                        *_total_ci(data['expected_revenue'], data['cluster'], weights, size, fpc), digits=2)
+        _with_intervals(portfolio, 'avg_recommended_fee',
+                        *stratified_mean_ci(data['recommended_fee'], data['cluster'], weights, fpc), digits=2)
+        _with_intervals(portfolio, 'avg_churn_risk',
+                        *stratified_mean_ci(data['churn_risk'], data['cluster'], weights, fpc))
+
+        for cluster in sorted(data.loc[data['cluster'] != -1, 'cluster'].unique()):
+            in_cluster = data['cluster'] == cluster
+            rows = data[in_cluster]
+            entry = {'cluster': int(cluster)}
+            _with_intervals(entry, 'avg_recommended_fee', *mean_ci(rows['recommended_fee'], fpc), digits=2)
+            # Domain total: population size times the mean of revenue masked to the cluster
+            _with_intervals(entry, 'total_revenue', *_total_ci(data['expected_revenue'].where(in_cluster, 0),
+                                                               data['cluster'], weights, size, fpc), digits=2)
+            _with_intervals(entry, 'avg_churn_risk', *mean_ci(rows['churn_risk'], fpc))
+            _with_intervals(entry, 'customer_count', *_total_ci(in_cluster, data['cluster'], weights, size, fpc),
+                            digits=0)
+            _with_intervals(entry, 'avg_default_probability', *mean_ci(rows['avg_default_probability'], fpc))
+            clusters.append(entry)
+
+    return {
+        'clusters': clusters,
+        'portfolio': portfolio,
+        'approximation': _approximation('customers', size, fraction, len(data)),
+    }
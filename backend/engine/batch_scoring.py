@@ -0,0 +1,185 @@
+import io
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+from threadpoolctl import threadpool_limits
+
+from . import schema
+from .profiling import key_ranges
+from .scoring import AGE_MEDIAN_QUERY, FEATURES, load_artifacts, prepare_loan_features, risk_category
+
+logger = logging.getLogger(__name__)
+
+# Same features as LoanRiskView, restricted to one loan_id range
+LOAN_RANGE_QUERY = """
+SELECT l.loan_id, l.customer_id, l.loan_amount, l.interest_rate, l.loan_tenure_months,
+       c.income, c.credit_score, c.cluster, s.activity_score,
+       c.is_diaspora, c.age, c.segment,
+       COALESCE((
+           SELECT SUM(ct.transaction_value)
+           FROM card_transactions ct
+           WHERE ct.customer_id = c.customer_id
+       ), 0) as total_card_value
+FROM loans l
+JOIN customers c ON l.customer_id = c.customer_id
+LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
+WHERE l.loan_id BETWEEN :low AND :high
+ORDER BY l.loan_id
+"""
+
+STAGE_QUERY = """
+CREATE TEMP TABLE loan_scores_stage (
+    loan_id integer, customer_id integer, default_probability float8, risk_category varchar(10)
+) ON COMMIT DROP
+"""
+
+MERGE_QUERY = """
+INSERT INTO loan_scores (loan_id, customer_id, model_version, default_probability, risk_category, scored_at)
+SELECT loan_id, customer_id, %s, default_probability, risk_category, now()
+FROM loan_scores_stage
+ON CONFLICT (loan_id) DO UPDATE SET
+    customer_id = EXCLUDED.customer_id,
+    model_version = EXCLUDED.model_version,
+    default_probability = EXCLUDED.default_probability,
+    risk_category = EXCLUDED.risk_category,
+    scored_at = EXCLUDED.scored_at
+"""
+
+# Per-process state set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(database_url, threads):
+    # Cap BLAS/OpenMP pools so N workers x M threads does not oversubscribe the cores
+    _worker['limits'] = threadpool_limits(limits=threads)
+    artifacts = load_artifacts()
+    if hasattr(artifacts.model, 'set_params'):
+        try:
+            artifacts.model.set_params(n_jobs=threads)
+        except ValueError:
+            pass
+    _worker['artifacts'] = artifacts
+    _worker['engine'] = create_engine(database_url, pool_size=1)
+
+
+def score_range(low, high, chunk_size, age_median=None):
+    """Score loans with low <= loan_id <= high and COPY the results into loan_scores.
+
+    Missing ages are filled with ``age_median``, the median over the whole book.
+    """
+    artifacts, engine = _worker['artifacts'], _worker['engine']
+    timings = defaultdict(float)
+    rows = 0
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        params = {'low': low, 'high': high}
+        t0 = time.perf_counter()
+        chunks = schema.copy_frames(LOAN_RANGE_QUERY, params, rows=chunk_size, bind=engine)
+        timings['read'] += time.perf_counter() - t0
+        if chunks is None:
+            chunks = pd.read_sql(text(LOAN_RANGE_QUERY), conn.execution_options(stream_results=True),
+                                 params=params, chunksize=chunk_size)
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute(STAGE_QUERY)
+            while True:
+                t0 = time.perf_counter()
+                chunk = next(chunks, None)
+                timings['read'] += time.perf_counter() - t0
+                if chunk is None:
+                    break
+
+                t0 = time.perf_counter()
+                chunk = prepare_loan_features(chunk, age_median)
+                X_scaled = artifacts.scaler.transform(chunk[FEATURES].astype(float))
+                probabilities = artifacts.model.predict_proba(X_scaled)[:, 1].round(3)
+                timings['score'] += time.perf_counter() - t0
+
+                t0 = time.perf_counter()
+                buffer = io.StringIO()
+                pd.DataFrame({
+                    'loan_id': chunk['loan_id'],
+                    'customer_id': chunk['customer_id'],
+                    'default_probability': probabilities,
+                    'risk_category': risk_category(probabilities),
+                }).to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cursor.copy_expert('COPY loan_scores_stage FROM STDIN WITH (FORMAT csv)', buffer)
+                timings['write'] += time.perf_counter() - t0
+                rows += len(chunk)
+
+            t0 = time.perf_counter()
+            cursor.execute(MERGE_QUERY, [artifacts.version])
+            raw.commit()
+            timings['write'] += time.perf_counter() - t0
+        finally:
+            raw.close()
+
+    return {
+        'pid': os.getpid(),
+        'low': low,
+        'high': high,
+        'rows': rows,
+        'seconds': time.perf_counter() - started,
+        **{f'{stage}_seconds': seconds for stage, seconds in timings.items()},
+    }
+
+
+def score_book(database_url, workers=4, ranges=None, chunk_size=50000, threads_per_worker=None):
+    """Score every loan in parallel loan_id ranges and return overall and per-worker throughput."""
+    started = time.perf_counter()
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    # More ranges than workers keeps the pool busy when ranges are uneven
+    engine = create_engine(database_url)
+    with engine.connect() as conn:
+        tasks = key_ranges(conn, 'loans', 'loan_id', ranges or workers * 4)
+        age_median = conn.execute(text(AGE_MEDIAN_QUERY)).scalar()
+    engine.dispose()
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(database_url, threads_per_worker)) as pool:
+        futures = [pool.submit(score_range, low, high, chunk_size, age_median) for low, high in tasks]
+        for future in futures:
+            result = future.result()
+            logger.info(f"Scored loans {result['low']}-{result['high']}: {result['rows']} rows "
+                        f"in {result['seconds']:.2f}s (pid {result['pid']})")
+            results.append(result)
+
+    per_worker = defaultdict(lambda: defaultdict(float))
+    for result in results:
+        stats = per_worker[result['pid']]
+        for key in ('rows', 'seconds', 'read_seconds', 'score_seconds', 'write_seconds'):
+            stats[key] += result.get(key, 0)
+        stats['ranges'] += 1
+
+    elapsed = time.perf_counter() - started
+    total = sum(result['rows'] for result in results)
+    return {
+        'loans': total,
+        'ranges': len(tasks),
+        'workers': workers,
+        'threads_per_worker': threads_per_worker,
+        'model_version': load_artifacts().version,
+        'duration_seconds': round(elapsed, 3),
+        'loans_per_second': round(total / elapsed, 1) if elapsed else None,
+        'per_worker': [
+            {
+                'pid': pid,
+                'ranges': int(stats['ranges']),
+                'loans': int(stats['rows']),
+                'busy_seconds': round(stats['seconds'], 3),
+                'read_seconds': round(stats['read_seconds'], 3),
+                'score_seconds': round(stats['score_seconds'], 3),
+                'write_seconds': round(stats['write_seconds'], 3),
+                'loans_per_second': round(stats['rows'] / stats['seconds'], 1) if stats['seconds'] else None,
+            }
+            for pid, stats in sorted(per_worker.items())
+        ],
+    }
@@ -0,0 +1,164 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Coalesces concurrent scoring requests into a single model call.
+
+    Callers submit a feature matrix and block on the returned future. A background
+    thread takes the first waiting request, keeps collecting requests until either
+    ``max_batch_size`` rows are queued or ``window_ms`` has passed since that first
+    request was enqueued, then scores all of them with one ``predict_fn`` call. If that
+    call fails, each request is scored on its own so one bad input fails only its caller.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=512, window_ms=5.0, history=1000):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._batch_sizes = deque(maxlen=history)
+        self._queue_waits = deque(maxlen=history)
+        self._totals = {'batches': 0, 'requests': 0, 'rows': 0, 'errors': 0}
+
+    def submit(self, X):
+        """Queue rows for scoring; the future resolves to (probabilities, batch_info)."""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((np.asarray(X, dtype=float), time.perf_counter(), future))
+        return future
+
+    def score(self, X, timeout=30):
+        return self.submit(X).result(timeout=timeout)
+
+    def _ensure_worker(self):
+        # The worker thread does not survive a fork, so restart it in each new process
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        first = self._queue.get()
+        batch = [first]
+        rows = len(first[0])
+        deadline = first[1] + self.window
+        while rows < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return batch, rows
+
+    def _predict(self, X):
+        result = self.predict_fn(X)
+        # predict_fn may return (probabilities, extra_info) to annotate every result
+        probabilities, extra = result if isinstance(result, tuple) else (result, {})
+        return np.asarray(probabilities), extra
+
+    def _run(self):
+        while True:
+            batch, rows = self._collect()
+            started = time.perf_counter()
+            try:
+                probabilities, extra = self._predict(np.vstack([item[0] for item in batch]))
+            except Exception as e:
+                logger.error(f"Batch scoring failed for {rows} rows: {str(e)}", exc_info=True)
+                if len(batch) > 1:
+                    # Score the requests one by one so only the one that broke the batch fails
+                    for item in batch:
+                        self._run_alone(item)
+                    continue
+                with self._lock:
+                    self._totals['errors'] += 1
+                batch[0][2].set_exception(e)
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            offset = 0
+            with self._lock:
+                self._totals['batches'] += 1
+                self._totals['requests'] += len(batch)
+                self._totals['rows'] += rows
+                self._batch_sizes.append(rows)
+                for X, enqueued_at, future in batch:
+                    wait_ms = (started - enqueued_at) * 1000
+                    self._queue_waits.append(wait_ms)
+                    future.set_result((probabilities[offset:offset + len(X)], {
+                        'batch_size': rows,
+                        'batch_requests': len(batch),
+                        'queue_wait_ms': round(wait_ms, 3),
+                        'predict_ms': round(elapsed_ms, 3),
+                        **extra,
+                    }))
+                    offset += len(X)
+
+    def _run_alone(self, item):
+        X, enqueued_at, future = item
+        started = time.perf_counter()
+        try:
+            probabilities, extra = self._predict(X)
+        except Exception as e:
+            with self._lock:
+                self._totals['errors'] += 1
+            future.set_exception(e)
+            return
+        wait_ms = (started - enqueued_at) * 1000
+        with self._lock:
+            self._totals['batches'] += 1
+            self._totals['requests'] += 1
+            self._totals['rows'] += len(X)
+            self._batch_sizes.append(len(X))
+            self._queue_waits.append(wait_ms)
+        future.set_result((probabilities, {
+            'batch_size': len(X),
+            'batch_requests': 1,
+            'queue_wait_ms': round(wait_ms, 3),
+            'predict_ms': round((time.perf_counter() - started) * 1000, 3),
+            **extra,
+        }))
+
+    def metrics(self):
+        with self._lock:
+            sizes = np.array(self._batch_sizes, dtype=float)
+            waits = np.array(self._queue_waits, dtype=float)
+            totals = dict(self._totals)
+
+        def describe(values):
+            if not len(values):
+                return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+            return {
+                'mean': round(float(values.mean()), 3),
+                'p50': round(float(np.percentile(values, 50)), 3),
+                'p95': round(float(np.percentile(values, 95)), 3),
+                'max': round(float(values.max()), 3),
+            }
+
+        return {
+            'window_ms': self.window * 1000,
+            'max_batch_size': self.max_batch_size,
+            'totals': totals,
+            'batch_size': describe(sizes),
+            'queue_wait_ms': describe(waits),
+        }
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+
+from . import segmentation, snapshots
+from .scoring import load_artifacts
+
+logger = logging.getLogger(__name__)
+
+# Highest key and latest modification per source table, from index endpoints, plus the
+# cumulative update/delete counters of the tables and card partitions for the writes those
+# cannot see, and the newest recorded change (engine/changelog.py), which the listener and
+# job workers bump after writes the watermarks miss, such as rescored loans. The counters
+# are flushed by other sessions about once a second.
+WATERMARK_QUERY = """
+SELECT (SELECT ROW(MAX(customer_id), MAX(updated_at))::text FROM customers),
+       (SELECT ROW(MAX(loan_id), MAX(updated_at))::text FROM loans),
+       (SELECT ROW(MAX(account_id), MAX(updated_at))::text FROM savings_accounts),
+       (SELECT MAX(transaction_id) FROM card_transactions),
+       (SELECT SUM(pg_stat_get_tuples_updated(relid) + pg_stat_get_tuples_deleted(relid))
+        FROM (SELECT unnest('{customers,loans,savings_accounts}'::regclass[])
+              UNION ALL SELECT relid FROM pg_partition_tree('card_transactions')) tables (relid)),
+       (SELECT MAX(id) FROM data_changes)
+"""
+
+_lock = threading.Lock()
+_version = {'value': None, 'checked_at': 0.0}
+stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'uncacheable': 0}
+
+
+def _segmentation_fingerprint():
+    # Cluster labels only change through a segmentation fit or an incremental assignment
+    try:
+        state = segmentation.load_model()
+    except FileNotFoundError:
+        return None
+    return [state['centroids'], state['assigned_since_fit'], state['cluster_counts_since_fit']]
+
+
+def data_version(force=False):
+    """Hash of the table watermarks, re-read at most every RESPONSE_CACHE_VERSION_TTL seconds.
+
+    Responses served from a snapshot are as of that snapshot, so they are keyed on its
+    name instead and Postgres is not consulted.
+    """
+    snapshot = snapshots.serving()
+    if snapshot is not None:
+        watermarks = ['snapshot', snapshot, _segmentation_fingerprint()]
+        return hashlib.sha1(json.dumps(watermarks, default=str).encode()).hexdigest()[:16]
+    with _lock:
+        fresh = time.monotonic() - _version['checked_at'] < settings.RESPONSE_CACHE_VERSION_TTL
+        if _version['value'] is not None and fresh and not force:
+            return _version['value']
+    with connection.cursor() as cursor:
+        cursor.execute(WATERMARK_QUERY)
+        watermarks = list(cursor.fetchone())
+    watermarks.append(_segmentation_fingerprint())
+    value = hashlib.sha1(json.dumps(watermarks, default=str).encode()).hexdigest()[:16]
+    with _lock:
+        _version['value'] = value
+        _version['checked_at'] = time.monotonic()
+    return value
+
+
+def model_version():
+    try:
+        return load_artifacts().version
+    except FileNotFoundError:
+        return 'none'
+
+
+def response_key(endpoint, request, force=False):
+    params = sorted((key, value) for key in request.GET for value in request.GET.getlist(key))
+    params_hash = hashlib.sha1(json.dumps(params).encode()).hexdigest()[:16]
+    key = f'engine:response:{endpoint}:{params_hash}:{data_version(force)}:{model_version()}'
+    return key, '"' + hashlib.sha1(key.encode()).hexdigest()[:32] + '"'
+
+
+def _etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    candidates = [tag.strip().removeprefix('W/') for tag in header.split(',')]
+    return '*' in candidates or etag in candidates
+
+
+def _cached(content, etag, cache_status):
+    response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    response['X-Cache'] = cache_status
+    return response
+
+
+def cached_response(endpoint):
+    """Cache a GET handler's JSON by (endpoint, query params, data version, model version).
+
+    The ETag is derived from the same key, so a client revalidating with If-None-Match
+    gets a 304 without the handler running at all while nothing underneath has changed.
+    """
+    def decorator(get):
+        @wraps(get)
+        def wrapper(self, request, *args, **kwargs):
+            # Direct calls such as populate_clusters pass a bare request object and get the raw Response
+            if not settings.RESPONSE_CACHE_ENABLED or not hasattr(request, 'GET') or request.method != 'GET':
+                return get(self, request, *args, **kwargs)
+            try:
+                key, etag = response_key(endpoint, request)
+            except Exception as e:
+                logger.warning(f"Response cache unavailable for {endpoint}: {str(e)}")
+                return get(self, request, *args, **kwargs)
+
+            if _etag_matches(request, etag):
+                stats['not_modified'] += 1
+                response = HttpResponse(status=304)
+                response['ETag'] = etag
+                return response
+
+            content = cache.get(key)
+            if content is not None:
+                stats['hits'] += 1
+                return _cached(content, etag, 'HIT')
+
+            stats['misses'] += 1
+            response = get(self, request, *args, **kwargs)
+            if response.status_code != 200 or response.streaming:
+                return response
+
+            content = JSONRenderer().render(response.data)
+            # The handler may itself have written (e.g. cluster labels), so key on the version after it ran
+            key, etag = response_key(endpoint, request, force=True)
+            if len(content) <= settings.RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                cache.set(key, content, settings.RESPONSE_CACHE_TIMEOUT)
+            else:
+                stats['uncacheable'] += 1
+            return _cached(content, etag, 'MISS')
+        return wrapper
+    return decorator
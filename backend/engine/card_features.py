@@ -0,0 +1,290 @@
+import datetime
+import logging
+import time
+
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import changes, locks, schema
+
+logger = logging.getLogger(__name__)
+
+# Trailing windows (days, ending on the as-of date inclusive) exposed as features
+WINDOWS = (30, 90, 365)
+WINDOW_COLUMNS = [f'{name}_{days}d' for days in WINDOWS for name in ('spend', 'txn_count', 'fx_share')]
+
+IS_PARTITIONED_QUERY = """
+SELECT EXISTS (
+    SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+    WHERE c.relname = 'card_transactions' AND c.relnamespace = 'public'::regnamespace
+)
+"""
+
+# Transactions since the rollup watermark less CARD_WATERMARK_LAG_IDS, as the (customer, day)
+# cells they touch; ids come from a sequence, so a lower id can commit after a higher one
+AFFECTED_DAYS_QUERY = """
+SELECT DISTINCT customer_id, transaction_date::date AS day
+FROM card_transactions
+WHERE transaction_id > %(after)s AND transaction_date IS NOT NULL
+"""
+
+# Recompute whole (customer, day) cells; the literal date bounds let the planner prune
+# every monthly partition outside [lo, hi)
+ROLLUP_UPSERT_QUERY = """
+INSERT INTO card_daily_rollups (customer_id, day, spend, txn_count, fx_spend, fx_count, last_transaction_id)
+SELECT t.customer_id, t.transaction_date::date,
+       COALESCE(SUM(t.transaction_value), 0)::float8,
+       COUNT(*),
+       COALESCE(SUM(t.transaction_value) FILTER (WHERE t.is_fx_transaction), 0)::float8,
+       COUNT(*) FILTER (WHERE t.is_fx_transaction),
+       MAX(t.transaction_id)
+FROM card_transactions t
+WHERE t.transaction_date >= %(lo)s AND t.transaction_date < %(hi)s
+  {cells}
+GROUP BY t.customer_id, t.transaction_date::date
+ON CONFLICT (customer_id, day) DO UPDATE SET
+    spend = EXCLUDED.spend,
+    txn_count = EXCLUDED.txn_count,
+    fx_spend = EXCLUDED.fx_spend,
+    fx_count = EXCLUDED.fx_count,
+    last_transaction_id = EXCLUDED.last_transaction_id
+"""
+
+AFFECTED_CELLS_FILTER = """
+  AND (t.customer_id, t.transaction_date::date) IN (
+      SELECT * FROM unnest(%(customer_ids)s::int[], %(days)s::date[])
+  )
+"""
+
+# Rebuilding given customers stops at the watermark; newer rows belong to the next incremental run
+CUSTOMER_CELLS_FILTER = """
+  AND t.customer_id = ANY(%(customer_ids)s) AND t.transaction_id <= %(through)s
+"""
+
+WINDOW_QUERY = """
+SELECT customer_id,
+       {aggregates}
+FROM card_daily_rollups
+WHERE day > CAST(:as_of AS date) - {longest} AND day <= CAST(:as_of AS date)
+  {customer_filter}
+GROUP BY customer_id
+"""
+
+
+def is_partitioned(cursor):
+    cursor.execute(IS_PARTITIONED_QUERY)
+    return cursor.fetchone()[0]
+
+
+def month_start(day):
+    return datetime.date(day.year, day.month, 1)
+
+
+def next_month(day):
+    return datetime.date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'card_transactions_{month:%Y_%m}'
+
+
+def ensure_partitions(cursor, first, last):
+    """Create the monthly partitions covering [first, last] that do not exist yet.
+
+    Rows already sitting in the default partition for a new month are moved into it, since
+    Postgres refuses to add a partition whose range overlaps rows in the default one.
+    """
+    created = []
+    month = month_start(first)
+    while month <= last:
+        name = partition_name(month)
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [f'public.{name}'])
+        if not cursor.fetchone()[0]:
+            bounds = f"FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')"
+            cursor.execute(f"CREATE TABLE {name} (LIKE card_transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+            cursor.execute(f"""
+                WITH moved AS (
+                    DELETE FROM card_transactions_default
+                    WHERE transaction_date >= %s AND transaction_date < %s
+                    RETURNING *
+                )
+                INSERT INTO {name} SELECT * FROM moved
+            """, [month, next_month(month)])
+            cursor.execute(f"ALTER TABLE card_transactions ATTACH PARTITION {name} FOR VALUES {bounds}")
+            created.append(name)
+        month = next_month(month)
+    return created
+
+
+def partition_table(months_ahead=3, keep_old=False):
+    """Convert card_transactions into a table range-partitioned by month of transaction_date.
+
+    Rows are copied into the new layout inside one transaction that holds an exclusive
+    lock on the old table, so writers wait rather than fail. Returns the partitions created.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        if is_partitioned(cursor):
+            cursor.execute("SELECT COALESCE(MIN(transaction_date), now()) FROM card_transactions")
+            first = cursor.fetchone()[0].date()
+            last = month_start(datetime.date.today())
+            for _ in range(months_ahead):
+                last = next_month(last)
+            return ensure_partitions(cursor, first, last)
+
+        cursor.execute("LOCK TABLE card_transactions IN ACCESS EXCLUSIVE MODE")
+        cursor.execute("ALTER TABLE card_transactions RENAME TO card_transactions_unpartitioned")
+        cursor.execute("ALTER TABLE card_transactions_unpartitioned RENAME CONSTRAINT card_transactions_pkey "
+                       "TO card_transactions_unpartitioned_pkey")
+        # The partition key has to be part of the primary key and cannot be NULL
+        cursor.execute("""
+            CREATE TABLE card_transactions (
+                transaction_id INTEGER NOT NULL DEFAULT nextval('card_transactions_transaction_id_seq'),
+                customer_id INTEGER NOT NULL REFERENCES customers(customer_id) ON DELETE RESTRICT,
+                transaction_value DECIMAL(12,2) CHECK (transaction_value >= 0),
+                category VARCHAR(50) NOT NULL,
+                is_fx_transaction BOOLEAN NOT NULL DEFAULT FALSE,
+                transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (transaction_id, transaction_date)
+            ) PARTITION BY RANGE (transaction_date)
+        """)
+        cursor.execute("ALTER SEQUENCE card_transactions_transaction_id_seq OWNED BY card_transactions.transaction_id")
+        cursor.execute("CREATE TABLE card_transactions_default PARTITION OF card_transactions DEFAULT")
+
+        cursor.execute("SELECT MIN(COALESCE(transaction_date, created_at, now())) FROM card_transactions_unpartitioned")
+        first = (cursor.fetchone()[0] or datetime.datetime.now()).date()
+        last = month_start(datetime.date.today())
+        for _ in range(months_ahead):
+            last = next_month(last)
+        created = ensure_partitions(cursor, first, last)
+
+        cursor.execute("""
+            INSERT INTO card_transactions
+            SELECT transaction_id, customer_id, transaction_value, category, is_fx_transaction,
+                   COALESCE(transaction_date, created_at, now()), created_at
+            FROM card_transactions_unpartitioned
+        """)
+        cursor.execute("CREATE INDEX card_transactions_customer_date_idx ON card_transactions (customer_id, transaction_date)")
+        # Triggers do not follow the rows into the new table
+        changes.install_triggers(cursor, ['card_transactions'])
+        if not keep_old:
+            cursor.execute("DROP TABLE card_transactions_unpartitioned")
+    return created
+
+
+def refresh_rollups(full=False):
+    """Bring card_daily_rollups up to date with card_transactions.
+
+    Incremental runs only recompute the (customer, day) cells touched by transactions newer
+    than the highest transaction already rolled up, less a CARD_WATERMARK_LAG_IDS margin for
+    transactions that committed late. Cells are recomputed whole, so re-reading the margin
+    is harmless. A full run (or the first one) rebuilds one month at a time. Returns the
+    number of rollup rows written.
+    """
+    started = time.perf_counter()
+    written = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        # A refresh already running on another node is waited for; its rows then move the
+        # watermark and this one only picks up what arrived since
+        locks.xact_lock(cursor, locks.CARD_ROLLUPS)
+        cursor.execute("SELECT COALESCE(MAX(last_transaction_id), 0) FROM card_daily_rollups")
+        after = cursor.fetchone()[0]
+        if full or not after:
+            cursor.execute("TRUNCATE card_daily_rollups")
+            cursor.execute("SELECT MIN(transaction_date), MAX(transaction_date) FROM card_transactions")
+            first, last = cursor.fetchone()
+            if first is None:
+                return 0
+            month = month_start(first.date())
+            while month <= last.date():
+                cursor.execute(ROLLUP_UPSERT_QUERY.format(cells=''), {'lo': month, 'hi': next_month(month)})
+                written += cursor.rowcount
+                month = next_month(month)
+        else:
+            cursor.execute(AFFECTED_DAYS_QUERY, {'after': max(after - settings.CARD_WATERMARK_LAG_IDS, 0)})
+            cells = cursor.fetchall()
+            if not cells:
+                return 0
+            days = [day for _, day in cells]
+            cursor.execute(ROLLUP_UPSERT_QUERY.format(cells=AFFECTED_CELLS_FILTER), {
+                'lo': min(days),
+                'hi': max(days) + datetime.timedelta(days=1),
+                'customer_ids': [customer_id for customer_id, _ in cells],
+                'days': days,
+            })
+            written = cursor.rowcount
+    logger.info(f"Refreshed {written} card rollup rows in {time.perf_counter() - started:.3f}s")
+    return written
+
+
+def refresh_customer_rollups(customer_ids):
+    """Rebuild every rollup row of the given customers.
+
+    Used when their existing transactions were updated or deleted, which the transaction_id
+    watermark of refresh_rollups cannot see. Returns the number of rollup rows written.
+    """
+    customer_ids = sorted(set(int(i) for i in customer_ids))
+    if not customer_ids:
+        return 0
+    started = time.perf_counter()
+    with transaction.atomic(), connection.cursor() as cursor:
+        # A refresh already running on another node is waited for; its rows then move the
+        # watermark and this one only picks up what arrived since
+        locks.xact_lock(cursor, locks.CARD_ROLLUPS)
+        cursor.execute("SELECT COALESCE(MAX(last_transaction_id), 0) FROM card_daily_rollups")
+        through = cursor.fetchone()[0]
+        if not through:
+            return refresh_rollups(full=True)
+        cursor.execute("DELETE FROM card_daily_rollups WHERE customer_id = ANY(%s)", [customer_ids])
+        cursor.execute("SELECT MIN(transaction_date), MAX(transaction_date) FROM card_transactions "
+                       "WHERE customer_id = ANY(%s)", [customer_ids])
+        first, last = cursor.fetchone()
+        if first is None:
+            return 0
+        cursor.execute(ROLLUP_UPSERT_QUERY.format(cells=CUSTOMER_CELLS_FILTER), {
+            'lo': first.date(),
+            'hi': last.date() + datetime.timedelta(days=1),
+            'customer_ids': customer_ids,
+            'through': through,
+        })
+        written = cursor.rowcount
+    logger.info(f"Rebuilt {written} card rollup rows for {len(customer_ids)} customers "
+                f"in {time.perf_counter() - started:.3f}s")
+    return written
+
+
+def as_of_date():
+    """The date windows end on: CARD_FEATURES_AS_OF when set (for historical data), else today."""
+    if settings.CARD_FEATURES_AS_OF:
+        return datetime.date.fromisoformat(settings.CARD_FEATURES_AS_OF)
+    return datetime.date.today()
+
+
+def window_features(as_of=None, customer_ids=None):
+    """Trailing-window spend, transaction count and FX share per customer from the daily rollups.
+
+    Customers without transactions in the longest window are absent from the result.
+    """
+    as_of = as_of or as_of_date()
+    aggregates = []
+    for days in WINDOWS:
+        in_window = f"day > CAST(:as_of AS date) - {days}"
+        aggregates += [
+            f"COALESCE(SUM(spend) FILTER (WHERE {in_window}), 0)::float8 AS spend_{days}d",
+            f"COALESCE(SUM(txn_count) FILTER (WHERE {in_window}), 0)::int AS txn_count_{days}d",
+            f"COALESCE(SUM(fx_spend) FILTER (WHERE {in_window}) / NULLIF(SUM(spend) FILTER (WHERE {in_window}), 0), 0)::float8"
+            f" AS fx_share_{days}d",
+        ]
+    query = WINDOW_QUERY.format(
+        aggregates=',\n       '.join(aggregates),
+        longest=max(WINDOWS),
+        customer_filter='AND customer_id = ANY(:customer_ids)' if customer_ids is not None else '',
+    )
+    params = {'as_of': as_of}
+    if customer_ids is not None:
+        customer_ids = [int(i) for i in customer_ids]
+        if not customer_ids:
+            return pd.DataFrame(columns=['customer_id'] + WINDOW_COLUMNS)
+        params['customer_ids'] = customer_ids
+    return schema.read_columns(query, params)
@@ -0,0 +1,68 @@
+"""Changes to derived data recorded in Postgres for processes in other containers.
+
+The change listener and the job workers cannot reach the API workers' response cache or
+their shared-memory feature store, so they record what they changed in data_changes.
+The newest id is part of the response cache's data version, and the feature store's
+refresher applies the card rewrites and cluster moves recorded past its watermark.
+"""
+import json
+import logging
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_QUERY = """
+INSERT INTO data_changes (changed_at, source, card_rewrites, clusters)
+VALUES (now(), %s, %s, %s)
+RETURNING id
+"""
+
+# Old rows go, but never the newest, which carries the current generation
+PRUNE_QUERY = """
+DELETE FROM data_changes
+WHERE changed_at < now() - %s * INTERVAL '1 hour'
+  AND id < (SELECT MAX(id) FROM data_changes)
+"""
+
+SINCE_QUERY = """
+SELECT id, card_rewrites, clusters FROM data_changes WHERE id > %s ORDER BY id
+"""
+
+
+def _ids(customer_ids):
+    return None if customer_ids is None else json.dumps(sorted(int(i) for i in customer_ids))
+
+
+def publish(source, card_rewrites=(), clusters=()):
+    """Record a change and return its id; None for a customer list means every customer."""
+    with connection.cursor() as cursor:
+        cursor.execute(PUBLISH_QUERY, [source, _ids(card_rewrites), _ids(clusters)])
+        change_id = cursor.fetchone()[0]
+        cursor.execute(PRUNE_QUERY, [settings.CHANGE_LOG_RETENTION_HOURS])
+    return change_id
+
+
+def latest():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX(id) FROM data_changes")
+        return cursor.fetchone()[0] or 0
+
+
+def since(after):
+    """Merge the changes after id ``after``: (newest id, card rewrites, cluster moves).
+
+    The customer sets are None when some change affected every customer.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(SINCE_QUERY, [after])
+        rows = cursor.fetchall()
+    card_rewrites, clusters = set(), set()
+    for _, card_ids, cluster_ids in rows:
+        # Django's cursor hands jsonb back as text
+        card_ids = json.loads(card_ids) if isinstance(card_ids, str) else card_ids
+        cluster_ids = json.loads(cluster_ids) if isinstance(cluster_ids, str) else cluster_ids
+        card_rewrites = None if card_rewrites is None or card_ids is None else card_rewrites | set(card_ids)
+        clusters = None if clusters is None or cluster_ids is None else clusters | set(cluster_ids)
+    return (rows[-1][0] if rows else after), card_rewrites, clusters
@@ -0,0 +1,281 @@
+import json
+import logging
+import select
+import time
+from collections import defaultdict
+
+import psycopg2
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from . import aggregates, card_features, changelog, fees, schema, segmentation
+from .db import database_url
+from .scoring import iter_scored, load_artifacts
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'engine_changes'
+
+# Watched tables and the columns whose updates change nothing derived from them. Cluster
+# labels are written by segmentation itself, so ignoring them also keeps the listener from
+# waking itself up.
+WATCHED_TABLES = {
+    'customers': ['cluster', 'updated_at'],
+    'loans': ['updated_at'],
+    'savings_accounts': ['updated_at'],
+    'card_transactions': [],
+}
+
+# NOTIFY payloads are limited to 8000 bytes; bigger statements just say "many customers"
+MAX_NOTIFY_IDS = 1000
+
+# One notification per statement with the distinct customers it touched. Updates that only
+# rewrite ignored columns (or nothing at all) are not published.
+NOTIFY_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION engine_notify_change() RETURNS trigger AS $$
+DECLARE
+    ignored text[] := COALESCE(TG_ARGV, '{{}}');
+    ids int[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT customer_id) INTO ids FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT customer_id) INTO ids FROM old_rows;
+    ELSE
+        SELECT array_agg(DISTINCT customer_id) INTO ids FROM (
+            (SELECT customer_id, to_jsonb(n) - ignored FROM new_rows n
+             EXCEPT SELECT customer_id, to_jsonb(o) - ignored FROM old_rows o)
+            UNION ALL
+            (SELECT customer_id, to_jsonb(o) - ignored FROM old_rows o
+             EXCEPT SELECT customer_id, to_jsonb(n) - ignored FROM new_rows n)
+        ) changed;
+    END IF;
+    IF ids IS NOT NULL THEN
+        PERFORM pg_notify('{CHANNEL}', json_build_object(
+            'table', TG_TABLE_NAME,
+            'op', TG_OP,
+            'customer_ids', CASE WHEN cardinality(ids) <= {MAX_NOTIFY_IDS} THEN ids END
+        )::text);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+TRIGGER_EVENTS = {
+    'INSERT': 'REFERENCING NEW TABLE AS new_rows',
+    'UPDATE': 'REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows',
+    'DELETE': 'REFERENCING OLD TABLE AS old_rows',
+}
+
+# Loan scores whose loan no longer exists
+STALE_SCORES_QUERY = """
+DELETE FROM loan_scores s
+WHERE NOT EXISTS (SELECT 1 FROM loans l WHERE l.loan_id = s.loan_id)
+  {customer_filter}
+"""
+
+
+def install_triggers(cursor, tables=None):
+    """(Re)create the notify function and the statement-level triggers on the watched tables."""
+    cursor.execute(NOTIFY_FUNCTION)
+    for table in tables or WATCHED_TABLES:
+        arguments = ', '.join(f"'{column}'" for column in WATCHED_TABLES[table])
+        for event, referencing in TRIGGER_EVENTS.items():
+            name = f'{table}_notify_{event.lower()}'
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name} ON {table}")
+            cursor.execute(f"CREATE TRIGGER {name} AFTER {event} ON {table} {referencing} "
+                           f"FOR EACH STATEMENT EXECUTE FUNCTION engine_notify_change({arguments})")
+
+
+def drop_triggers(cursor):
+    for table in WATCHED_TABLES:
+        for event in TRIGGER_EVENTS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_notify_{event.lower()} ON {table}")
+    cursor.execute("DROP FUNCTION IF EXISTS engine_notify_change()")
+
+
+class ChangeBatch:
+    """Notifications collected between two recomputations, merged per table."""
+
+    def __init__(self):
+        self.events = 0
+        self.customer_ids = defaultdict(set)
+        self.everyone = set()  # tables with a statement too big to list its customers
+        self.card_inserts = False
+        self.card_rewrites = set()  # customers whose existing transactions changed
+        self.card_rewrites_everyone = False
+
+    def __bool__(self):
+        return self.events > 0
+
+    def add(self, payload):
+        try:
+            event = json.loads(payload)
+            table, op, ids = event['table'], event['op'], event['customer_ids']
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Ignoring malformed change notification: {payload[:200]}")
+            return
+        self.events += 1
+        if ids is None:
+            self.everyone.add(table)
+        else:
+            self.customer_ids[table].update(ids)
+        if table == 'card_transactions':
+            if op == 'INSERT':
+                self.card_inserts = True
+            elif ids is None:
+                self.card_rewrites_everyone = True
+            else:
+                self.card_rewrites.update(ids)
+
+    @property
+    def affected(self):
+        """Customer ids whose derived data is stale, or None for all customers."""
+        if self.everyone:
+            return None
+        return set().union(*self.customer_ids.values())
+
+
+def rescore_chunks(customer_ids=None, keep=('loan_id', 'customer_id')):
+    """Re-score the loans of the given customers (every loan for None), persisting and then
+    yielding each scored chunk with its ``keep`` columns.
+
+    Scores of loans that were deleted are dropped once every chunk is scored.
+    """
+    artifacts = load_artifacts()
+    if customer_ids is None:
+        query, params, customer_filter = fees.LOAN_QUERY.format(where=''), None, ''
+    else:
+        query = fees.LOAN_QUERY.format(where='WHERE l.customer_id = ANY(:ids)')
+        params = {'ids': sorted(int(i) for i in customer_ids)}
+        customer_filter = 'AND s.customer_id = ANY(%(ids)s)'
+    frames = schema.iter_frames(query, params, rows=schema.chunk_rows(query, params))
+    keep = list(dict.fromkeys(['loan_id', 'customer_id', *keep]))
+    for scored in iter_scored(frames, artifacts, keep=keep):
+        aggregates.persist_scores(scored['loan_id'], scored['customer_id'], scored['default_probability'],
+                                  scored['risk_category'], artifacts.version)
+        yield scored
+    with connection.cursor() as cursor:
+        cursor.execute(STALE_SCORES_QUERY.format(customer_filter=customer_filter), params)
+
+
+def rescore(customer_ids=None):
+    """Re-score and persist the loans of the given customers (every loan for None).
+
+    Returns the number of loans scored.
+    """
+    return sum(len(scored) for scored in rescore_chunks(customer_ids))
+
+
+def reassign(customer_ids=None):
+    """Move the given customers (every customer for None) to their nearest centroid."""
+    if customer_ids is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT customer_id FROM customers")
+            customer_ids = [row[0] for row in cursor.fetchall()]
+    if not customer_ids:
+        return 0
+    return segmentation.assign(customer_ids)['assigned']
+
+
+def _step(result, name, function, *args):
+    # One failing consumer should not keep the others from catching up
+    try:
+        result[name] = function(*args)
+    except FileNotFoundError as e:
+        logger.info(f"Skipping {name}: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error updating {name} after changes: {str(e)}", exc_info=True)
+        result.setdefault('errors', []).append(name)
+
+
+def apply_changes(batch):
+    """Bring everything derived from the watched tables up to date with one batch."""
+    started = time.perf_counter()
+    close_old_connections()
+    affected = batch.affected
+    result = {'events': batch.events, 'customers': 'all' if affected is None else len(affected)}
+
+    if batch.card_inserts:
+        _step(result, 'rollups', card_features.refresh_rollups)
+    if batch.card_rewrites_everyone:
+        _step(result, 'rollups_rebuilt', card_features.refresh_rollups, True)
+    elif batch.card_rewrites:
+        _step(result, 'rollups_rebuilt', card_features.refresh_customer_rollups, batch.card_rewrites)
+
+    # Retire cached responses in the API workers now, and have their feature store
+    # recompute the card totals the rewrites changed
+    changelog.publish('listener', card_rewrites=None if batch.card_rewrites_everyone else batch.card_rewrites)
+    _step(result, 'rescored', rescore, affected)
+    _step(result, 'reassigned', reassign, affected)
+
+    # Rescoring wrote too; retire anything cached while it ran
+    changelog.publish('listener')
+    result['duration_seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def catch_up():
+    """Apply whatever changed while nobody was listening, as far as the watermarks can tell."""
+    started = time.perf_counter()
+    close_old_connections()
+    result = {'events': 0, 'customers': 'changed'}
+    _step(result, 'rollups', card_features.refresh_rollups)
+    try:
+        stale = not aggregates.scores_current(load_artifacts().version)
+    except FileNotFoundError:
+        stale = False
+    if stale:
+        _step(result, 'rescored', rescore)
+    # New customers and customers/savings updated since the last assignment
+    _step(result, 'reassigned', lambda: segmentation.assign()['assigned'])
+    changelog.publish('listener')
+    result['duration_seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def listen(on_batch=None, debounce=None, max_delay=None, catch_up_first=True):
+    """LISTEN for change notifications and apply them in batches until interrupted.
+
+    Notifications are collected until none arrived for ``debounce`` seconds (or the oldest
+    is ``max_delay`` seconds old), so a burst of writes is recomputed once. The connection
+    is re-established after errors, catching up on changes missed in between.
+    """
+    debounce = settings.CHANGE_FEED_DEBOUNCE_SECONDS if debounce is None else debounce
+    max_delay = settings.CHANGE_FEED_MAX_DELAY_SECONDS if max_delay is None else max_delay
+    on_batch = on_batch or (lambda result: logger.info(f"Applied changes: {result}"))
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(database_url())
+            conn.autocommit = True
+            conn.cursor().execute(f'LISTEN {CHANNEL}')
+            logger.info(f"Listening for changes on {CHANNEL}")
+            if catch_up_first:
+                on_batch(catch_up())
+            catch_up_first = True
+
+            batch, first_at, last_at = ChangeBatch(), None, None
+            while True:
+                if batch:
+                    now = time.monotonic()
+                    timeout = max(0.0, min(last_at + debounce, first_at + max_delay) - now)
+                else:
+                    timeout = 60.0
+                if select.select([conn], [], [], timeout)[0]:
+                    conn.poll()
+                    while conn.notifies:
+                        batch.add(conn.notifies.pop(0).payload)
+                        last_at = time.monotonic()
+                        first_at = first_at or last_at
+                    continue
+                if batch:
+                    on_batch(apply_changes(batch))
+                    batch, first_at, last_at = ChangeBatch(), None, None
+        except psycopg2.Error as e:
+            logger.error(f"Change listener connection failed, reconnecting: {str(e)}")
+            time.sleep(settings.CHANGE_FEED_RECONNECT_SECONDS)
+        finally:
+            if conn is not None:
+                conn.close()
@@ -0,0 +1,229 @@
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+from django.conf import settings
+
+from . import snapshots
+from .db import database_url
+
+try:
+    import duckdb
+except ImportError:  # optional: ANALYTICS_ENGINE=duckdb needs it
+    duckdb = None
+
+logger = logging.getLogger(__name__)
+
+# Snapshot datasets backing each base relation when reading from the Arrow snapshot
+SNAPSHOT_RELATIONS = {
+    'customers': 'customers_table',
+    'savings_accounts': 'refit_savings',
+    'loans': 'loans_table',
+    'card_totals': 'refit_cards',
+}
+
+# The same relations over the attached database; card totals are aggregated by the scan
+POSTGRES_RELATIONS = {
+    'customers': 'SELECT customer_id, age, income, credit_score, is_diaspora, segment, cluster FROM pg.public.customers',
+    'savings_accounts': 'SELECT customer_id, savings_balance, activity_score FROM pg.public.savings_accounts',
+    'loans': """SELECT loan_id, customer_id, loan_amount, loan_tenure_months,
+                       interest_rate::DOUBLE AS interest_rate, loan_default FROM pg.public.loans""",
+    'card_totals': """SELECT customer_id, SUM(transaction_value)::DOUBLE AS total_card_value,
+                             COUNT(transaction_id) AS transaction_count
+                      FROM pg.public.card_transactions GROUP BY customer_id""",
+}
+
+# Feature joins of the registered snapshot datasets, with the card subqueries as one
+# hash join against card_totals
+QUERIES = {
+    'loans': """
+SELECT l.loan_id, l.customer_id, l.loan_amount, l.interest_rate::DOUBLE AS interest_rate, l.loan_tenure_months,
+       c.income, c.credit_score, c.cluster, s.activity_score,
+       c.is_diaspora, c.age, c.segment,
+       COALESCE(ct.total_card_value, 0)::DOUBLE AS total_card_value
+FROM loans l
+JOIN customers c ON l.customer_id = c.customer_id
+LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
+LEFT JOIN card_totals ct ON ct.customer_id = c.customer_id
+ORDER BY l.loan_id
+""",
+    'customers': """
+SELECT c.customer_id, c.income, c.credit_score, c.is_diaspora, c.cluster,
+       COALESCE(s.savings_balance, 0) AS savings_balance,
+       COALESCE(s.activity_score, 0) AS activity_score,
+       COALESCE(ct.total_card_value, 0)::DOUBLE AS total_card_value
+FROM customers c
+LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
+LEFT JOIN card_totals ct ON ct.customer_id = c.customer_id
+ORDER BY c.customer_id
+""",
+}
+
+# CustomerSegmentationView's four refit reads and their merges as one query
+REFIT_QUERY = """
+SELECT c.customer_id, c.income, c.credit_score, c.is_diaspora,
+       s.savings_balance, s.activity_score,
+       ct.total_card_value, ct.transaction_count,
+       l.total_loan_amount, l.avg_interest_rate
+FROM customers c
+LEFT JOIN savings_accounts s ON s.customer_id = c.customer_id
+LEFT JOIN card_totals ct ON ct.customer_id = c.customer_id
+LEFT JOIN (
+    SELECT customer_id, SUM(loan_amount)::DOUBLE AS total_loan_amount,
+           (SUM(interest_rate) / COUNT(loan_id))::DOUBLE AS avg_interest_rate
+    FROM loans GROUP BY customer_id
+) l ON l.customer_id = c.customer_id
+ORDER BY c.customer_id
+"""
+
+AGGREGATES = {'mean': 'avg', 'sum': 'sum', 'count': 'count'}
+
+_lock = threading.Lock()
+_database = {'pid': None, 'connection': None, 'attached': False, 'attach_error': None}
+
+
+class ColumnarUnavailable(Exception):
+    """The engine cannot reach its data (missing DuckDB, extension or snapshot)."""
+
+
+def enabled():
+    if settings.ANALYTICS_ENGINE != 'duckdb':
+        return False
+    if duckdb is None:
+        logger.warning("ANALYTICS_ENGINE=duckdb but duckdb is not installed; using pandas")
+        return False
+    return True
+
+
+def _connection():
+    """Cursor on the process's in-memory DuckDB database.
+
+    Each call gets its own cursor, so a streamed result is not cut short by another
+    query; a forked worker opens its own database instead of using the parent's.
+    """
+    with _lock:
+        if _database['pid'] != os.getpid():
+            connection = duckdb.connect(':memory:')
+            connection.execute(f"SET threads = {int(settings.COLUMNAR_THREADS)}")
+            _database.update(pid=os.getpid(), connection=connection, attached=False, attach_error=None)
+        return _database['connection'].cursor()
+
+
+def _attach_postgres():
+    with _lock:
+        if _database['attached']:
+            return
+        # Not retried: a failed attach (usually the extension download) would fail again
+        if _database['attach_error']:
+            raise ColumnarUnavailable(_database['attach_error'])
+        connection = _database['connection']
+        try:
+            try:
+                connection.execute("LOAD postgres")
+            except duckdb.Error:
+                connection.execute("INSTALL postgres")
+                connection.execute("LOAD postgres")
+            connection.execute(f"ATTACH '{database_url()}' AS pg (TYPE postgres, READ_ONLY)")
+        except duckdb.Error as e:
+            _database['attach_error'] = f'DuckDB cannot attach the database: {str(e).splitlines()[0]}'
+            raise ColumnarUnavailable(_database['attach_error'])
+        _database['attached'] = True
+
+
+def _bind_relations(cursor):
+    """Define the base relations on ``cursor`` over the snapshot or the attached database."""
+    if snapshots.active_source() == 'snapshot':
+        for relation, dataset in SNAPSHOT_RELATIONS.items():
+            mapped = snapshots.mapped_dataset(dataset)
+            if mapped is None:
+                raise ColumnarUnavailable(f'snapshot has no {dataset} dataset')
+            # Scans the memory-mapped Arrow buffers in place
+            cursor.register(relation, mapped)
+        return
+    _attach_postgres()
+    for relation, sql in POSTGRES_RELATIONS.items():
+        cursor.execute(f"CREATE OR REPLACE TEMP VIEW {relation} AS {sql}")
+
+
+def execute(sql, rows=None):
+    """Run ``sql`` over the base relations and return a RecordBatchReader of ``rows``-row batches."""
+    started = time.perf_counter()
+    cursor = _connection()
+    _bind_relations(cursor)
+    reader = cursor.execute(sql).fetch_record_batch(rows or settings.ANALYTICS_CHUNK_ROWS)
+    logger.debug(f"DuckDB query ready in {time.perf_counter() - started:.3f}s")
+    return reader
+
+
+def _query(sql, params):
+    if params or not enabled():
+        return None
+    return QUERIES.get(snapshots.dataset_name(sql))
+
+
+def frames(sql, params=None, rows=None):
+    """DataFrames of the DuckDB version of a registered query, or None to use the other readers."""
+    query = _query(sql, params)
+    if query is None:
+        return None
+    try:
+        reader = execute(query, rows)
+    except ColumnarUnavailable as e:
+        logger.warning(f"{str(e)}; reading without DuckDB")
+        return None
+    return (batch.to_pandas() for batch in reader)
+
+
+def frame(sql, params=None):
+    batches = frames(sql, params)
+    if batches is None:
+        return None
+    parts = list(batches)
+    if not parts:
+        return pd.DataFrame()
+    return parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True, copy=False)
+
+
+def refit_inputs():
+    """The merged segmentation refit inputs from one DuckDB query, or None when disabled."""
+    if not enabled():
+        return None
+    try:
+        return execute(REFIT_QUERY).read_all().to_pandas()
+    except ColumnarUnavailable as e:
+        logger.warning(f"{str(e)}; merging the refit inputs in pandas")
+        return None
+
+
+def group_agg(data, by, aggregations):
+    """``data.groupby(by).agg(aggregations)``, run by DuckDB over the frame when enabled.
+
+    Aggregations are 'mean', 'sum' or 'count' per column; like pandas, missing values
+    and missing group keys are skipped.
+    """
+    if not enabled() or data.empty:
+        return data.groupby(by).agg(aggregations)
+    columns = []
+    for column, how in aggregations.items():
+        value = f'"{column}"'
+        if how != 'count' and data[column].dtype == bool:
+            # pandas sums and averages booleans as integers
+            value = f'{value}::BIGINT'
+        if how == 'sum':
+            # ... gives 0 for a group with no values, and keeps integer sums integral
+            expression = f'COALESCE(sum({value}), 0)'
+            if data[column].dtype.kind in 'biu':
+                expression = f'{expression}::BIGINT'
+        else:
+            expression = f'{AGGREGATES[how]}({value})'
+        columns.append(f'{expression} AS "{column}"')
+    cursor = _connection()
+    # Scans the frame's NumPy columns in place
+    cursor.register('summary_input', data)
+    result = cursor.execute(
+        f'SELECT "{by}", {", ".join(columns)} FROM summary_input WHERE "{by}" IS NOT NULL '
+        f'GROUP BY "{by}" ORDER BY "{by}"'
+    ).fetch_arrow_table().to_pandas()
+    return result.set_index(by)
@@ -0,0 +1,52 @@
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
+
+_lock = threading.Lock()
+_engines = {}
+
+
+def database_url():
+    """libpq / SQLAlchemy URL of Django's default database.
+
+    Built from settings.DATABASES (which DATABASE_URL configures) at call time, so the raw
+    psycopg2, SQLAlchemy and DuckDB connections reach the same database as the ORM,
+    including the test database while tests run.
+    """
+    database = settings.DATABASES['default']
+    if database['ENGINE'] != 'django.db.backends.postgresql':
+        raise ImproperlyConfigured('The analytics engine needs PostgreSQL; set DATABASE_URL')
+    host = database.get('HOST') or None
+    query = {}
+    if host and host.startswith('/'):
+        # A Unix socket directory goes in the query string, as libpq expects
+        host, query = None, {'host': database['HOST']}
+    return URL.create(
+        'postgresql',
+        username=database.get('USER') or None,
+        password=database.get('PASSWORD') or None,
+        host=host,
+        port=int(database['PORT']) if database.get('PORT') else None,
+        database=database['NAME'],
+        query=query,
+    ).render_as_string(hide_password=False)
+
+
+def get_engine():
+    """Shared SQLAlchemy engine for pandas reads, one per database URL."""
+    url = database_url()
+    with _lock:
+        if url not in _engines:
+            _engines[url] = create_engine(url, pool_pre_ping=True)
+        return _engines[url]
+
+
+def dispose(close=True):
+    """Drop pooled connections, e.g. around a fork (``close=False`` in the child)."""
+    with _lock:
+        engines = list(_engines.values())
+    for engine in engines:
+        engine.dispose(close=close)
@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+REFERENCE_FILE = 'feature_reference.json'
+# Smallest bin share used in PSI, so empty bins on either side stay finite
+PSI_FLOOR = 1e-4
+
+FLUSH_QUERY = """
+INSERT INTO feature_drift_counts (model_version, source, day, feature, bin, count)
+SELECT %s, %s, %s, u.feature, u.bin, u.count
+FROM unnest(%s::text[], %s::int[], %s::bigint[]) AS u(feature, bin, count)
+ON CONFLICT (model_version, source, day, feature, bin) DO UPDATE SET
+    count = feature_drift_counts.count + EXCLUDED.count
+"""
+
+WINDOW_QUERY = """
+SELECT source, feature, bin, SUM(count)
+FROM feature_drift_counts
+WHERE model_version = %s AND day > CURRENT_DATE - %s
+GROUP BY source, feature, bin
+"""
+
+_lock = threading.Lock()
+_reference = None
+
+
+class Reference:
+    """Training-time histogram of each model feature, as written by train_model.py.
+
+    A feature's bins are split at its ``cuts``: bin 0 holds values below the first cut and
+    bin i values in [cuts[i-1], cuts[i]), so every live value lands in some bin.
+    """
+
+    def __init__(self, data, stamp):
+        self.stamp = stamp
+        self.created_at = data.get('created_at')
+        self.n = data['n']
+        self.features = list(data['features'])
+        self.cuts = [np.asarray(data['features'][f]['cuts'], dtype=float) for f in self.features]
+        self.counts = [np.asarray(data['features'][f]['counts'], dtype=float) for f in self.features]
+        self.width = max(len(cuts) + 1 for cuts in self.cuts)
+
+    def histogram(self, X):
+        """Bin counts (features x width) of an unscaled feature matrix in reference order."""
+        X = np.asarray(X, dtype=float)
+        counts = np.zeros((len(self.features), self.width), dtype=np.int64)
+        for i, cuts in enumerate(self.cuts):
+            column = X[:, i]
+            column = column[~np.isnan(column)]
+            counts[i, :len(cuts) + 1] = np.bincount(np.searchsorted(cuts, column, side='right'),
+                                                    minlength=len(cuts) + 1)
+        return counts
+
+
+def reference_path():
+    return os.path.join(settings.MODELS_DIR, REFERENCE_FILE)
+
+
+def load_reference():
+    """The process-wide reference histograms, reloaded when the file changes; None if missing."""
+    global _reference
+    path = reference_path()
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        if _reference is None or _reference.stamp != stamp:
+            with open(path) as f:
+                _reference = Reference(json.load(f), stamp)
+            logger.info(f"Loaded feature reference histograms from {path}")
+        return _reference
+
+
+def psi(expected, actual):
+    """Population stability index of ``actual`` bin counts against ``expected``."""
+    p = np.clip(expected / expected.sum(), PSI_FLOOR, None)
+    q = np.clip(actual / actual.sum(), PSI_FLOOR, None)
+    return float(np.sum((q - p) * np.log(q / p)))
+
+
+def ks(expected, actual):
+    """Kolmogorov-Smirnov distance between the two binned distributions (largest CDF gap)."""
+    return float(np.max(np.abs(np.cumsum(expected) / expected.sum() - np.cumsum(actual) / actual.sum())))
+
+
+class DriftMonitor:
+    """Per-process streaming histograms of the scored feature rows.
+
+    Recording is one searchsorted/bincount per feature on the batch. Counts are plain
+    sums, so processes merge them by adding into feature_drift_counts (per model
+    version, source and day), at most every DRIFT_FLUSH_SECONDS or when asked to.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed_at = time.monotonic()
+
+    def record(self, X, model_version, source, flush=False):
+        """Add a batch of unscaled FEATURES rows; never lets a monitoring failure reach the caller."""
+        try:
+            reference = load_reference()
+            if reference is None or not len(X):
+                return
+            counts = reference.histogram(X)
+            key = (model_version, source, date.today())
+            with self._lock:
+                current = self._pending.get(key)
+                # A reference written with different bins starts the pending counts over
+                if current is not None and current.shape == counts.shape:
+                    current += counts
+                else:
+                    self._pending[key] = counts
+                due = flush or time.monotonic() - self._flushed_at >= settings.DRIFT_FLUSH_SECONDS
+            if due:
+                self.flush()
+        except Exception as e:
+            logger.warning(f"Feature drift recording failed: {str(e)}")
+
+    def flush(self):
+        """Write the counts gathered since the last flush."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+        reference = load_reference()
+        if not pending or reference is None:
+            return
+        try:
+            with connection.cursor() as cursor:
+                for (model_version, source, day), counts in pending.items():
+                    features, bins = np.nonzero(counts)
+                    cursor.execute(FLUSH_QUERY, [
+                        model_version, source, day,
+                        [reference.features[i] for i in features], bins.tolist(), counts[features, bins].tolist()
+                    ])
+        except Exception as e:
+            logger.warning(f"Could not write feature drift counts: {str(e)}")
+
+    def report(self, model_version, days=None, source=None):
+        """PSI and KS per feature for the last ``days`` days of scored rows against training.
+
+        Returns None when there is no reference to compare with.
+        """
+        reference = load_reference()
+        if reference is None:
+            return None
+        days = settings.DRIFT_WINDOW_DAYS if days is None else days
+        self.flush()
+        with connection.cursor() as cursor:
+            cursor.execute(WINDOW_QUERY, [model_version, days])
+            rows = cursor.fetchall()
+
+        position = {feature: i for i, feature in enumerate(reference.features)}
+        live = {}
+        for row_source, feature, bin_index, count in rows:
+            if (source and row_source != source) or feature not in position:
+                continue
+            counts = live.setdefault(row_source, np.zeros((len(reference.features), reference.width)))
+            if bin_index < reference.width:
+                counts[position[feature], bin_index] += float(count)
+
+        return {
+            'reference': {'created_at': reference.created_at, 'samples': reference.n},
+            'window_days': days,
+            'sources': {name: self._compare(reference, counts) for name, counts in sorted(live.items())},
+        }
+
+    def _compare(self, reference, live):
+        features = {}
+        samples = int(live[0].sum())
+        for i, feature in enumerate(reference.features):
+            expected = reference.counts[i]
+            actual = live[i, :len(expected)]
+            if not actual.sum():
+                continue
+            value = psi(expected, actual)
+            features[feature] = {
+                'psi': round(value, 4),
+                'ks': round(ks(expected, actual), 4),
+                'status': ('drift' if value >= settings.DRIFT_PSI_RETRAIN
+                           else 'moderate' if value >= settings.DRIFT_PSI_WARN else 'stable'),
+            }
+        drifted = sorted(f for f, v in features.items() if v['status'] == 'drift')
+        return {
+            'samples': samples,
+            'features': features,
+            'max_psi': max((v['psi'] for v in features.values()), default=0.0),
+            'drifted_features': drifted,
+            'retrain_recommended': bool(drifted) and samples >= settings.DRIFT_MIN_SAMPLES,
+        }
+
+
+# One monitor per process, shared by the scoring paths
+monitor = DriftMonitor()
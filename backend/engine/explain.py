@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import time
+
+import numpy as np
+from django.db import connection, transaction
+
+from . import fees, schema
+from .scoring import FEATURES, book_age_median, load_artifacts, prepare_loan_features, risk_category
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_LOANS = 'WHERE l.loan_id = ANY(:ids)'
+
+CACHED_QUERY = """
+SELECT loan_id, contributions_key, default_probability, risk_category, contributions
+FROM loan_scores
+WHERE loan_id = ANY(%s) AND model_version = %s AND contributions IS NOT NULL
+"""
+
+PAGE_QUERY = "SELECT loan_id FROM loans ORDER BY loan_id LIMIT %s OFFSET %s"
+
+
+def feature_key(row):
+    """Hash of one loan's raw model inputs, so cached contributions follow data changes."""
+    return hashlib.sha1(np.ascontiguousarray(row, dtype=np.float64).tobytes()).hexdigest()
+
+
+def contributions(artifacts, X):
+    """Per-feature log-odds contributions plus the bias column for a raw FEATURES matrix.
+
+    Tree models use the booster's native TreeSHAP (pred_contribs) in one batched call;
+    rows of the result sum to the model's margin.
+    """
+    X_scaled = artifacts.scaler.transform(X)
+    model = artifacts.model
+    if hasattr(model, 'get_booster'):
+        import xgboost
+
+        booster = model.get_booster()
+        matrix = xgboost.DMatrix(np.asarray(X_scaled, dtype=np.float32), feature_names=booster.feature_names)
+        return booster.predict(matrix, pred_contribs=True).astype(float)
+    if hasattr(model, 'coef_'):
+        # Linear models: coefficient times the scaled value, intercept as the bias
+        bias = np.full((len(X_scaled), 1), float(np.ravel(model.intercept_)[0]))
+        return np.hstack([np.asarray(X_scaled) * model.coef_[0], bias])
+    raise ValueError(f'{type(model).__name__} does not provide per-feature contributions')
+
+
+def page_loan_ids(page, page_size):
+    with connection.cursor() as cursor:
+        cursor.execute(PAGE_QUERY, [page_size, (page - 1) * page_size])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _cached(key_by_loan, model_version):
+    """Cached (probability, category, contributions) of the loans whose input hash still matches."""
+    with connection.cursor() as cursor:
+        cursor.execute(CACHED_QUERY, [list(key_by_loan), model_version])
+        rows = cursor.fetchall()
+    cached = {}
+    for loan_id, key, probability, category, values in rows:
+        if isinstance(values, str):
+            values = json.loads(values)
+        if key == key_by_loan.get(loan_id) and len(values) == len(FEATURES) + 1:
+            cached[loan_id] = (probability, category, values)
+    return cached
+
+
+def _store(rows, model_version):
+    """Upsert freshly computed scores and contributions in one statement."""
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO loan_scores (loan_id, customer_id, model_version, default_probability, risk_category,
+                                     scored_at, contributions, contributions_key)
+            SELECT u.loan_id, u.customer_id, %s, u.default_probability, u.risk_category, now(),
+                   u.contributions::jsonb, u.contributions_key
+            FROM unnest(%s::int[], %s::int[], %s::float8[], %s::text[], %s::text[], %s::text[])
+                 AS u(loan_id, customer_id, default_probability, risk_category, contributions, contributions_key)
+            ON CONFLICT (loan_id) DO UPDATE SET
+                customer_id = EXCLUDED.customer_id,
+                model_version = EXCLUDED.model_version,
+                default_probability = EXCLUDED.default_probability,
+                risk_category = EXCLUDED.risk_category,
+                scored_at = EXCLUDED.scored_at,
+                contributions = EXCLUDED.contributions,
+                contributions_key = EXCLUDED.contributions_key
+            """,
+            [model_version,
+             [r['loan_id'] for r in rows], [r['customer_id'] for r in rows],
+             [r['default_probability'] for r in rows], [r['risk_category'] for r in rows],
+             [json.dumps(r['contributions']) for r in rows], [r['key'] for r in rows]]
+        )
+
+
+def _drivers(values, raw, top_k):
+    order = np.argsort(-np.abs(values), kind='stable')[:top_k]
+    return [
+        {'feature': FEATURES[i], 'value': float(raw[i]), 'contribution': round(float(values[i]), 6)}
+        for i in order
+    ]
+
+
+def explain_loans(loan_ids, top_k=5):
+    """Score and explain the given loans, reusing cached contributions where still valid.
+
+    Returns (explanations in the requested order, unknown loan ids, metadata). Raises
+    FileNotFoundError when the risk model is missing.
+    """
+    started = time.perf_counter()
+    artifacts = load_artifacts()
+    loan_ids = list(dict.fromkeys(int(i) for i in loan_ids))
+    data = schema.read_frame(fees.LOAN_QUERY.format(where=EXPLAIN_LOANS), {'ids': loan_ids})
+    unknown = sorted(set(loan_ids) - set(data['loan_id'])) if not data.empty else loan_ids
+    if data.empty:
+        return [], unknown, {'model_version': artifacts.version, 'cached': 0, 'computed': 0}
+
+    data = prepare_loan_features(data, book_age_median())
+    X = data[FEATURES].astype(float)
+    raw = X.to_numpy()
+    key_by_loan = {int(loan_id): feature_key(row) for loan_id, row in zip(data['loan_id'], raw)}
+    cached = _cached(key_by_loan, artifacts.version)
+
+    misses = np.array([int(loan_id) not in cached for loan_id in data['loan_id']])
+    computed = {}
+    if misses.any():
+        missing = data[misses]
+        values = contributions(artifacts, X[misses])
+        probabilities = np.round(artifacts.predict_proba(raw[misses]).astype(float), 3)
+        categories = risk_category(probabilities)
+        rows = []
+        for i, (loan_id, customer_id) in enumerate(zip(missing['loan_id'].astype(int),
+                                                       missing['customer_id'].astype(int))):
+            rows.append({
+                'loan_id': int(loan_id), 'customer_id': int(customer_id),
+                'default_probability': float(probabilities[i]), 'risk_category': str(categories[i]),
+                'contributions': [float(v) for v in values[i]], 'key': key_by_loan[int(loan_id)],
+            })
+        _store(rows, artifacts.version)
+        computed = {row['loan_id']: (row['default_probability'], row['risk_category'], row['contributions'])
+                    for row in rows}
+
+    by_loan = {}
+    for position, (loan_id, customer_id) in enumerate(zip(data['loan_id'].astype(int), data['customer_id'].astype(int))):
+        probability, category, values = cached.get(loan_id) or computed[loan_id]
+        values = np.asarray(values, dtype=float)
+        by_loan[loan_id] = {
+            'loan_id': loan_id,
+            'customer_id': customer_id,
+            'default_probability': probability,
+            'risk_category': category,
+            'base_value': round(float(values[-1]), 6),
+            'drivers': _drivers(values[:-1], raw[position], top_k),
+        }
+
+    explanations = [by_loan[loan_id] for loan_id in loan_ids if loan_id in by_loan]
+    meta = {'model_version': artifacts.version, 'cached': len(cached), 'computed': len(computed)}
+    logger.info(f"Explained {len(explanations)} loans ({meta['cached']} cached, {meta['computed']} computed) "
+                f"in {time.perf_counter() - started:.3f}s")
+    return explanations, unknown, meta
@@ -0,0 +1,489 @@
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from . import card_features, changelog, schema
+from .schema import CURRENCIES, SEGMENTS
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = [
+    ('income', np.float64),
+    ('credit_score', np.float32),
+    ('age', np.float32),
+    ('segment', np.int8),
+    ('preferred_currency', np.int8),
+    ('is_diaspora', np.int8),
+    ('cluster', np.int16),
+    ('savings_balance', np.float64),
+    ('activity_score', np.float64),
+    ('total_card_value', np.float64),
+    ('transaction_count', np.int32),
+    # Trailing-window card features from card_features.window_features
+    ('spend_30d', np.float64),
+    ('txn_count_30d', np.int32),
+    ('fx_share_30d', np.float32),
+    ('spend_90d', np.float64),
+    ('txn_count_90d', np.int32),
+    ('fx_share_90d', np.float32),
+    ('spend_365d', np.float64),
+    ('txn_count_365d', np.int32),
+    ('fx_share_365d', np.float32),
+]
+
+# Categorical columns are stored as int8 codes into these tuples (-1 = unknown)
+CATEGORIES = {'segment': SEGMENTS, 'preferred_currency': CURRENCIES}
+
+# Header slots (int64)
+(MAGIC, GENERATION, N_ROWS, CAPACITY, INDEX_SIZE, WATERMARK, CARD_WATERMARK, RETIRED, WINDOW_DAY, BUILT_AT,
+ CHANGE_WATERMARK) = range(11)
+HEADER_SLOTS = 11
+MAGIC_VALUE = 0x52564D4653  # set once the segment is fully loaded
+
+CUSTOMER_QUERY = """
+SELECT c.customer_id, c.income, c.credit_score, c.age, c.segment, c.preferred_currency,
+       c.is_diaspora, c.cluster, s.savings_balance, s.activity_score,
+       (EXTRACT(EPOCH FROM GREATEST(c.updated_at, COALESCE(s.updated_at, c.updated_at))) * 1000000)::bigint AS changed_at
+FROM customers c
+LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
+"""
+
+CARD_QUERY = """
+SELECT customer_id, SUM(transaction_value)::float8 AS total_card_value,
+       COUNT(*) AS transaction_count, MAX(transaction_id) AS last_transaction_id
+FROM card_transactions
+WHERE transaction_id > :after
+GROUP BY customer_id
+"""
+
+# Exact totals for customers with new, late or rewritten transactions, up to the store's card
+# watermark so rows past it are left to the next refresh
+CARD_TOTALS_QUERY = """
+SELECT customer_id, SUM(transaction_value)::float8 AS total_card_value, COUNT(*) AS transaction_count
+FROM card_transactions
+WHERE customer_id = ANY(:ids) AND transaction_id <= :through
+GROUP BY customer_id
+"""
+
+CLUSTER_QUERY = "SELECT customer_id, cluster FROM customers"
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _layout(capacity, index_size):
+    offsets = {'ids': HEADER_SLOTS * 8}
+    offset = _align(offsets['ids'] + capacity * 4)
+    offsets['index'] = offset
+    offset = _align(offset + index_size * 4)
+    for name, dtype in COLUMNS:
+        offsets[name] = offset
+        offset = _align(offset + capacity * np.dtype(dtype).itemsize)
+    return offsets, offset
+
+
+def _untrack(shm):
+    # The resource tracker would unlink the segment when this process exits; the store
+    # outlives individual processes and is removed explicitly with unlink()
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+class CustomerFeatureStore:
+    """Column-oriented customer features in a named shared-memory segment.
+
+    Every column is a NumPy array over the same row order, and ``index`` maps a
+    customer_id straight to its row (-1 when absent), so a lookup is a couple of
+    array reads. A generation counter in the header is bumped before and after each
+    write (odd while writing) so readers can retry instead of seeing torn rows.
+    """
+
+    def __init__(self, shm):
+        self.shm = shm
+        self._write_lock = threading.Lock()
+        self._lock_path = os.path.join(tempfile.gettempdir(), f'{shm.name.lstrip("/")}.lock')
+        self.header = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=shm.buf)
+        capacity, index_size = int(self.header[CAPACITY]), int(self.header[INDEX_SIZE])
+        offsets, _ = _layout(capacity, index_size)
+        self.ids = np.ndarray((capacity,), dtype=np.int32, buffer=shm.buf, offset=offsets['ids'])
+        self.index = np.ndarray((index_size,), dtype=np.int32, buffer=shm.buf, offset=offsets['index'])
+        self.columns = {
+            name: np.ndarray((capacity,), dtype=dtype, buffer=shm.buf, offset=offsets[name])
+            for name, dtype in COLUMNS
+        }
+
+    @classmethod
+    def create(cls, name, capacity, index_size):
+        offsets, size = _layout(capacity, index_size)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _untrack(shm)
+        header = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[CAPACITY] = capacity
+        header[INDEX_SIZE] = index_size
+        store = cls(shm)
+        store.index[:] = -1
+        return store
+
+    @classmethod
+    def attach(cls, name, timeout=30.0):
+        shm = shared_memory.SharedMemory(name=name)
+        _untrack(shm)
+        header = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=shm.buf)
+        deadline = time.monotonic() + timeout
+        # Another process may still be loading a freshly created segment
+        while header[MAGIC] != MAGIC_VALUE:
+            if time.monotonic() > deadline:
+                shm.close()
+                raise TimeoutError(f"Feature store {name} was never finished loading")
+            time.sleep(0.05)
+        _, size = _layout(int(header[CAPACITY]), int(header[INDEX_SIZE]))
+        if shm.size < size:
+            # Left behind by a version with other columns or dtypes; have it rebuilt
+            header[RETIRED] = 1
+            resource_tracker.register(shm._name, 'shared_memory')
+            shm.unlink()
+            shm.close()
+            raise FileNotFoundError(f"Feature store {name} has an outdated layout")
+        return cls(shm)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def retired(self):
+        return bool(self.header[RETIRED])
+
+    def __len__(self):
+        return int(self.header[N_ROWS])
+
+    def rows_for(self, customer_ids):
+        customer_ids = np.asarray(customer_ids, dtype=np.int64)
+        rows = np.full(customer_ids.shape, -1, dtype=np.int64)
+        in_range = (customer_ids >= 0) & (customer_ids < len(self.index))
+        rows[in_range] = self.index[customer_ids[in_range]]
+        return rows
+
+    def lookup(self, customer_ids, columns=None):
+        """Return {column: array} for the given customers plus a 'found' mask."""
+        columns = columns or [name for name, _ in COLUMNS]
+        while True:
+            before = int(self.header[GENERATION])
+            if before % 2:
+                time.sleep(0)
+                continue
+            rows = self.rows_for(customer_ids)
+            found = rows >= 0
+            safe_rows = np.where(found, rows, 0)
+            result = {name: self.columns[name][safe_rows] for name in columns}
+            if int(self.header[GENERATION]) == before:
+                break
+        result['found'] = found
+        return result
+
+    def frame(self, customer_ids, decode=True):
+        """Lookup as a DataFrame with categorical codes decoded back to strings."""
+        values = self.lookup(customer_ids)
+        found = values.pop('found')
+        data = pd.DataFrame(values)
+        data.insert(0, 'customer_id', np.asarray(customer_ids, dtype=np.int64))
+        if decode:
+            for name, categories in CATEGORIES.items():
+                codes = data[name].to_numpy()
+                labels = np.array(categories + (None,), dtype=object)
+                data[name] = labels[np.where(codes >= 0, codes, len(categories))]
+            data['is_diaspora'] = data['is_diaspora'].astype(bool)
+            data['cluster'] = data['cluster'].where(data['cluster'] >= 0)
+        return data[found].reset_index(drop=True)
+
+    def _begin_write(self):
+        # Writers may live in different processes, so serialise them with a file lock too
+        self._write_lock.acquire()
+        self._lock_file = open(self._lock_path, 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self.header[GENERATION] += 1
+
+    def _end_write(self):
+        self.header[GENERATION] += 1
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._write_lock.release()
+
+    def fits(self, customer_ids):
+        customer_ids = np.unique(np.asarray(customer_ids, dtype=np.int64))
+        if not len(customer_ids):
+            return True
+        new = int((self.rows_for(customer_ids) < 0).sum())
+        return customer_ids.max() < len(self.index) and len(self) + new <= len(self.ids)
+
+    def upsert(self, frame):
+        """Write encoded customer rows, appending customers the store has not seen yet."""
+        customer_ids = frame['customer_id'].to_numpy(dtype=np.int64)
+        self._begin_write()
+        try:
+            rows = self.rows_for(customer_ids)
+            new = rows < 0
+            n_rows = len(self)
+            rows[new] = np.arange(n_rows, n_rows + new.sum())
+            self.ids[rows[new]] = customer_ids[new]
+            for name, dtype in COLUMNS:
+                if name in frame.columns:
+                    self.columns[name][rows] = frame[name].to_numpy().astype(dtype)
+            # Publish the new rows in the index last so readers never see half-written rows
+            self.index[customer_ids[new]] = rows[new]
+            self.header[N_ROWS] = n_rows + new.sum()
+        finally:
+            self._end_write()
+
+    def set_column(self, name, customer_ids, values, add=False):
+        rows = self.rows_for(customer_ids)
+        found = rows >= 0
+        values = np.asarray(values)[found]
+        self._begin_write()
+        try:
+            if add:
+                np.add.at(self.columns[name], rows[found], values.astype(self.columns[name].dtype))
+            else:
+                self.columns[name][rows[found]] = values
+        finally:
+            self._end_write()
+        return int(found.sum())
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.header[RETIRED] = 1
+        try:
+            # SharedMemory.unlink() unregisters from the tracker, so register it back first
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def encode_customers(data):
+    """Turn a CUSTOMER_QUERY result into store dtypes (codes instead of strings)."""
+    encoded = pd.DataFrame({'customer_id': data['customer_id'].astype(np.int64)})
+    for name, dtype in COLUMNS:
+        if name in CATEGORIES:
+            encoded[name] = pd.Categorical(data[name], categories=CATEGORIES[name]).codes.astype(dtype)
+        elif name in data.columns:
+            column = pd.to_numeric(data[name], errors='coerce')
+            if np.issubdtype(dtype, np.integer):
+                column = column.fillna(-1 if name == 'cluster' else 0)
+            encoded[name] = column.astype(dtype)
+    return encoded
+
+
+def _load_customers(where='', params=None):
+    data = schema.read_columns(CUSTOMER_QUERY + where, params)
+    return data.drop_duplicates('customer_id', keep='last')
+
+
+def _load_windows(customer_ids):
+    """Windowed card features for the given customers, zero for those with no recent spend."""
+    card_features.refresh_rollups()
+    windows = card_features.window_features(customer_ids=customer_ids)
+    data = pd.DataFrame({'customer_id': np.asarray(customer_ids, dtype=np.int64)})
+    data = data.merge(windows.astype({'customer_id': np.int64}), on='customer_id', how='left')
+    return data.fillna(0)
+
+
+def build(name=None):
+    """Create (or replace) the shared-memory store from a full scan of the tables."""
+    name = name or settings.FEATURE_STORE_NAME
+    started = time.perf_counter()
+    # Changes recorded from here on are applied by the first refresh
+    change_id = changelog.latest()
+    customers = _load_customers()
+    cards = schema.read_columns(CARD_QUERY, {'after': 0})
+
+    data = customers.merge(cards, on='customer_id', how='left')
+    data['total_card_value'] = data['total_card_value'].fillna(0)
+    data['transaction_count'] = data['transaction_count'].fillna(0)
+    data = data.merge(_load_windows(data['customer_id']), on='customer_id', how='left')
+
+    # Leave headroom so new customers can be appended without a rebuild
+    max_id = int(data['customer_id'].max()) if len(data) else 0
+    headroom = settings.FEATURE_STORE_HEADROOM
+    capacity = int(len(data) * headroom) + 1024
+    index_size = int(max_id * headroom) + 1024
+
+    try:
+        old = CustomerFeatureStore.attach(name, timeout=0)
+    except (FileNotFoundError, TimeoutError):
+        old = None
+    if old is not None:
+        # Readers notice the retired flag and re-attach to the replacement
+        old.unlink()
+        old.close()
+
+    store = CustomerFeatureStore.create(name, capacity, index_size)
+    store.upsert(encode_customers(data))
+    store.header[WATERMARK] = int(customers['changed_at'].fillna(0).max()) if len(customers) else 0
+    store.header[CARD_WATERMARK] = int(cards['last_transaction_id'].max()) if len(cards) else 0
+    store.header[WINDOW_DAY] = card_features.as_of_date().toordinal()
+    store.header[BUILT_AT] = int(time.time())
+    store.header[CHANGE_WATERMARK] = change_id
+    store.header[MAGIC] = MAGIC_VALUE
+    logger.info(f"Built feature store {name} with {len(store)} customers "
+                f"({store.shm.size / 1e6:.1f} MB) in {time.perf_counter() - started:.2f}s")
+    return store
+
+
+def refresh_card_totals(store, customer_ids):
+    """Recompute the card totals of customers whose existing transactions changed."""
+    customer_ids = np.unique(np.asarray(list(customer_ids), dtype=np.int64))
+    customer_ids = customer_ids[store.rows_for(customer_ids) >= 0]
+    if not len(customer_ids):
+        return 0
+    totals = schema.read_columns(CARD_TOTALS_QUERY, {'ids': customer_ids.tolist(),
+                                                     'through': int(store.header[CARD_WATERMARK])})
+    data = pd.DataFrame({'customer_id': customer_ids})
+    data = data.merge(totals.astype({'customer_id': np.int64}), on='customer_id', how='left').fillna(0)
+    store.upsert(data[['customer_id', 'total_card_value', 'transaction_count']])
+    return len(data)
+
+
+def refresh(store):
+    """Apply customer/savings changes since the watermark, new card transactions, and the
+    card rewrites and cluster moves other processes recorded in the change log.
+
+    Customers and transactions are found past the watermarks less a margin
+    (UPDATED_AT_LAG_SECONDS, CARD_WATERMARK_LAG_IDS) for transactions that committed after
+    an earlier refresh had moved past them. The card totals of customers with transactions
+    in that range, and of those the change listener saw rewritten, are recomputed exactly
+    rather than added onto, so re-reading the margin never counts a row twice. Rewrites
+    nobody recorded are caught by a rebuild once the store is FEATURE_STORE_REBUILD_SECONDS old.
+
+    Returns the number of customers touched, or None when the change does not fit the
+    segment's headroom or a full rebuild is otherwise required.
+    """
+    rebuild_after = settings.FEATURE_STORE_REBUILD_SECONDS
+    if rebuild_after and time.time() - store.header[BUILT_AT] > rebuild_after:
+        return None
+    change_id, card_rewrites, cluster_moves = changelog.since(int(store.header[CHANGE_WATERMARK]))
+    if card_rewrites is None:
+        return None
+    started = time.perf_counter()
+    changed = _load_customers(
+        where="WHERE c.updated_at > TIMESTAMP 'epoch' + :after * INTERVAL '1 microsecond' "
+              "OR s.updated_at > TIMESTAMP 'epoch' + :after * INTERVAL '1 microsecond'",
+        params={'after': max(int(store.header[WATERMARK]) - int(settings.UPDATED_AT_LAG_SECONDS * 1e6), 0)}
+    )
+    cards = schema.read_columns(CARD_QUERY, {
+        'after': max(int(store.header[CARD_WATERMARK]) - settings.CARD_WATERMARK_LAG_IDS, 0)
+    })
+
+    if not store.fits(np.concatenate([changed['customer_id'].to_numpy(), cards['customer_id'].to_numpy()])):
+        return None
+
+    if len(changed):
+        store.upsert(encode_customers(changed))
+        store.header[WATERMARK] = max(int(store.header[WATERMARK]), int(changed['changed_at'].fillna(0).max()))
+    if len(cards):
+        store.header[CARD_WATERMARK] = max(int(store.header[CARD_WATERMARK]), int(cards['last_transaction_id'].max()))
+    card_customers = set(cards['customer_id'].tolist()) | card_rewrites
+    if card_customers:
+        refresh_card_totals(store, card_customers)
+    if cluster_moves is None or cluster_moves:
+        where, params = ('', None) if cluster_moves is None else (' WHERE customer_id = ANY(:ids)',
+                                                                  {'ids': sorted(cluster_moves)})
+        clusters = schema.read_columns(CLUSTER_QUERY + where, params)
+        store.set_column('cluster', clusters['customer_id'], clusters['cluster'].fillna(-1))
+    store.header[CHANGE_WATERMARK] = change_id
+
+    # Windows slide with the calendar, so a new day recomputes every customer's windows
+    as_of = card_features.as_of_date().toordinal()
+    if as_of != store.header[WINDOW_DAY]:
+        window_ids = store.ids[:len(store)]
+    else:
+        window_ids = np.union1d(cards['customer_id'].to_numpy(), np.fromiter(card_rewrites, dtype=np.int64))
+    window_ids = window_ids[store.rows_for(window_ids) >= 0]
+    if len(window_ids):
+        store.upsert(_load_windows(window_ids))
+        store.header[WINDOW_DAY] = as_of
+
+    touched = len(set(changed['customer_id']) | card_customers | (set() if cluster_moves is None else cluster_moves))
+    if touched:
+        logger.info(f"Refreshed {touched} customers in feature store in {time.perf_counter() - started:.3f}s")
+    return touched
+
+
+_store = None
+_store_lock = threading.Lock()
+_last_refresh = 0.0
+_owner_pid = None
+
+
+def claim_refresh():
+    """Make this process the one that refreshes the store on access (see serving.after_fork)."""
+    global _owner_pid, _last_refresh
+    with _store_lock:
+        _owner_pid = os.getpid()
+        _last_refresh = time.monotonic()
+
+
+def get_store(create=True):
+    """Attach to the shared store, building it if nobody has yet.
+
+    Only the process that built the store refreshes it on access; other workers just
+    read the shared pages (run ``manage.py refresh_feature_store`` for a dedicated
+    refresher).
+    """
+    global _store, _last_refresh, _owner_pid
+    if not settings.FEATURE_STORE_ENABLED:
+        return None
+    with _store_lock:
+        if _store is not None and _store.retired:
+            _store.close()
+            _store = None
+        if _store is None:
+            try:
+                _store = CustomerFeatureStore.attach(settings.FEATURE_STORE_NAME)
+            except FileNotFoundError:
+                if not create:
+                    return None
+                try:
+                    _store = build()
+                    _owner_pid = os.getpid()
+                except FileExistsError:
+                    # Another worker won the race to build it
+                    _store = CustomerFeatureStore.attach(settings.FEATURE_STORE_NAME)
+                _last_refresh = time.monotonic()
+
+        interval = settings.FEATURE_STORE_REFRESH_SECONDS
+        if _owner_pid == os.getpid() and interval and time.monotonic() - _last_refresh > interval:
+            _last_refresh = time.monotonic()
+            if refresh(_store) is None:
+                _store.close()
+                _store = build()
+        return _store
+
+
+def describe():
+    """State of this process's attachment to the shared store, without attaching or refreshing."""
+    with _store_lock:
+        if _store is None:
+            return {'enabled': settings.FEATURE_STORE_ENABLED, 'attached': False}
+        return {
+            'enabled': settings.FEATURE_STORE_ENABLED,
+            'attached': True,
+            'rows': len(_store),
+            'generation': int(_store.header[GENERATION]),
+            'refreshes_here': _owner_pid == os.getpid(),
+            'seconds_since_refresh': round(time.monotonic() - _last_refresh, 1) if _owner_pid == os.getpid() else None,
+        }
@@ -0,0 +1,318 @@
+import itertools
+import logging
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db.utils import Error as dbError
+
+from . import aggregates, schema
+from .scoring import load_artifacts, score_frames
+
+logger = logging.getLogger(__name__)
+
+# The fee rule FeeOptimizationView has always applied, as tunable parameters
+DEFAULT_POLICY = {
+    'base_rate': 0.001,               # share of wealth (income + savings + card value)
+    'medium_risk_multiplier': 1.1,    # avg default probability > 0.2
+    'high_risk_multiplier': 1.2,      # avg default probability > 0.5
+    'cluster_0_multiplier': 0.8,
+    'cluster_2_multiplier': 1.2,
+    'churn_cap_rate': 0.05,           # fee cap as a share of income for churn-risk customers
+    'cap_rate': 0.1,                  # fee cap as a share of income otherwise
+    'min_fee': 100,
+    'max_fee': 1000,
+    'churn_haircut': 0.5,             # revenue lost per unit of churn risk
+    'fee_elasticity': 0.0,            # extra churn probability per unit of fee/income
+}
+
+# Range every policy parameter must lie in, inclusive; None leaves that side open
+POLICY_RANGES = {
+    'base_rate': (0, 1),
+    'medium_risk_multiplier': (0, None),
+    'high_risk_multiplier': (0, None),
+    'cluster_0_multiplier': (0, None),
+    'cluster_2_multiplier': (0, None),
+    'churn_cap_rate': (0, 1),
+    'cap_rate': (0, 1),
+    'min_fee': (0, None),
+    'max_fee': (0, None),
+    'churn_haircut': (0, 1),
+    'fee_elasticity': (0, None),
+}
+
+CUSTOMER_QUERY = """
+SELECT c.customer_id, c.income, c.credit_score, c.is_diaspora, c.cluster,
+       COALESCE(s.savings_balance, 0) as savings_balance,
+       COALESCE(s.activity_score, 0) as activity_score,
+       COALESCE((
+           SELECT SUM(ct.transaction_value)
+           FROM card_transactions ct
+           WHERE ct.customer_id = c.customer_id
+       ), 0) as total_card_value
+FROM customers c {sample}
+LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
+ORDER BY c.customer_id
+"""
+
+# In loan_id order, as the DuckDB engine reads it (columnar.QUERIES)
+LOAN_QUERY = """
+SELECT l.loan_id, l.customer_id, l.loan_amount, l.interest_rate, l.loan_tenure_months,
+       c.income, c.credit_score, c.cluster, s.activity_score,
+       c.is_diaspora, c.age, c.segment,
+       COALESCE((
+           SELECT SUM(ct.transaction_value)
+           FROM card_transactions ct
+           WHERE ct.customer_id = c.customer_id
+       ), 0) as total_card_value
+FROM loans l
+JOIN customers c ON l.customer_id = c.customer_id
+LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
+{where}
+ORDER BY l.loan_id
+"""
+
+
+def customer_frame(sample=''):
+    """Customers with the inputs of the fee rule, including their average default probability.
+
+    ``sample`` is an optional TABLESAMPLE clause for customers; only the sampled customers'
+    loans are then scored. Raises FileNotFoundError when loans exist but the risk model is missing.
+    """
+    logger.info("Executing customer query...")
+    data = schema.read_frame(CUSTOMER_QUERY.format(sample=sample))
+    logger.info(f"Retrieved {len(data)} customer rows")
+    if data.empty:
+        return data
+
+    logger.info("Computing loan risk probabilities...")
+    if sample:
+        loan_risk = customer_loan_risk('WHERE l.customer_id = ANY(:ids)',
+                                       {'ids': data['customer_id'].astype(int).tolist()})
+    else:
+        loan_risk = customer_loan_risk()
+    return prepare_customers(data, loan_risk)
+
+
+def customer_loan_risk(where='', params=None, age_median=None):
+    """Score the loans matching ``where`` and return each customer's average default probability.
+
+    Loans are scored in chunks sized to the memory budget and their scores persisted;
+    missing ages get ``age_median``, by default the median over the whole book. Returns
+    None when there are no such loans.
+    """
+    loan_query = LOAN_QUERY.format(where=where)
+    chunks = schema.iter_frames(loan_query, params, rows=schema.chunk_rows(loan_query, params))
+    first = next(chunks, None)
+    if first is None or first.empty:
+        return None
+    artifacts = load_artifacts()
+    loan_data = score_frames(itertools.chain([first], chunks), artifacts, keep=['loan_id', 'customer_id'],
+                             age_median=age_median)
+    logger.info(f"Scored {len(loan_data)} loan rows")
+    try:
+        aggregates.persist_scores(loan_data['loan_id'], loan_data['customer_id'],
+                                  loan_data['default_probability'],
+                                  loan_data['risk_category'], artifacts.version)
+    except dbError as e:
+        logger.warning(f"Failed to persist loan scores: {str(e)}")
+
+    # Aggregate to customer level
+    return loan_data.groupby('customer_id').agg({
+        'default_probability': 'mean'
+    }).reset_index().rename(columns={'default_probability': 'avg_default_probability'})
+
+
+def prepare_customers(data, loan_risk=None, income_median=None):
+    """Merge the customers' loan risk and fill the fee rule inputs.
+
+    Missing incomes get ``income_median``, by default the median of ``data`` itself; callers
+    working on a slice of the customers pass the median of all of them.
+    """
+    if loan_risk is not None:
+        data = data.merge(loan_risk, on='customer_id', how='left')
+    else:
+        data['avg_default_probability'] = 0
+
+    logger.info(f"Merged data shape: {data.shape}")
+
+    # Convert Decimal to float
+    for col in ['income', 'savings_balance', 'total_card_value']:
+        data[col] = pd.to_numeric(data[col], errors='coerce').astype(float)
+
+    # Fill missing values
+    data['savings_balance'] = data['savings_balance'].fillna(0)
+    data['total_card_value'] = data['total_card_value'].fillna(0)
+    data['activity_score'] = data['activity_score'].fillna(0)
+    data['avg_default_probability'] = data['avg_default_probability'].fillna(0)
+    data['cluster'] = data['cluster'].fillna(-1)
+    data['income'] = data['income'].fillna(data['income'].median() if income_median is None else income_median)
+
+    # Convert boolean to int
+    data['is_diaspora'] = data['is_diaspora'].astype(int)
+
+    # Churn risk: low savings activity
+    data['churn_risk'] = (data['activity_score'] < 0.3).astype(int)
+    return data
+
+
+def customer_matrix(data):
+    """The per-customer arrays the fee rule reads, as plain NumPy for broadcasting."""
+    probability = data['avg_default_probability'].to_numpy(dtype=float)
+    return {
+        'income': data['income'].to_numpy(dtype=float),
+        'wealth': (data['income'] + data['savings_balance'] + data['total_card_value']).to_numpy(dtype=float),
+        'risk_level': np.where(probability > 0.5, 2, np.where(probability > 0.2, 1, 0)).astype(np.int8),
+        'cluster': data['cluster'].to_numpy(dtype=float).astype(np.int16),
+        'churn_risk': data['churn_risk'].to_numpy(dtype=float),
+    }
+
+
+def evaluate(policies, customers):
+    """Fees, churn probabilities and expected revenue for every (policy, customer) pair.
+
+    ``policies`` maps each DEFAULT_POLICY key to an array of shape (P,); the result arrays
+    have shape (P, N) and are computed by broadcasting, without per-row Python.
+    """
+    p = {key: np.asarray(values, dtype=float)[:, None] for key, values in policies.items()}
+    risk = customers['risk_level'][None, :]
+    cluster = customers['cluster'][None, :]
+    churn = customers['churn_risk'][None, :]
+    income = customers['income'][None, :]
+
+    risk_multiplier = np.where(risk == 2, p['high_risk_multiplier'], np.where(risk == 1, p['medium_risk_multiplier'], 1.0))
+    cluster_multiplier = np.where(cluster == 0, p['cluster_0_multiplier'], np.where(cluster == 2, p['cluster_2_multiplier'], 1.0))
+    fee = customers['wealth'][None, :] * p['base_rate'] * risk_multiplier * cluster_multiplier
+
+    # Cap fee to avoid churn, then enforce min/max bounds
+    cap = income * np.where(churn > 0.5, p['churn_cap_rate'], p['cap_rate'])
+    fee = np.maximum(p['min_fee'], np.minimum(np.minimum(fee, cap), p['max_fee'])).round(2)
+
+    churn_probability = np.clip(churn * p['churn_haircut'] + p['fee_elasticity'] * fee / np.maximum(income, 1), 0, 1)
+    return fee, churn_probability, fee * (1 - churn_probability)
+
+
+def apply_policy(data, policy=None):
+    """Add recommended_fee and expected_revenue columns for a single policy."""
+    policy = {**DEFAULT_POLICY, **(policy or {})}
+    fee, _, revenue = evaluate({key: [value] for key, value in policy.items()}, customer_matrix(data))
+    data['recommended_fee'] = fee[0]
+    data['expected_revenue'] = revenue[0]
+    return data
+
+
+def simulation_defaults():
+    """DEFAULT_POLICY as the simulator evaluates it.
+
+    The production rule ignores how fees drive churn (fee_elasticity 0), under which a
+    higher fee only ever adds revenue and the frontier collapses to one policy, so
+    simulations default to FEE_SIMULATOR_FEE_ELASTICITY instead.
+    """
+    return {**DEFAULT_POLICY, 'fee_elasticity': settings.FEE_SIMULATOR_FEE_ELASTICITY}
+
+
+def expand_grid(grid):
+    """Cartesian product of the grid's values, with unspecified parameters at their defaults."""
+    unknown = sorted(set(grid) - set(DEFAULT_POLICY))
+    if unknown:
+        raise ValueError(f'Unknown policy parameters: {unknown}')
+    defaults = simulation_defaults()
+    keys = list(defaults)
+    axes = [np.asarray(grid.get(key, [defaults[key]]), dtype=float).ravel() for key in keys]
+    for key, axis in zip(keys, axes):
+        low, high = POLICY_RANGES[key]
+        if not np.all(np.isfinite(axis)) or np.any(axis < low) or (high is not None and np.any(axis > high)):
+            raise ValueError(f"{key} must be between {low} and {high}" if high is not None
+                             else f"{key} must be at least {low}")
+    # Every combination is evaluated, so each min_fee must be at most each max_fee
+    min_fees, max_fees = axes[keys.index('min_fee')], axes[keys.index('max_fee')]
+    if len(min_fees) and len(max_fees) and min_fees.max() > max_fees.min():
+        raise ValueError('min_fee must not exceed max_fee')
+    if not np.any(axes[keys.index('fee_elasticity')] > 0):
+        raise ValueError('fee_elasticity must be positive for a revenue/churn trade-off')
+    size = math.prod(len(axis) for axis in axes)
+    if not size:
+        raise ValueError('Every grid parameter needs at least one value')
+    if size > settings.FEE_SIMULATOR_MAX_POLICIES:
+        raise ValueError(f'Grid has {size} policies; the limit is {settings.FEE_SIMULATOR_MAX_POLICIES}')
+    mesh = np.meshgrid(*axes, indexing='ij')
+    return {key: values.ravel() for key, values in zip(keys, mesh)}
+
+
+def _simulate_chunk(policies, customers, cluster_ids):
+    fee, churn_probability, revenue = evaluate(policies, customers)
+    onehot = (customers['cluster'][:, None] == cluster_ids[None, :]).astype(float)
+    return {
+        'total_revenue': revenue.sum(axis=1),
+        'expected_churn': churn_probability.sum(axis=1),
+        'avg_fee': fee.mean(axis=1),
+        'cluster_revenue': revenue @ onehot,
+    }
+
+
+def simulate(grid, data, workers=None):
+    """Evaluate every policy in the grid over all customers and summarise the trade-offs."""
+    policies = expand_grid(grid)
+    customers = customer_matrix(data)
+    n_policies, n_customers = len(next(iter(policies.values()))), len(data)
+    cluster_ids = np.unique(customers['cluster'][customers['cluster'] >= 0])
+
+    # Bound the (policies x customers) working set and fan large grids out to processes
+    rows_per_chunk = max(1, settings.FEE_SIMULATOR_CHUNK_CELLS // max(n_customers, 1))
+    chunks = [
+        {key: values[start:start + rows_per_chunk] for key, values in policies.items()}
+        for start in range(0, n_policies, rows_per_chunk)
+    ]
+    workers = workers or settings.FEE_SIMULATOR_WORKERS
+    if len(chunks) > 1 and workers > 1 and n_policies * n_customers >= settings.FEE_SIMULATOR_PARALLEL_MIN_CELLS:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_simulate_chunk, chunks, itertools.repeat(customers), itertools.repeat(cluster_ids)))
+    else:
+        parts = [_simulate_chunk(chunk, customers, cluster_ids) for chunk in chunks]
+    results = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+    # The rule in production, at the grid's elasticity when it names exactly one
+    baseline_policy = simulation_defaults()
+    if len(grid.get('fee_elasticity', [])) == 1:
+        baseline_policy['fee_elasticity'] = float(grid['fee_elasticity'][0])
+    baseline = _simulate_chunk({key: [value] for key, value in baseline_policy.items()}, customers, cluster_ids)
+
+    def policy_at(i):
+        return {key: float(values[i]) for key, values in policies.items()}
+
+    def outcome_at(i, results=results, policy=None):
+        return {
+            'policy': policy or policy_at(i),
+            'total_revenue': round(float(results['total_revenue'][i]), 2),
+            'expected_churn': round(float(results['expected_churn'][i]), 2),
+            'churn_rate': round(float(results['expected_churn'][i]) / max(n_customers, 1), 4),
+            'avg_fee': round(float(results['avg_fee'][i]), 2),
+        }
+
+    # Revenue/churn frontier: policies no other policy beats on both revenue and churn
+    order = np.lexsort((-results['total_revenue'], results['expected_churn']))
+    frontier, best_revenue = [], -np.inf
+    for i in order:
+        if results['total_revenue'][i] > best_revenue:
+            frontier.append(int(i))
+            best_revenue = results['total_revenue'][i]
+
+    best = int(np.argmax(results['total_revenue']))
+    best_by_cluster = {}
+    for j, cluster in enumerate(cluster_ids):
+        i = int(np.argmax(results['cluster_revenue'][:, j]))
+        best_by_cluster[f'Cluster {cluster}'] = {
+            'policy': policy_at(i),
+            'cluster_revenue': round(float(results['cluster_revenue'][i, j]), 2),
+        }
+
+    return {
+        'policies_evaluated': n_policies,
+        'customers': n_customers,
+        'best_policy': outcome_at(best),
+        'frontier': [outcome_at(i) for i in frontier],
+        'best_by_cluster': best_by_cluster,
+        'baseline': outcome_at(0, baseline, {key: float(value) for key, value in baseline_policy.items()}),
+    }
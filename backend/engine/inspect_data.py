@@ -2,6 +2,11 @@ import pandas as pd
 from sqlalchemy import create_engine
 from decimal import Decimal
 
+try:
+    from engine.pgcopy import UnsupportedQuery, read_copy
+except ImportError:  # run directly as engine/<script>.py
+    from pgcopy import UnsupportedQuery, read_copy
+
 # Database connection
 engine = create_engine('postgresql://postgres:2003@db:5432/revenue')
 
@@ -19,12 +24,18 @@ FROM loans l
 JOIN customers c ON l.customer_id = c.customer_id
 LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
 """
-data = pd.read_sql(query, engine)
+try:
+    # Binary COPY straight into NumPy columns; segments arrive as categorical codes
+    data = read_copy(query, bind=engine, categories={'segment': ['High Net Worth', 'Low Income', 'Middle Class']})
+    data['segment'] = data['segment'].astype(object)
+except UnsupportedQuery:
+    data = pd.read_sql(query, engine)
 
 # Convert Decimal to float
 decimal_columns = ['loan_amount', 'interest_rate', 'total_card_value']
 for col in decimal_columns:
-    data[col] = data[col].apply(lambda x: float(x) if isinstance(x, Decimal) else x)
+    if data[col].dtype == object:
+        data[col] = data[col].apply(lambda x: float(x) if isinstance(x, Decimal) else x)
 
 # Fill missing values
 data['activity_score'] = data['activity_score'].fillna(0)
@@ -48,7 +59,7 @@ print(data.isnull().sum())
 print("\nClass Distribution:")
 print(data['loan_default'].value_counts(normalize=True))
 print("\nFeature Correlations with loan_default:")
-numeric_cols = data.select_dtypes(include=['float64', 'int64']).columns
+numeric_cols = data.select_dtypes(include='number').columns
 print(data[numeric_cols].corr()['loan_default'].sort_values(ascending=False))
 
 # Save to CSV for inspection
@@ -0,0 +1,381 @@
+import hashlib
+import json
+import logging
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import psycopg2
+from django.conf import settings
+from django.db import close_old_connections, connection, connections
+from psycopg2.extras import Json
+
+from .db import database_url
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'engine_jobs'
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+ENQUEUE_QUERY = """
+INSERT INTO jobs (kind, key, payload, priority, status, attempts, max_attempts, run_after, created_at)
+VALUES (%s, %s, %s, %s, 'queued', 0, %s, clock_timestamp() + %s * interval '1 second', clock_timestamp())
+ON CONFLICT (key) WHERE status = 'queued' DO UPDATE SET
+    priority = GREATEST(jobs.priority, EXCLUDED.priority),
+    run_after = LEAST(jobs.run_after, EXCLUDED.run_after)
+RETURNING id, xmax = 0
+"""
+
+# The next ready job by priority, skipping rows other workers hold and keys already running
+CLAIM_QUERY = """
+UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = %(worker)s,
+                started_at = clock_timestamp(), heartbeat_at = clock_timestamp(),
+                wait_seconds = EXTRACT(EPOCH FROM clock_timestamp() - run_after)
+WHERE id = (
+    SELECT q.id FROM jobs q
+    WHERE q.status = 'queued' AND q.run_after <= clock_timestamp()
+      AND (%(kinds)s::text[] IS NULL OR q.kind = ANY(%(kinds)s::text[]))
+      AND NOT EXISTS (SELECT 1 FROM jobs r WHERE r.key = q.key AND r.status = 'running')
+    ORDER BY q.priority DESC, q.run_after, q.id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, kind, key, payload, attempts, max_attempts
+"""
+
+COMPLETE_QUERY = """
+UPDATE jobs SET status = 'done', finished_at = clock_timestamp(), heartbeat_at = NULL,
+                duration_seconds = %s, result = %s, last_error = NULL
+WHERE id = %s
+"""
+
+# A failed attempt is retried after the backoff, unless a newer request for the same key is
+# already queued and will do the work anyway
+RETRY_STATUS = """
+CASE WHEN j.attempts < j.max_attempts
+      AND NOT EXISTS (SELECT 1 FROM jobs q WHERE q.key = j.key AND q.status = 'queued')
+     THEN 'queued' ELSE 'failed' END
+"""
+
+FAIL_QUERY = f"""
+UPDATE jobs j SET status = {RETRY_STATUS}, run_after = clock_timestamp() + %s * interval '1 second',
+                  finished_at = clock_timestamp(), heartbeat_at = NULL, duration_seconds = %s, last_error = %s
+WHERE j.id = %s
+RETURNING j.status
+"""
+
+# A stopped job goes back in the queue without counting the attempt, unless a newer request
+# for the same key is already queued
+REQUEUE_QUERY = """
+UPDATE jobs j SET status = CASE WHEN NOT EXISTS (SELECT 1 FROM jobs q WHERE q.key = j.key AND q.status = 'queued')
+                                THEN 'queued' ELSE 'failed' END,
+                  attempts = attempts - 1, heartbeat_at = NULL, finished_at = clock_timestamp(),
+                  last_error = 'worker ' || COALESCE(j.worker, '?') || ' stopped'
+WHERE j.id = %s AND j.status = 'running'
+"""
+
+# When a request for the same key is queued between the retry check and the write, the
+# write hits the one-queued-job-per-key index; the queued job does the work instead
+SUPERSEDE_QUERY = """
+UPDATE jobs SET status = 'failed', finished_at = clock_timestamp(), heartbeat_at = NULL, duration_seconds = %s,
+                last_error = %s || ' (superseded by a newer queued request)'
+WHERE id = %s
+"""
+
+# Jobs whose worker died mid-run
+REAP_QUERY = f"""
+UPDATE jobs j SET status = {RETRY_STATUS}, run_after = clock_timestamp(),
+                  finished_at = clock_timestamp(), heartbeat_at = NULL,
+                  last_error = 'worker ' || COALESCE(j.worker, '?') || ' stopped sending heartbeats'
+WHERE j.status = 'running' AND j.heartbeat_at < clock_timestamp() - %s * interval '1 second'
+RETURNING j.id, j.kind, j.status
+"""
+
+PRUNE_QUERY = """
+DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < clock_timestamp() - %s * interval '1 day'
+"""
+
+STATS_QUERY = """
+SELECT kind, status, COUNT(*),
+       MAX(EXTRACT(EPOCH FROM clock_timestamp() - run_after))
+           FILTER (WHERE status = 'queued' AND run_after <= clock_timestamp()),
+       AVG(wait_seconds) FILTER (WHERE status IN ('running', 'done')),
+       AVG(duration_seconds) FILTER (WHERE status = 'done')
+FROM jobs
+GROUP BY kind, status
+"""
+
+JOB_COLUMNS = ['id', 'kind', 'key', 'payload', 'priority', 'status', 'attempts', 'max_attempts', 'run_after',
+               'created_at', 'started_at', 'finished_at', 'wait_seconds', 'duration_seconds', 'worker',
+               'last_error', 'result']
+
+
+class JobError(Exception):
+    """A job ran but could not do its work; it is retried like any other failure."""
+
+
+# Handlers: payload -> JSON-able result. Heavy imports stay inside so the API processes
+# that only enqueue never load them
+
+def _segmentation(payload):
+    from .views import CustomerSegmentationView
+
+    response, source = CustomerSegmentationView().refit(mode='wait')
+    if response.status_code != 200:
+        raise JobError(response.data.get('error', f'HTTP {response.status_code}'))
+    return {'customers': len(response.data.get('clusters', [])), 'source': source}
+
+
+def _assign_clusters(payload):
+    from . import segmentation
+
+    result = segmentation.assign(payload.get('customer_ids'))
+    return {'assigned': result['assigned']}
+
+
+def _score_loans(payload):
+    from . import locks
+    from .batch_scoring import score_book
+
+    # The scoring processes are forked; do not let them inherit this process's connection
+    connections.close_all()
+    report, source = locks.single_flight(locks.BATCH_SCORING, lambda: score_book(
+        database_url(),
+        workers=payload.get('workers', 4),
+        ranges=payload.get('ranges'),
+        chunk_size=payload.get('chunk_size', 50000),
+        threads_per_worker=payload.get('threads_per_worker')
+    ), mode='wait')
+    return {'loans': report['loans'], 'model_version': report['model_version'], 'source': source}
+
+
+def _refresh_card_rollups(payload):
+    from . import card_features
+
+    return {'rows': card_features.refresh_rollups(full=bool(payload.get('full')))}
+
+
+def _export_snapshot(payload):
+    from . import snapshots
+
+    manifest = snapshots.export(payload.get('keep'))
+    return {'name': manifest['name'], 'duration_seconds': manifest['duration_seconds']}
+
+
+def _train_model(payload):
+    # train_model.py is a standalone script; serving processes pick up the new files by stamp
+    script = os.path.join(settings.BASE_DIR, 'engine', 'train_model.py')
+    completed = subprocess.run([sys.executable, script], cwd=settings.BASE_DIR, capture_output=True, text=True)
+    output = (completed.stdout + completed.stderr).strip().splitlines()
+    if completed.returncode:
+        raise JobError(f'train_model.py exited with {completed.returncode}: {output[-1] if output else "no output"}')
+    return {'output': output[-10:]}
+
+
+HANDLERS = {
+    'segmentation': _segmentation,
+    'assign_clusters': _assign_clusters,
+    'score_loans': _score_loans,
+    'refresh_card_rollups': _refresh_card_rollups,
+    'export_snapshot': _export_snapshot,
+    'train_model': _train_model,
+}
+
+
+def default_key(kind, payload):
+    """Requests for the same work share a key, so queuing it again while it waits is a no-op."""
+    if not payload:
+        return kind
+    return f"{kind}:{hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]}"
+
+
+def enqueue(kind, payload=None, key=None, priority=0, delay=0, max_attempts=None):
+    """Queue a job, or merge it into the queued job with the same key.
+
+    A merged request raises the queued job's priority and never delays it. Returns
+    (job id, created).
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind {kind!r}; expected one of {', '.join(HANDLERS)}")
+    payload = payload or {}
+    key = key or default_key(kind, payload)
+    max_attempts = settings.JOB_MAX_ATTEMPTS if max_attempts is None else max_attempts
+    with connection.cursor() as cursor:
+        cursor.execute(ENQUEUE_QUERY, [kind, key, json.dumps(payload), priority, max_attempts, delay])
+        job_id, created = cursor.fetchone()
+        cursor.execute("SELECT pg_notify(%s, %s)", [CHANNEL, kind])
+    logger.info(f"{'Queued' if created else 'Merged into queued'} job {job_id} ({key}, priority {priority})")
+    return job_id, created
+
+
+def _job(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    # Django's connections hand jsonb back as text
+    for column in ('payload', 'result'):
+        if isinstance(job[column], str):
+            job[column] = json.loads(job[column])
+    return job
+
+
+def get(job_id):
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = %s", [job_id])
+        row = cursor.fetchone()
+    return _job(row) if row else None
+
+
+def recent(status=None, kind=None, limit=50):
+    conditions, params = [], []
+    if status:
+        conditions.append("status = %s")
+        params.append(status)
+    if kind:
+        conditions.append("kind = %s")
+        params.append(kind)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs {where} ORDER BY id DESC LIMIT %s",
+                       params + [limit])
+        return [_job(row) for row in cursor.fetchall()]
+
+
+def stats():
+    """Jobs per kind and status, the longest a ready job has waited, and average wait and run times."""
+    with connection.cursor() as cursor:
+        cursor.execute(STATS_QUERY)
+        rows = cursor.fetchall()
+    kinds = {}
+    for kind, job_status, count, oldest_ready, wait, duration in rows:
+        summary = kinds.setdefault(kind, {**{name: 0 for name in STATUSES}, 'oldest_ready_seconds': None,
+                                          'avg_wait_seconds': None, 'avg_duration_seconds': None})
+        summary[job_status] = count
+        if oldest_ready is not None:
+            summary['oldest_ready_seconds'] = round(float(oldest_ready), 1)
+        if job_status == 'done':
+            summary['avg_wait_seconds'] = round(float(wait), 3) if wait is not None else None
+            summary['avg_duration_seconds'] = round(float(duration), 3) if duration is not None else None
+    return kinds
+
+
+def backoff(attempts):
+    """Seconds before retrying after the given number of failed attempts."""
+    return min(settings.JOB_RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), settings.JOB_RETRY_MAX_SECONDS)
+
+
+class Worker:
+    """Claims and runs queued jobs one at a time until stopped.
+
+    Idle workers sleep on LISTEN for new jobs, polling every JOB_POLL_SECONDS for retries
+    coming due. A running job's heartbeat is refreshed from a background thread; jobs whose
+    worker stopped beating are put back in the queue by whichever worker notices first.
+    """
+
+    def __init__(self, kinds=None, poll=None):
+        self.kinds = list(kinds) if kinds else None
+        self.poll = settings.JOB_POLL_SECONDS if poll is None else poll
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self.conn = None
+        self._maintained_at = 0.0
+
+    def _connect(self):
+        self.conn = psycopg2.connect(database_url())
+        self.conn.autocommit = True
+        self.conn.cursor().execute(f'LISTEN {CHANNEL}')
+
+    def _maintain(self):
+        if time.monotonic() - self._maintained_at < self.poll:
+            return
+        self._maintained_at = time.monotonic()
+        with self.conn.cursor() as cursor:
+            try:
+                cursor.execute(REAP_QUERY, [settings.JOB_STALE_SECONDS])
+                for job_id, kind, job_status in cursor.fetchall():
+                    logger.warning(f"Job {job_id} ({kind}) lost its worker; now {job_status}")
+            except psycopg2.errors.UniqueViolation:
+                logger.warning("Skipped reaping stale jobs that are queued again already")
+            cursor.execute(PRUNE_QUERY, [settings.JOB_RETENTION_DAYS])
+
+    def claim(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute(CLAIM_QUERY, {'worker': self.name, 'kinds': self.kinds})
+            row = cursor.fetchone()
+        return dict(zip(['id', 'kind', 'key', 'payload', 'attempts', 'max_attempts'], row)) if row else None
+
+    def _heartbeat(self, job_id, stop):
+        while not stop.wait(settings.JOB_HEARTBEAT_SECONDS):
+            try:
+                with self.conn.cursor() as cursor:
+                    cursor.execute("UPDATE jobs SET heartbeat_at = clock_timestamp() WHERE id = %s", [job_id])
+            except psycopg2.Error as e:
+                logger.warning(f"Could not record the heartbeat of job {job_id}: {str(e)}")
+
+    def run(self, job):
+        logger.info(f"Running job {job['id']} ({job['key']}, attempt {job['attempts']}/{job['max_attempts']})")
+        stop = threading.Event()
+        beat = threading.Thread(target=self._heartbeat, args=(job['id'], stop), name='job-heartbeat', daemon=True)
+        beat.start()
+        started = time.perf_counter()
+        try:
+            try:
+                close_old_connections()
+                result = HANDLERS[job['kind']](job['payload'] or {})
+            finally:
+                stop.set()
+                beat.join()
+                close_old_connections()
+        except (KeyboardInterrupt, SystemExit):
+            # Stopped on purpose: give the job back without counting the attempt
+            with self.conn.cursor() as cursor:
+                try:
+                    cursor.execute(REQUEUE_QUERY, [job['id']])
+                except psycopg2.errors.UniqueViolation:
+                    cursor.execute(SUPERSEDE_QUERY, [time.perf_counter() - started, 'stopped', job['id']])
+            raise
+        except Exception as e:
+            duration = time.perf_counter() - started
+            logger.error(f"Job {job['id']} ({job['kind']}) failed after {duration:.3f}s: {str(e)}", exc_info=True)
+            with self.conn.cursor() as cursor:
+                try:
+                    cursor.execute(FAIL_QUERY, [backoff(job['attempts']), duration, str(e)[:2000], job['id']])
+                    job_status = cursor.fetchone()[0]
+                except psycopg2.errors.UniqueViolation:
+                    logger.warning(f"Job {job['id']} not retried: a newer request for {job['key']} is queued")
+                    cursor.execute(SUPERSEDE_QUERY, [duration, str(e)[:2000], job['id']])
+                    job_status = 'failed'
+            if job_status == 'queued':
+                logger.info(f"Job {job['id']} retries in {backoff(job['attempts'])}s")
+            return {**job, 'status': job_status, 'duration_seconds': round(duration, 3), 'error': str(e)}
+
+        duration = time.perf_counter() - started
+        with self.conn.cursor() as cursor:
+            cursor.execute(COMPLETE_QUERY, [duration, Json(result), job['id']])
+        logger.info(f"Job {job['id']} ({job['kind']}) done in {duration:.3f}s")
+        return {**job, 'status': 'done', 'duration_seconds': round(duration, 3), 'result': result}
+
+    def work(self, on_job=None, burst=False):
+        """Run jobs until interrupted; with ``burst``, return once no job is ready."""
+        on_job = on_job or (lambda outcome: None)
+        logger.info(f"Job worker {self.name} started" + (f" for {', '.join(self.kinds)}" if self.kinds else ''))
+        while True:
+            try:
+                if self.conn is None or self.conn.closed:
+                    self._connect()
+                self._maintain()
+                job = self.claim()
+                if job is not None:
+                    on_job(self.run(job))
+                    continue
+                if burst:
+                    return
+                if select.select([self.conn], [], [], self.poll)[0]:
+                    self.conn.poll()
+                    self.conn.notifies.clear()
+            except psycopg2.OperationalError as e:
+                logger.error(f"Job worker connection failed, reconnecting: {str(e)}")
+                if self.conn is not None:
+                    self.conn.close()
+                time.sleep(self.poll)
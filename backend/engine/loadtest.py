@@ -0,0 +1,329 @@
+import asyncio
+import io
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# Named request mix entries; anything starting with "/" is used as a literal path
+ENDPOINTS = {
+    'segmentation': '/api/segmentation/',
+    'segmentation-summary': '/api/segmentation/?summary=1',
+    'loan-risk': '/api/loan-risk/',
+    'loan-risk-summary': '/api/loan-risk/?summary=1',
+    'fee-optimization': '/api/fee-optimization/',
+    'fee-summary': '/api/fee-optimization/?summary=1',
+    'health': '/health/',
+}
+DEFAULT_MIX = 'segmentation-summary=2,loan-risk-summary=2,fee-summary=2,health=4'
+
+# (table, primary key, customer foreign key) in load order
+SEED_TABLES = [
+    ('customers', 'customer_id', None),
+    ('savings_accounts', 'account_id', 'customer_id'),
+    ('card_transactions', 'transaction_id', 'customer_id'),
+    ('loans', 'loan_id', 'customer_id'),
+    ('fx_transactions', 'fx_id', 'customer_id'),
+]
+
+
+def parse_mix(spec):
+    """Parse "name=weight,..." into [(label, path, weight)]."""
+    mix = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, weight = item.rpartition('=')
+        if not name:
+            name, weight = weight, '1'
+        path = name if name.startswith('/') else ENDPOINTS.get(name)
+        if path is None:
+            raise ValueError(f'Unknown endpoint {name!r}; use one of {sorted(ENDPOINTS)} or a path')
+        mix.append((name, path, float(weight)))
+    if not mix or sum(weight for _, _, weight in mix) <= 0:
+        raise ValueError('The request mix needs at least one positive weight')
+    return mix
+
+
+def seed_database(data_dir, scale=1, force=False):
+    """Load the bundled CSVs ``scale`` times (with shifted keys) into empty tables.
+
+    Returns {table: rows} or None when the database already has customers and ``force``
+    was not given; with ``force`` the tables are truncated first.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM customers)")
+        if cursor.fetchone()[0]:
+            if not force:
+                return None
+            cursor.execute("TRUNCATE customers, savings_accounts, card_transactions, loans, fx_transactions, "
+                           "loan_scores, card_daily_rollups RESTART IDENTITY CASCADE")
+
+        loaded = {}
+        customer_span = None
+        for table, key, customer_key in SEED_TABLES:
+            frame = pd.read_csv(os.path.join(data_dir, f'{table}.csv'))
+            span = int(frame[key].max())
+            if table == 'customers':
+                customer_span = span
+            buffer = io.StringIO()
+            for copy in range(scale):
+                shifted = frame.copy()
+                shifted[key] += copy * span
+                if customer_key:
+                    shifted[customer_key] += copy * customer_span
+                shifted.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{key}'), MAX({key})) FROM {table}")
+            loaded[table] = len(frame) * scale
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    return loaded
+
+
+def start_server(kind, port, workers=2):
+    """Start runserver or gunicorn on 127.0.0.1:port and wait until /health/ answers."""
+    if kind == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', 'config.wsgi:application',
+                   '--bind', f'127.0.0.1:{port}', '--workers', str(workers)]
+    else:
+        command = [sys.executable, 'manage.py', 'runserver', '--noreload', f'127.0.0.1:{port}']
+    process = subprocess.Popen(command, cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{kind} exited with status {process.returncode}')
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/health/', timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise TimeoutError(f'{kind} did not become healthy on port {port}')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def process_tree_rss(pid):
+    """Resident set size in bytes of a process and its descendants, read from /proc."""
+    children = defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces; the parent pid follows the closing paren
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children[parent].append(int(entry))
+
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+        stack.extend(children.get(current, []))
+    return total
+
+
+class Connection:
+    """Minimal keep-alive HTTP/1.1 client connection on asyncio streams."""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def request(self, path, timeout):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(
+            f'GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n'
+            f'Accept: application/json\r\nConnection: keep-alive\r\n\r\n'.encode()
+        )
+        await self.writer.drain()
+        return await asyncio.wait_for(self._read_response(), timeout)
+
+    async def _read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('Server closed the connection')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        size = 0
+        if 'content-length' in headers:
+            size = int(headers['content-length'])
+            await self.reader.readexactly(size)
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(chunk_size + 2)
+                size += chunk_size
+                if chunk_size == 0:
+                    break
+        elif status not in (204, 304):
+            size = len(await self.reader.read())
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, size
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def _run(base_url, mix, rps, duration, concurrency, warmup, timeout, server_pid, rss_interval, seed):
+    parts = urlsplit(base_url)
+    host, port = parts.hostname, parts.port or 80
+    prefix = parts.path.rstrip('/')
+    rng = random.Random(seed)
+    labels = [label for label, _, _ in mix]
+    paths = {label: prefix + path for label, path, _ in mix}
+    weights = [weight for _, _, weight in mix]
+
+    pool = asyncio.Queue()
+    for _ in range(concurrency):
+        pool.put_nowait(Connection(host, port))
+    samples = []
+    rss = []
+    dropped = 0
+    started = time.perf_counter()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+
+    async def one(label, scheduled):
+        connection = await pool.get()
+        try:
+            status, size = await connection.request(paths[label], timeout)
+            error = None if status < 400 else f'HTTP {status}'
+        except Exception as e:
+            connection.close()
+            status, size, error = None, 0, type(e).__name__
+        finally:
+            pool.put_nowait(connection)
+        finished = time.perf_counter()
+        if scheduled >= measure_from:
+            # Latency is measured from the scheduled send time, so queueing behind a
+            # slow server counts against it instead of being hidden (open-loop load)
+            samples.append((label, scheduled - measure_from, finished - scheduled, status, size, error))
+
+    async def sample_rss():
+        while time.perf_counter() < stop_at:
+            rss.append((round(time.perf_counter() - measure_from, 2), process_tree_rss(server_pid)))
+            await asyncio.sleep(rss_interval)
+
+    rss_task = asyncio.create_task(sample_rss()) if server_pid else None
+    tasks = set()
+    # Poisson arrivals at the target rate
+    next_at = started
+    while next_at < stop_at:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(tasks) >= concurrency * 50:
+            # The server is far behind; stop queueing rather than exhausting client memory
+            dropped += 1
+        else:
+            label = rng.choices(labels, weights)[0]
+            task = asyncio.create_task(one(label, next_at))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        next_at += rng.expovariate(rps)
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout + 5)
+    if rss_task:
+        rss_task.cancel()
+    while not pool.empty():
+        pool.get_nowait().close()
+    return samples, rss, dropped
+
+
+def _latency_stats(latencies):
+    if not len(latencies):
+        return {}
+    ms = np.asarray(latencies) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(ms, 50)), 2),
+        'p95_ms': round(float(np.percentile(ms, 95)), 2),
+        'p99_ms': round(float(np.percentile(ms, 99)), 2),
+        'max_ms': round(float(ms.max()), 2),
+        'mean_ms': round(float(ms.mean()), 2),
+    }
+
+
+def summarize(samples, rss, dropped, duration, rps):
+    frame = pd.DataFrame(samples, columns=['endpoint', 'sent_at', 'latency', 'status', 'bytes', 'error'])
+    report = {
+        'target_rps': rps,
+        'duration_seconds': duration,
+        'requests': len(frame),
+        'dropped': dropped,
+        'throughput_rps': round(len(frame) / duration, 2) if duration else None,
+        'error_rate': round(float(frame['error'].notna().mean()), 4) if len(frame) else 0.0,
+        'latency': _latency_stats(frame['latency']),
+        'endpoints': {},
+        'timeline': [],
+    }
+    for label, rows in frame.groupby('endpoint'):
+        report['endpoints'][label] = {
+            'requests': len(rows),
+            'throughput_rps': round(len(rows) / duration, 2) if duration else None,
+            'error_rate': round(float(rows['error'].notna().mean()), 4),
+            'errors': {str(k): int(v) for k, v in rows['error'].value_counts().items()},
+            'avg_bytes': int(rows['bytes'].mean()),
+            **_latency_stats(rows['latency']),
+        }
+    # Per-second throughput and p95 so degradation over the run is visible
+    if len(frame):
+        frame['second'] = frame['sent_at'].astype(int)
+        for second, rows in frame.groupby('second'):
+            report['timeline'].append({
+                'second': int(second),
+                'requests': len(rows),
+                'errors': int(rows['error'].notna().sum()),
+                'p95_ms': round(float(np.percentile(rows['latency'], 95) * 1000), 2),
+            })
+    if rss:
+        report['rss_mb'] = [{'t': t, 'rss_mb': round(value / 1e6, 1)} for t, value in rss]
+        report['peak_rss_mb'] = round(max(value for _, value in rss) / 1e6, 1)
+    return report
+
+
+def run_load(base_url, mix, rps, duration, concurrency=32, warmup=2.0, timeout=30.0,
+             server_pid=None, rss_interval=1.0, seed=0):
+    """Replay ``mix`` against ``base_url`` at ``rps`` requests/second and return the report."""
+    samples, rss, dropped = asyncio.run(_run(base_url, mix, rps, duration, concurrency, warmup, timeout,
+                                             server_pid, rss_interval, seed))
+    return summarize(samples, rss, dropped, duration, rps)
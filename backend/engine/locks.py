@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from django.conf import settings
+from django.db import connection
+from rest_framework.utils.encoders import JSONEncoder
+
+from .db import database_url
+
+logger = logging.getLogger(__name__)
+
+# Lock names shared by every node
+SEGMENTATION = 'segmentation'
+BATCH_SCORING = 'batch_scoring'
+CARD_ROLLUPS = 'card_rollups'
+
+SAVE_SNAPSHOT_QUERY = """
+INSERT INTO recompute_snapshots (name, payload, started_at, completed_at, duration_seconds)
+VALUES (%s, %s, %s, clock_timestamp(), %s)
+ON CONFLICT (name) DO UPDATE SET
+    payload = EXCLUDED.payload,
+    started_at = EXCLUDED.started_at,
+    completed_at = EXCLUDED.completed_at,
+    duration_seconds = EXCLUDED.duration_seconds
+"""
+
+_held = threading.local()
+
+
+class LockTimeout(Exception):
+    """The lock stayed taken by another session for longer than the timeout."""
+
+
+def lock_key(name):
+    """Signed 64-bit advisory lock key for a lock name."""
+    return int.from_bytes(hashlib.sha1(f'engine:{name}'.encode()).digest()[:8], 'big', signed=True)
+
+
+def xact_lock(cursor, name):
+    """Take ``name`` until the cursor's transaction ends; other nodes wait for it to commit."""
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", [lock_key(name)])
+
+
+def _held_names():
+    if not hasattr(_held, 'names'):
+        _held.names = set()
+    return _held.names
+
+
+@contextmanager
+def _lock_session(name):
+    # Session locks live on their own connection: the work inside may commit, close or fork
+    # Django's connections without releasing the lock
+    conn = psycopg2.connect(database_url())
+    conn.autocommit = True
+    try:
+        yield conn.cursor()
+    finally:
+        conn.close()
+
+
+def _acquire(cursor, name, timeout):
+    cursor.execute("SET lock_timeout = %s", [f'{int(timeout * 1000)}ms'])
+    try:
+        cursor.execute("SELECT pg_advisory_lock(%s)", [lock_key(name)])
+    except psycopg2.errors.LockNotAvailable:
+        raise LockTimeout(f'{name} is still running elsewhere after {timeout}s')
+
+
+@contextmanager
+def advisory_lock(name, timeout=None):
+    """Hold the cluster-wide lock ``name`` for the block, waiting up to ``timeout`` seconds.
+
+    Re-entrant within a thread, so a locked command can call code that takes the same lock.
+    """
+    held = _held_names()
+    if name in held:
+        yield
+        return
+    timeout = settings.RECOMPUTE_LOCK_TIMEOUT_SECONDS if timeout is None else timeout
+    with _lock_session(name) as cursor:
+        _acquire(cursor, name, timeout)
+        held.add(name)
+        try:
+            yield
+        finally:
+            held.discard(name)
+
+
+def latest_snapshot(name, completed_after=None):
+    """(payload, completed_at) of the last completed run, optionally only if newer than a time."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT payload, completed_at FROM recompute_snapshots WHERE name = %s"
+                       + (" AND completed_at > %s" if completed_after is not None else ""),
+                       [name] + ([completed_after] if completed_after is not None else []))
+        row = cursor.fetchone()
+    return (json.loads(row[0]), row[1]) if row else None
+
+
+def single_flight(name, compute, snapshot=None, restore=None, mode=None, timeout=None):
+    """Run ``compute()`` at most once at a time across all nodes sharing the database.
+
+    A caller that finds the job running elsewhere either waits for it and takes its result
+    (mode 'wait'), or gets the last completed snapshot straight away (mode 'snapshot';
+    it waits when there is none yet). ``snapshot(result)`` gives the JSON-able data to
+    share (None to not share a failed run) and ``restore(data)`` turns it back into a
+    result. Returns (result, source) with source 'computed', 'waited' or 'snapshot'.
+    Raises LockTimeout when waiting takes longer than ``timeout`` seconds.
+    """
+    snapshot = snapshot or (lambda result: result)
+    restore = restore or (lambda data: data)
+    mode = mode or settings.RECOMPUTE_WAIT_MODE
+    held = _held_names()
+    if name in held:
+        return compute(), 'computed'
+
+    timeout = settings.RECOMPUTE_LOCK_TIMEOUT_SECONDS if timeout is None else timeout
+    with _lock_session(name) as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s), clock_timestamp()", [lock_key(name)])
+        acquired, requested_at = cursor.fetchone()
+        if not acquired:
+            if mode == 'snapshot':
+                previous = latest_snapshot(name)
+                if previous is not None:
+                    logger.info(f"{name} is running elsewhere; returning the snapshot from {previous[1]}")
+                    return restore(previous[0]), 'snapshot'
+            logger.info(f"{name} is running elsewhere; waiting for its result")
+            waited = time.perf_counter()
+            _acquire(cursor, name, timeout)
+            # The other run finished while we waited: share its result instead of redoing it
+            finished = latest_snapshot(name, completed_after=requested_at)
+            if finished is not None:
+                logger.info(f"Took the result of {name} from another node after "
+                            f"{time.perf_counter() - waited:.3f}s")
+                return restore(finished[0]), 'waited'
+
+        held.add(name)
+        try:
+            cursor.execute("SELECT clock_timestamp()")
+            started_at = cursor.fetchone()[0]
+            started = time.perf_counter()
+            result = compute()
+            data = snapshot(result)
+            if data is not None:
+                with connection.cursor() as django_cursor:
+                    django_cursor.execute(SAVE_SNAPSHOT_QUERY, [
+                        name, json.dumps(data, cls=JSONEncoder), started_at, time.perf_counter() - started
+                    ])
+            return result, 'computed'
+        finally:
+            held.discard(name)
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+import logging
+from engine import segmentation
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Assigns new and changed customers to the nearest persisted segmentation centroid'
+
+    def add_arguments(self, parser):
+        parser.add_argument('customer_ids', nargs='*', type=int, help='Only assign these customers')
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        try:
+            result = segmentation.assign(options['customer_ids'] or None, batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Assigned {result['assigned']} customers in {result['duration_seconds']}s: {result['clusters']}"
+            ))
+            drift = result['drift']
+            message = (f"Drift since {drift['fitted_at']}: dispersion ratio {drift['dispersion_ratio']}, "
+                       f"share shift {drift['share_shift']}, new fraction {drift['new_fraction']}")
+            if drift['refit_recommended']:
+                self.stdout.write(self.style.WARNING(message + ' - full refit recommended (run populate_clusters)'))
+            else:
+                self.stdout.write(message)
+        except Exception as e:
+            logger.error(f'Error in assign_clusters: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
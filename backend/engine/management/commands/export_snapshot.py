@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+import logging
+from engine import snapshots
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Exports a consistent Arrow snapshot of the analytics inputs for ANALYTICS_SOURCE=snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=None,
+                            help='Snapshots to keep, including this one (default: SNAPSHOT_KEEP)')
+
+    def handle(self, *args, **options):
+        try:
+            manifest = snapshots.export(keep=options['keep'])
+            for name, dataset in manifest['datasets'].items():
+                self.stdout.write(f"- {name}: {dataset['rows']} rows, {dataset['bytes'] / 1e6:.1f} MB")
+            self.stdout.write(self.style.SUCCESS(
+                f"Exported snapshot {manifest['name']} in {manifest['duration_seconds']}s"
+            ))
+        except Exception as e:
+            logger.error(f'Error in export_snapshot: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
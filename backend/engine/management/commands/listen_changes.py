@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+import logging
+from engine import changes
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = ('Listens for change notifications on customers, loans, savings_accounts and card_transactions '
+            'and incrementally updates card rollups, cached responses, loan scores and cluster labels')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--debounce', type=float, default=None,
+                            help='Seconds without new changes before recomputing (default CHANGE_FEED_DEBOUNCE_SECONDS)')
+        parser.add_argument('--max-delay', type=float, default=None,
+                            help='Longest a change waits during a burst (default CHANGE_FEED_MAX_DELAY_SECONDS)')
+        parser.add_argument('--skip-catch-up', action='store_true',
+                            help='Do not apply changes made before the listener started')
+
+    def handle(self, *args, **options):
+        def report(result):
+            self.stdout.write(', '.join(f'{key} {value}' for key, value in result.items()))
+
+        try:
+            changes.listen(on_batch=report, debounce=options['debounce'], max_delay=options['max_delay'],
+                           catch_up_first=not options['skip_catch_up'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped listening')
+        except Exception as e:
+            logger.error(f'Error in listen_changes: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import connections
+import json
+import logging
+import os
+from engine import loadtest
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = ('Replays a mix of analytics and health requests at a target rate against a local (or given) '
+            'server and reports throughput, latency percentiles, errors and server memory')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=None,
+                            help='Test an already running server instead of starting one (e.g. http://localhost:8000)')
+        parser.add_argument('--server', choices=['runserver', 'gunicorn'], default='gunicorn',
+                            help='Server to start locally when --url is not given')
+        parser.add_argument('--server-workers', type=int, default=2, help='gunicorn worker processes')
+        parser.add_argument('--server-pid', type=int, default=None,
+                            help='Sample the RSS of this process tree when testing an external --url')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--mix', default=loadtest.DEFAULT_MIX,
+                            help=f'Weighted endpoints, e.g. "{loadtest.DEFAULT_MIX}"; '
+                                 f'names: {", ".join(sorted(loadtest.ENDPOINTS))}, or a literal /path')
+        parser.add_argument('--rps', type=float, default=20, help='Target requests per second')
+        parser.add_argument('--duration', type=float, default=30, help='Measured seconds')
+        parser.add_argument('--warmup', type=float, default=2, help='Unmeasured seconds before measuring')
+        parser.add_argument('--concurrency', type=int, default=32, help='Client connections')
+        parser.add_argument('--timeout', type=float, default=30, help='Per-request timeout in seconds')
+        parser.add_argument('--seed-data', action='store_true',
+                            help='Load data/*.csv into the database first if it has no customers')
+        parser.add_argument('--seed-scale', type=int, default=1,
+                            help='Copies of the bundled data to load (with shifted ids) for a bigger book')
+        parser.add_argument('--reseed', action='store_true',
+                            help='Truncate the tables before seeding (destroys existing data)')
+        parser.add_argument('--random-seed', type=int, default=0, help='Seed for arrivals and the request mix')
+        parser.add_argument('--output', default=None, help='Write the full JSON report here')
+
+    def handle(self, *args, **options):
+        server = None
+        try:
+            mix = loadtest.parse_mix(options['mix'])
+            if options['seed_data'] or options['reseed']:
+                loaded = loadtest.seed_database(os.path.join(settings.BASE_DIR, 'data'),
+                                                scale=options['seed_scale'], force=options['reseed'])
+                if loaded is None:
+                    self.stdout.write('Database already has customers; not seeding (use --reseed to replace)')
+                else:
+                    for table, rows in loaded.items():
+                        self.stdout.write(f'Seeded {rows} rows into {table}')
+            connections.close_all()
+
+            base_url, server_pid = options['url'], options['server_pid']
+            if base_url is None:
+                server = loadtest.start_server(options['server'], options['port'], options['server_workers'])
+                base_url, server_pid = f"http://127.0.0.1:{options['port']}", server.pid
+                self.stdout.write(f"Started {options['server']} (pid {server.pid}) on {base_url}")
+
+            self.stdout.write(f"Sending ~{options['rps']} req/s for {options['duration']}s to {base_url}...")
+            report = loadtest.run_load(
+                base_url, mix, options['rps'], options['duration'],
+                concurrency=options['concurrency'],
+                warmup=options['warmup'],
+                timeout=options['timeout'],
+                server_pid=server_pid,
+                seed=options['random_seed']
+            )
+            if options['output']:
+                with open(options['output'], 'w') as f:
+                    json.dump(report, f, indent=2)
+
+            latency = report['latency']
+            for label, stats in sorted(report['endpoints'].items()):
+                self.stdout.write(
+                    f"- {label}: {stats['requests']} req, {stats['throughput_rps']} req/s, "
+                    f"errors {stats['error_rate']:.1%}, p50 {stats.get('p50_ms')}ms, "
+                    f"p95 {stats.get('p95_ms')}ms, p99 {stats.get('p99_ms')}ms"
+                )
+            if 'peak_rss_mb' in report:
+                self.stdout.write(f"Server RSS: {report['rss_mb'][0]['rss_mb']} MB at start, "
+                                  f"{report['rss_mb'][-1]['rss_mb']} MB at end, peak {report['peak_rss_mb']} MB")
+            summary = (f"{report['requests']} requests, {report['throughput_rps']} req/s "
+                       f"(target {report['target_rps']}), errors {report['error_rate']:.1%}, "
+                       f"p50 {latency.get('p50_ms')}ms, p95 {latency.get('p95_ms')}ms, p99 {latency.get('p99_ms')}ms")
+            if report['dropped']:
+                summary += f", {report['dropped']} requests not sent (client backlog full)"
+            self.stdout.write(self.style.SUCCESS(summary))
+        except Exception as e:
+            logger.error(f'Error in load_test: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
+        finally:
+            if server is not None:
+                loadtest.stop_server(server)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+import logging
+from engine import card_features
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = ('Converts card_transactions to monthly range partitions on transaction_date, '
+            'or adds upcoming monthly partitions if it is already partitioned')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3,
+                            help='Create partitions for this many months after the current one')
+        parser.add_argument('--keep-old', action='store_true',
+                            help='Keep the unpartitioned table as card_transactions_unpartitioned')
+
+    def handle(self, *args, **options):
+        try:
+            created = card_features.partition_table(options['months_ahead'], options['keep_old'])
+            for name in created:
+                self.stdout.write(f'Created partition {name}')
+            self.stdout.write(self.style.SUCCESS(f'card_transactions is partitioned ({len(created)} new partitions)'))
+        except Exception as e:
+            logger.error(f'Error in partition_card_transactions: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+import json
+import logging
+from engine.db import database_url
+from engine.profiling import TABLES, profile_database
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Profiles the tables in bounded memory with streaming, mergeable sketches and writes a JSON profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='/app/data_profile.json')
+        parser.add_argument('--tables', nargs='*', choices=list(TABLES), help='Tables to profile (default: all)')
+        parser.add_argument('--workers', type=int, default=4, help='Parallel scan processes')
+        parser.add_argument('--ranges-per-table', type=int, default=None,
+                            help='Key ranges each table is split into (default: --workers)')
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Rows fetched per chunk')
+        parser.add_argument('--bins', type=int, default=20, help='Histogram bins per numeric column')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Profiling tables...')
+        try:
+            profile = profile_database(
+                database_url(),
+                tables=options['tables'],
+                workers=options['workers'],
+                ranges_per_table=options['ranges_per_table'],
+                chunk_size=options['chunk_size'],
+                bins=options['bins']
+            )
+            with open(options['output'], 'w') as f:
+                json.dump(profile, f, indent=2, default=str)
+
+            for table, entry in profile['tables'].items():
+                self.stdout.write(f"- {table}: {entry['rows']} rows, {len(entry['columns'])} columns")
+            self.stdout.write(self.style.SUCCESS(
+                f"Profile written to {options['output']} in {profile['duration_seconds']}s"
+            ))
+        except Exception as e:
+            logger.error(f'Error in profile_data: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+import logging
+import time
+from engine import card_features
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Updates the per-customer daily card rollups behind the windowed card features'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild every rollup month by month')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running and refresh every INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        try:
+            full = options['full']
+            while True:
+                started = time.perf_counter()
+                written = card_features.refresh_rollups(full=full)
+                self.stdout.write(f'Wrote {written} rollup rows in {time.perf_counter() - started:.3f}s')
+                full = False
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+        except Exception as e:
+            logger.error(f'Error in refresh_card_rollups: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+import logging
+import time
+from engine import feature_store
+from engine.feature_store import CustomerFeatureStore
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Builds the shared-memory customer feature store and keeps it refreshed incrementally'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Rebuild the store from a full scan')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running and refresh every INTERVAL seconds')
+        parser.add_argument('--drop', action='store_true', help='Remove the shared-memory segment and exit')
+
+    def handle(self, *args, **options):
+        name = settings.FEATURE_STORE_NAME
+        try:
+            if options['drop']:
+                try:
+                    store = CustomerFeatureStore.attach(name, timeout=0)
+                except (FileNotFoundError, TimeoutError):
+                    self.stdout.write(f'Feature store {name} does not exist')
+                    return
+                store.unlink()
+                store.close()
+                self.stdout.write(self.style.SUCCESS(f'Dropped feature store {name}'))
+                return
+
+            store = None
+            if not options['rebuild']:
+                try:
+                    store = CustomerFeatureStore.attach(name, timeout=0)
+                except (FileNotFoundError, TimeoutError):
+                    pass
+            if store is None:
+                store = feature_store.build(name)
+                self.stdout.write(self.style.SUCCESS(f'Built feature store {name} with {len(store)} customers'))
+
+            while True:
+                started = time.perf_counter()
+                touched = feature_store.refresh(store)
+                if touched is None:
+                    store.close()
+                    store = feature_store.build(name)
+                    self.stdout.write(f'Rebuilt feature store {name} with {len(store)} customers')
+                else:
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(f'Refreshed {touched} customers in {elapsed:.3f}s')
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+
+        except Exception as e:
+            logger.error(f'Error in refresh_feature_store: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
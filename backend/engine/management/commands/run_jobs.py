@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+import logging
+import multiprocessing
+from engine import jobqueue
+
+logger = logging.getLogger(__name__)
+
+
+def _work(kinds, poll, burst):
+    jobqueue.Worker(kinds=kinds, poll=poll).work(burst=burst)
+
+
+class Command(BaseCommand):
+    help = ('Runs queued background jobs (segmentation, scoring, rollup refresh, snapshots, retraining); '
+            'start more processes or more copies of this command to add workers')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes to run')
+        parser.add_argument('--kinds', nargs='+', choices=sorted(jobqueue.HANDLERS), default=None,
+                            help='Only run jobs of these kinds')
+        parser.add_argument('--poll', type=float, default=None,
+                            help='Seconds between checks for retries coming due (default JOB_POLL_SECONDS)')
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is ready')
+
+    def handle(self, *args, **options):
+        def report(outcome):
+            line = f"Job {outcome['id']} ({outcome['kind']}) {outcome['status']} in {outcome['duration_seconds']}s"
+            if 'error' in outcome:
+                self.stdout.write(self.style.ERROR(f"{line}: {outcome['error']}"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"{line}: {outcome['result']}"))
+
+        try:
+            if options['processes'] <= 1:
+                jobqueue.Worker(kinds=options['kinds'], poll=options['poll']).work(on_job=report,
+                                                                                  burst=options['burst'])
+                return
+
+            # Workers are forked; do not let them inherit this process's database connection.
+            # They are not daemonic, so scoring jobs can start their own process pools
+            connections.close_all()
+            workers = [
+                multiprocessing.Process(target=_work, args=(options['kinds'], options['poll'], options['burst']),
+                                        name=f'job-worker-{i}')
+                for i in range(options['processes'])
+            ]
+            for worker in workers:
+                worker.start()
+            self.stdout.write(f"Started {len(workers)} job workers")
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped job workers')
+        except Exception as e:
+            logger.error(f'Error in run_jobs: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+import json
+import logging
+from engine import locks
+from engine.batch_scoring import score_book
+from engine.db import database_url
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Scores the whole loan book in parallel loan_id ranges and writes the results to loan_scores'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Scoring processes')
+        parser.add_argument('--ranges', type=int, default=None,
+                            help='loan_id ranges the book is split into (default: 4 per worker)')
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Loans read and scored per chunk')
+        parser.add_argument('--threads-per-worker', type=int, default=None,
+                            help='BLAS/OpenMP threads per process (default: cores / workers)')
+        parser.add_argument('--json', action='store_true', help='Print the full report as JSON')
+
+    def handle(self, *args, **options):
+        try:
+            # Workers are forked; do not let them inherit this process's database connection
+            connections.close_all()
+            # Only one node scores the book at a time; a second run started meanwhile waits
+            # and reports the first one's result instead of scoring everything again
+            report, source = locks.single_flight(locks.BATCH_SCORING, lambda: score_book(
+                database_url(),
+                workers=options['workers'],
+                ranges=options['ranges'],
+                chunk_size=options['chunk_size'],
+                threads_per_worker=options['threads_per_worker']
+            ), mode='wait')
+            if source != 'computed':
+                self.stdout.write(self.style.WARNING('Scoring was already running on another node; '
+                                                     'reporting its result'))
+            if options['json']:
+                self.stdout.write(json.dumps(report, indent=2))
+                return
+
+            for worker in report['per_worker']:
+                self.stdout.write(
+                    f"- worker {worker['pid']}: {worker['loans']} loans in {worker['ranges']} ranges, "
+                    f"{worker['loans_per_second']} loans/s (read {worker['read_seconds']}s, "
+                    f"score {worker['score_seconds']}s, write {worker['write_seconds']}s)"
+                )
+            self.stdout.write(self.style.SUCCESS(
+                f"Scored {report['loans']} loans with model {report['model_version']} in "
+                f"{report['duration_seconds']}s ({report['loans_per_second']} loans/s, "
+                f"{report['workers']} workers x {report['threads_per_worker']} threads)"
+            ))
+        except Exception as e:
+            logger.error(f'Error in score_loans: {str(e)}', exc_info=True)
+            self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
@@ -0,0 +1,219 @@
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from django.conf import settings
+from django.db import connection, connections
+
+from . import aggregates, approx, fees, schema, serving
+from . import db
+from .profiling import Moments, key_ranges
+from .scoring import AGE_MEDIAN_QUERY, RISK_CATEGORIES, load_artifacts, score_frames
+
+logger = logging.getLogger(__name__)
+
+# Summary inputs for one customer id range; every aggregate is restricted to the range so
+# partitions do not each scan the whole card and loan tables
+PARTITION_CUSTOMERS_QUERY = """
+SELECT c.customer_id, c.cluster, c.income, c.credit_score, c.is_diaspora,
+       COALESCE(s.savings_balance, 0) AS savings_balance,
+       COALESCE(s.activity_score, 0) AS activity_score,
+       COALESCE(ct.total_card_value, 0) AS total_card_value,
+       COALESCE(ct.transaction_count, 0) AS transaction_count,
+       COALESCE(l.total_loan_amount, 0) AS total_loan_amount
+FROM customers c
+LEFT JOIN savings_accounts s ON s.customer_id = c.customer_id
+LEFT JOIN (
+    SELECT customer_id, SUM(transaction_value) AS total_card_value, COUNT(*) AS transaction_count
+    FROM card_transactions WHERE customer_id BETWEEN :low AND :high GROUP BY customer_id
+) ct ON ct.customer_id = c.customer_id
+LEFT JOIN (
+    SELECT customer_id, SUM(loan_amount) AS total_loan_amount
+    FROM loans WHERE customer_id BETWEEN :low AND :high GROUP BY customer_id
+) l ON l.customer_id = c.customer_id
+WHERE c.customer_id BETWEEN :low AND :high
+"""
+
+PARTITION_LOANS = 'WHERE l.customer_id BETWEEN :low AND :high'
+INCOME_MEDIAN_QUERY = "SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY income) FROM customers"
+LOAN_COLUMNS = ['loan_id', 'customer_id', 'loan_amount', 'cluster', 'credit_score', 'income']
+
+LOAN_RISK_COLUMNS = ['default_probability', 'loan_amount', 'credit_score', 'income']
+FEE_COLUMNS = ['recommended_fee', 'expected_revenue', 'churn_risk', 'avg_default_probability']
+
+
+class Partial:
+    """Mergeable partial aggregates: Moments per (group, column) and integer counters.
+
+    Merging adds counters and combines moments with the parallel formulas, so the merged
+    result does not depend on how the customers were partitioned.
+    """
+
+    def __init__(self):
+        self.moments = {}
+        self.counts = defaultdict(int)
+
+    def add(self, frame, columns, by=None):
+        groups = frame.groupby(by, observed=True) if by else [(None, frame)]
+        for group, rows in groups:
+            group = None if group is None else int(group)
+            self.counts[('rows', group)] += len(rows)
+            for column in columns:
+                # Like AVG() and DataFrame.mean(), missing values are skipped
+                values = pd.to_numeric(rows[column], errors='coerce').astype(float).dropna()
+                self.moments.setdefault((group, column), Moments()).update(values.to_numpy())
+        return self
+
+    def merge(self, other):
+        for key, moments in other.moments.items():
+            self.moments.setdefault(key, Moments()).merge(moments)
+        for key, count in other.counts.items():
+            self.counts[key] += count
+        return self
+
+    def groups(self):
+        return sorted({group for group, _ in self.moments if group is not None})
+
+    def mean(self, group, column):
+        moments = self.moments.get((group, column))
+        return moments.mean if moments is not None and moments.n else None
+
+    def total(self, group, column):
+        moments = self.moments.get((group, column))
+        return moments.mean * moments.n if moments is not None else 0.0
+
+
+def parallel_workers(table):
+    """Worker processes worth using for a summary over ``table`` (1 means run in-process)."""
+    workers = settings.SUMMARY_WORKERS
+    if workers > 1 and approx.population(table) >= settings.SUMMARY_PARALLEL_MIN_ROWS:
+        return workers
+    return 1
+
+
+def _init_worker():
+    # Forked workers must open their own connections instead of sharing the parent's sockets
+    db.dispose(close=False)
+    # One native thread per worker process. This also keeps the model off the OpenMP pool
+    # inherited from a parent that scored with several threads, which would deadlock here
+    serving.pin_threads(1)
+
+
+def run(job, *args, workers=None):
+    """Map ``job(low, high, *args)`` over customer id ranges and merge the returned partials."""
+    started = time.perf_counter()
+    workers = parallel_workers('customers') if workers is None else workers
+    with db.get_engine().connect() as conn:
+        # More ranges than workers keeps the pool busy when ranges are uneven
+        ranges = key_ranges(conn, 'customers', 'customer_id', workers * 4 if workers > 1 else 1)
+    merged = Partial()
+    if workers > 1 and len(ranges) > 1:
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = [pool.submit(job, low, high, *args) for low, high in ranges]
+            for future in futures:
+                merged.merge(future.result())
+    else:
+        for low, high in ranges:
+            merged.merge(job(low, high, *args))
+    logger.info(f"Ran {job.__name__} over {len(ranges)} customer ranges with {workers} worker(s) "
+                f"in {time.perf_counter() - started:.3f}s")
+    return merged
+
+
+def loan_risk_partial(low, high, age_median):
+    artifacts = load_artifacts()
+    params = {'low': low, 'high': high}
+    query = fees.LOAN_QUERY.format(where=PARTITION_LOANS)
+    frames = schema.iter_frames(query, params, rows=schema.chunk_rows(query, params))
+    data = score_frames(frames, artifacts, keep=LOAN_COLUMNS, age_median=age_median)
+    partial = Partial()
+    if data.empty:
+        return partial
+    aggregates.persist_scores(data['loan_id'], data['customer_id'], data['default_probability'],
+                              data['risk_category'], artifacts.version)
+    partial.add(data, ['default_probability'])
+    partial.add(data[data['cluster'] != -1], LOAN_RISK_COLUMNS, by='cluster')
+    for category, count in data['risk_category'].value_counts().items():
+        partial.counts[('risk', category)] += int(count)
+    return partial
+
+
+def fee_partial(low, high, income_median, age_median):
+    data = schema.read_frame(PARTITION_CUSTOMERS_QUERY, {'low': low, 'high': high})
+    partial = Partial()
+    if data.empty:
+        return partial
+    loan_risk = fees.customer_loan_risk(PARTITION_LOANS, {'low': low, 'high': high}, age_median)
+    data = fees.apply_policy(fees.prepare_customers(data, loan_risk, income_median))
+    partial.add(data, FEE_COLUMNS)
+    partial.add(data[data['cluster'] != -1], FEE_COLUMNS, by='cluster')
+    return partial
+
+
+def _median(query):
+    # Fill values every partition must share, computed once over all rows
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        value = cursor.fetchone()[0]
+    return float(value) if value is not None else None
+
+
+def loan_risk_summary(workers=None):
+    """Score every loan by customer partition (persisting the scores) and merge the summaries.
+
+    Returns the clusters and portfolio of LoanRiskView's summary. Raises FileNotFoundError
+    when the risk model is missing.
+    """
+    load_artifacts()
+    partial = run(loan_risk_partial, _median(AGE_MEDIAN_QUERY), workers=workers)
+    mean_probability = partial.mean(None, 'default_probability')
+    return {
+        'clusters': [
+            {
+                'cluster': int(cluster),
+                'avg_default_probability': partial.mean(cluster, 'default_probability'),
+                'loan_count': partial.counts[('rows', cluster)],
+                'avg_loan_amount': partial.mean(cluster, 'loan_amount'),
+                'avg_credit_score': partial.mean(cluster, 'credit_score'),
+                'avg_income': partial.mean(cluster, 'income'),
+            }
+            for cluster in partial.groups()
+        ],
+        'portfolio': {
+            'total_loans': partial.counts[('rows', None)],
+            **{f'{category.lower()}_risk_loans': partial.counts[('risk', category)]
+               for category in reversed(RISK_CATEGORIES)},
+            'avg_default_probability': round(mean_probability, 3) if mean_probability is not None else None,
+        },
+    }
+
+
+def fee_summary(workers=None):
+    """FeeOptimizationView's summary with each customer partition scored and priced separately.
+
+    Missing incomes are filled with the median over all customers, and missing ages with
+    the median over the loan book, as in the single pass.
+    """
+    partial = run(fee_partial, _median(INCOME_MEDIAN_QUERY), _median(AGE_MEDIAN_QUERY), workers=workers)
+    return {
+        'clusters': [
+            {
+                'cluster': int(cluster),
+                'avg_recommended_fee': partial.mean(cluster, 'recommended_fee'),
+                'total_revenue': partial.total(cluster, 'expected_revenue'),
+                'avg_churn_risk': partial.mean(cluster, 'churn_risk'),
+                'customer_count': partial.counts[('rows', cluster)],
+                'avg_default_probability': partial.mean(cluster, 'avg_default_probability'),
+            }
+            for cluster in partial.groups()
+        ],
+        'portfolio': {
+            'total_customers': partial.counts[('rows', None)],
+            'total_revenue': round(partial.total(None, 'expected_revenue'), 2),
+            'avg_recommended_fee': round(partial.mean(None, 'recommended_fee') or 0, 2),
+            'avg_churn_risk': round(partial.mean(None, 'churn_risk') or 0, 3),
+        },
+    }
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoanScore',
+            fields=[
+                ('loan_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('customer_id', models.IntegerField(db_index=True)),
+                ('model_version', models.CharField(db_index=True, max_length=40)),
+                ('default_probability', models.FloatField()),
+                ('risk_category', models.CharField(max_length=10)),
+                ('scored_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'loan_scores',
+            },
+        ),
+    ]
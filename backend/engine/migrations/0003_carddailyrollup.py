@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0002_loanscore'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customer_id', models.IntegerField()),
+                ('day', models.DateField(db_index=True)),
+                ('spend', models.FloatField()),
+                ('txn_count', models.IntegerField()),
+                ('fx_spend', models.FloatField()),
+                ('fx_count', models.IntegerField()),
+                ('last_transaction_id', models.IntegerField(db_index=True)),
+            ],
+            options={
+                'db_table': 'card_daily_rollups',
+                'constraints': [models.UniqueConstraint(fields=('customer_id', 'day'), name='card_daily_rollups_customer_day')],
+            },
+        ),
+    ]
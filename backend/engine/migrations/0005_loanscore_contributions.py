@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0004_change_notify_triggers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loanscore',
+            name='contributions',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='loanscore',
+            name='contributions_key',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
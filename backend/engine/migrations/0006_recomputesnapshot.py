@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0005_loanscore_contributions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecomputeSnapshot',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('payload', models.TextField()),
+                ('started_at', models.DateTimeField()),
+                ('completed_at', models.DateTimeField()),
+                ('duration_seconds', models.FloatField()),
+            ],
+            options={
+                'db_table': 'recompute_snapshots',
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.1 on 2026-10-19 15:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0006_recomputesnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureDriftCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_version', models.CharField(max_length=40)),
+                ('source', models.CharField(max_length=20)),
+                ('day', models.DateField()),
+                ('feature', models.CharField(max_length=50)),
+                ('bin', models.IntegerField()),
+                ('count', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'feature_drift_counts',
+                'constraints': [models.UniqueConstraint(fields=('model_version', 'source', 'day', 'feature', 'bin'), name='feature_drift_counts_bin')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+TABLES = ['customers', 'loans', 'savings_accounts']
+
+# The source tables are created by db.sql, not by migrations, so only index the ones present
+CREATE_INDEXES = ';'.join(
+    f"DO $$ BEGIN IF to_regclass('{table}') IS NOT NULL THEN "
+    f"CREATE INDEX IF NOT EXISTS {table}_updated_at_idx ON {table} (updated_at); END IF; END $$"
+    for table in TABLES
+)
+DROP_INDEXES = ';'.join(f"DROP INDEX IF EXISTS {table}_updated_at_idx" for table in TABLES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0008_job'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_INDEXES, DROP_INDEXES),
+    ]
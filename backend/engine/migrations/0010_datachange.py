@@ -0,0 +1,26 @@
+# Generated by Django 5.1.1 on 2026-10-19 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0009_watermark_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('changed_at', models.DateTimeField(db_index=True)),
+                ('source', models.CharField(max_length=50)),
+                ('card_rewrites', models.JSONField(blank=True, default=list, null=True)),
+                ('clusters', models.JSONField(blank=True, default=list, null=True)),
+            ],
+            options={
+                'db_table': 'data_changes',
+            },
+        ),
+    ]
@@ -55,4 +55,112 @@ class CardTransaction(models.Model):
 
     class Meta:
         managed = False
-        db_table = 'card_transactions'
\ No newline at end of file
+        db_table = 'card_transactions'
+
+class LoanScore(models.Model):
+    # Latest model output per loan, written by the scoring paths so summaries can be
+    # aggregated in SQL instead of re-scoring the book
+    loan_id = models.IntegerField(primary_key=True)
+    customer_id = models.IntegerField(db_index=True)
+    model_version = models.CharField(max_length=40, db_index=True)
+    default_probability = models.FloatField()
+    risk_category = models.CharField(max_length=10)
+    scored_at = models.DateTimeField()
+    # Per-feature log-odds contributions (FEATURES order, then the bias) cached by the
+    # explanation endpoint, valid while model_version and the input hash still match
+    contributions = models.JSONField(null=True, blank=True)
+    contributions_key = models.CharField(max_length=40, null=True, blank=True)
+
+    class Meta:
+        db_table = 'loan_scores'
+
+class CardDailyRollup(models.Model):
+    # Per-customer daily card totals maintained incrementally from card_transactions, so
+    # trailing-window features read O(days) rows instead of every transaction
+    customer_id = models.IntegerField()
+    day = models.DateField(db_index=True)
+    spend = models.FloatField()
+    txn_count = models.IntegerField()
+    fx_spend = models.FloatField()
+    fx_count = models.IntegerField()
+    last_transaction_id = models.IntegerField(db_index=True)
+
+    class Meta:
+        db_table = 'card_daily_rollups'
+        constraints = [
+            models.UniqueConstraint(fields=['customer_id', 'day'], name='card_daily_rollups_customer_day'),
+        ]
+
+class RecomputeSnapshot(models.Model):
+    # Last completed result of a single-flight recompute (engine/locks.py), served to callers
+    # that find the job already running on another node
+    name = models.CharField(max_length=100, primary_key=True)
+    payload = models.TextField()
+    started_at = models.DateTimeField()
+    completed_at = models.DateTimeField()
+    duration_seconds = models.FloatField()
+
+    class Meta:
+        db_table = 'recompute_snapshots'
+
+class FeatureDriftCount(models.Model):
+    # Histogram counts of scored feature rows per model version, source and day, binned on
+    # the training reference (engine/drift.py); processes merge by adding into these rows
+    model_version = models.CharField(max_length=40)
+    source = models.CharField(max_length=20)
+    day = models.DateField()
+    feature = models.CharField(max_length=50)
+    bin = models.IntegerField()
+    count = models.BigIntegerField()
+
+    class Meta:
+        db_table = 'feature_drift_counts'
+        constraints = [
+            models.UniqueConstraint(fields=['model_version', 'source', 'day', 'feature', 'bin'],
+                                    name='feature_drift_counts_bin'),
+        ]
+
+class Job(models.Model):
+    # Background recompute queued in Postgres (engine/jobqueue.py); workers claim the next
+    # job with FOR UPDATE SKIP LOCKED, and each dedup key has at most one queued job
+    kind = models.CharField(max_length=50)
+    key = models.CharField(max_length=200)
+    payload = models.JSONField(default=dict)
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=10, default='queued')
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    run_after = models.DateTimeField()
+    created_at = models.DateTimeField()
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    wait_seconds = models.FloatField(null=True, blank=True)
+    duration_seconds = models.FloatField(null=True, blank=True)
+    worker = models.CharField(max_length=100, null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'jobs'
+        constraints = [
+            models.UniqueConstraint(fields=['key'], condition=models.Q(status='queued'), name='jobs_queued_key'),
+        ]
+        indexes = [
+            models.Index(fields=['-priority', 'run_after', 'id'], condition=models.Q(status='queued'),
+                         name='jobs_queued_order'),
+            models.Index(fields=['status', 'finished_at'], name='jobs_status_finished'),
+        ]
+
+class DataChange(models.Model):
+    # What a process changed in the source data or cluster labels (engine/changelog.py), so
+    # API workers in other containers see it: the newest id is part of the response cache's
+    # data version and the feature store applies rows past its watermark. Customer id lists
+    # are null when every customer is affected.
+    changed_at = models.DateTimeField(db_index=True)
+    source = models.CharField(max_length=50)
+    card_rewrites = models.JSONField(default=list, null=True, blank=True)
+    clusters = models.JSONField(default=list, null=True, blank=True)
+
+    class Meta:
+        db_table = 'data_changes'
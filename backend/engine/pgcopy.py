@@ -0,0 +1,147 @@
+"""Read query results with binary COPY straight into NumPy columns.
+
+The query is wrapped so every output field has a fixed width: NUMERIC is cast to float8,
+NULLs become a separate boolean flag next to a zero value, and strings with a known domain
+are sent as small integer codes. Every row of the COPY stream then has the same layout and
+the whole result decodes as one NumPy structured array, without a Python object per value.
+
+Kept free of Django so the standalone scripts can use it too.
+"""
+import io
+import logging
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+POSTGRES_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+# Postgres type oid -> (cast applied in the wrapper, big-endian wire format, zero value)
+FIXED_TYPES = {
+    16: ('bool', '?', 'false'),
+    20: ('int8', '>i8', '0'),
+    21: ('int2', '>i2', '0'),
+    23: ('int4', '>i4', '0'),
+    26: ('int8', '>i8', '0'),  # oid
+    700: ('float4', '>f4', '0'),
+    701: ('float8', '>f8', '0'),
+    1700: ('float8', '>f8', '0'),  # numeric
+    1082: ('date', '>i4', "'2000-01-01'"),
+    1114: ('timestamp', '>i8', "'2000-01-01'"),
+    1184: ('timestamptz', '>i8', "'2000-01-01+00'"),
+}
+TEXT_TYPES = {25, 1042, 1043}
+
+
+class UnsupportedQuery(Exception):
+    """The result has a column the binary reader cannot give a fixed width."""
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _literal(sql, params, cursor, dialect):
+    # COPY takes no bind parameters, so render them client-side the way psycopg2 would
+    compiled = text(sql).compile(dialect=dialect)
+    return cursor.mogrify(compiled.string, compiled.construct_params(params or {})).decode()
+
+
+def _plan(columns, categories):
+    """Wrapper expressions and the structured dtype of one COPY row."""
+    expressions, fields = [], [('_fields', '>i2')]
+    decoders = []
+    for index, (name, oid) in enumerate(columns):
+        column = f'q.{_quote(name)}'
+        if oid in TEXT_TYPES and name in categories:
+            domain = ', '.join("'" + str(value).replace("'", "''") + "'" for value in categories[name])
+            expressions.append(f'COALESCE(array_position(ARRAY[{domain}]::text[], {column}::text), 0)::int2')
+            fields += [(f'_len{index}', '>i4'), (f'v{index}', '>i2')]
+            decoders.append((name, 'category', index))
+            continue
+        if oid not in FIXED_TYPES:
+            raise UnsupportedQuery(f'column {name!r} has type oid {oid}')
+        cast, wire, zero = FIXED_TYPES[oid]
+        expressions += [f'{column} IS NULL', f'COALESCE({column}::{cast}, {zero}::{cast})']
+        fields += [(f'_nlen{index}', '>i4'), (f'n{index}', '?'), (f'_len{index}', '>i4'), (f'v{index}', wire)]
+        decoders.append((name, cast, index))
+    return ', '.join(expressions), np.dtype(fields), decoders
+
+
+def _decode(rows, decoders, categories):
+    data = {}
+    for name, kind, index in decoders:
+        values = rows[f'v{index}']
+        if kind == 'category':
+            data[name] = pd.Categorical.from_codes(values.astype(np.int16) - 1, categories=categories[name])
+            continue
+        nulls = rows[f'n{index}']
+        if kind in ('timestamp', 'timestamptz', 'date'):
+            if kind == 'date':
+                values = POSTGRES_EPOCH + values.astype(np.int64) * np.timedelta64(1, 'D')
+            else:
+                values = POSTGRES_EPOCH + values.astype(np.int64) * np.timedelta64(1, 'us')
+            column = pd.Series(values.astype('datetime64[ns]'))
+            if kind == 'timestamptz':
+                column = column.dt.tz_localize('UTC')
+            data[name] = column.mask(nulls) if nulls.any() else column
+        elif kind == 'bool':
+            data[name] = pd.arrays.BooleanArray(values.copy(), nulls.copy()) if nulls.any() else values.copy()
+        else:
+            values = values.astype(values.dtype.newbyteorder('='))
+            if nulls.any():
+                # Like the DB-API path: integer columns with NULLs come back as float64 with NaN
+                values = values.astype(np.float64)
+                values[nulls] = np.nan
+            data[name] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def read_copy(sql, params=None, bind=None, categories=None, chunk_rows=None, connection=None):
+    """Run ``sql`` (SQLAlchemy text with :name parameters) through binary COPY.
+
+    ``bind`` is a SQLAlchemy engine; ``categories`` maps string columns to their known
+    values, which arrive as categoricals (other values become missing). Returns a DataFrame,
+    or a generator of DataFrames of at most ``chunk_rows`` rows when that is given.
+    An open DB-API ``connection`` is read through and left open, so several queries can
+    share one transaction. Raises UnsupportedQuery when a column cannot be read this way.
+    """
+    categories = categories or {}
+    raw = connection or bind.raw_connection()
+    try:
+        with raw.cursor() as cursor:
+            query = _literal(sql, params, cursor, bind.dialect)
+            cursor.execute(f'SELECT * FROM ({query}) q LIMIT 0')
+            columns = [(col.name, col.type_code) for col in cursor.description]
+            if len({name for name, _ in columns}) != len(columns):
+                raise UnsupportedQuery('duplicate column names')
+            expressions, row_dtype, decoders = _plan(columns, categories)
+            buffer = io.BytesIO()
+            cursor.copy_expert(f'COPY (SELECT {expressions} FROM ({query}) q) TO STDOUT WITH (FORMAT binary)',
+                               buffer)
+        if connection is None:
+            raw.rollback()
+    finally:
+        if connection is None:
+            raw.close()
+
+    payload = buffer.getbuffer()
+    if bytes(payload[:len(SIGNATURE)]) != SIGNATURE:
+        raise ValueError('Not a binary COPY stream')
+    extension = int.from_bytes(payload[15:19], 'big')
+    offset = 19 + extension
+    count, remainder = divmod(len(payload) - offset - 2, row_dtype.itemsize)
+    if remainder or bytes(payload[-2:]) != b'\xff\xff':
+        raise ValueError('Unexpected binary COPY row layout')
+    rows = np.frombuffer(payload, dtype=row_dtype, count=count, offset=offset)
+    if count and (rows['_fields'] != (len(row_dtype.names) - 1) // 2).any():
+        raise ValueError('Unexpected field count in binary COPY stream')
+    logger.debug(f"COPY read {count} rows x {len(columns)} columns ({len(payload)} bytes)")
+
+    if chunk_rows is None:
+        return _decode(rows, decoders, categories)
+    return (_decode(rows[start:start + chunk_rows], decoders, categories)
+            for start in range(0, max(count, 1), chunk_rows))
@@ -0,0 +1,188 @@
+"""Revenue-maximizing fees under churn-vs-fee response curves fitted per cluster.
+
+Each cluster's churn probability at fee f is a logistic curve in the fee burden f / income,
+p(f) = sigmoid(a + b * f / income). A customer's expected revenue f * (1 - p(f)) has
+derivative (1 - p)(1 - s f p) with s = b / income, so for b > 0 it peaks where
+s * f * p(f) = 1; the left side only grows with f, so one bisection over all customers'
+brackets at once finds every optimum. A curve whose b is not clearly positive says
+nothing about how far a fee can rise before customers leave (the optimum would be the
+cap), so its customers keep the current rule's fee.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from sklearn.linear_model import LogisticRegression
+
+from .fees import DEFAULT_POLICY, customer_matrix, evaluate
+
+logger = logging.getLogger(__name__)
+
+POOLED = 'pooled'
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+def fee_burden(data, policy=None):
+    """Fee over income each customer faces under the rule, before its churn-risk cap.
+
+    The churn-risk cap is set from the churn label itself, so fitting against capped fees
+    would teach the curve that lower fees go with more churn.
+    """
+    policy = {**DEFAULT_POLICY, **(policy or {})}
+    policy['churn_cap_rate'] = policy['cap_rate']
+    customers = customer_matrix(data)
+    fee, _, _ = evaluate({key: [value] for key, value in policy.items()}, customers)
+    return fee[0] / np.maximum(customers['income'], 1)
+
+
+def _fit(burden, churned):
+    if len(churned) < settings.FEE_RESPONSE_MIN_CUSTOMERS or churned.min() == churned.max():
+        return None
+    # Burdens are a few percent, so fit on a standardized copy and unscale the slope
+    scale = burden.std() or 1.0
+    x = burden / scale
+    model = LogisticRegression(C=1e4).fit(x[:, None], churned)
+    # Standard error of the slope from the inverse Fisher information
+    p = model.predict_proba(x[:, None])[:, 1]
+    w = p * (1 - p)
+    information = np.array([[w.sum(), (w * x).sum()], [(w * x).sum(), (w * x * x).sum()]])
+    try:
+        se = float(np.sqrt(np.linalg.inv(information)[1, 1])) / scale
+    except np.linalg.LinAlgError:
+        se = np.inf
+    return float(model.intercept_[0]), float(model.coef_[0, 0]) / scale, se
+
+
+def fit_response_curves(data, policy=None):
+    """Churn response curve per cluster from the customers' churn labels and fee burdens.
+
+    Clusters with too few customers, or only churners or only stayers, use the curve fitted
+    over all customers. A curve is identified only when its slope, less FEE_RESPONSE_SLOPE_Z
+    standard errors, exceeds FEE_RESPONSE_MIN_SLOPE: churn that does not clearly rise with
+    the fee burden gives no optimum below the cap, so those customers stay on the rule.
+    """
+    burden = fee_burden(data, policy)
+    churned = data['churn_risk'].to_numpy(dtype=int)
+    clusters = data['cluster'].to_numpy(dtype=float).astype(int)
+
+    pooled = _fit(burden, churned)
+    if pooled is None:
+        rate = np.clip(churned.mean() if len(churned) else 0.0, 1e-3, 1 - 1e-3)
+        pooled = (float(np.log(rate / (1 - rate))), 0.0, np.inf)
+
+    curves = {}
+    for cluster in [POOLED] + sorted(set(clusters[clusters >= 0].tolist())):
+        members = np.ones(len(clusters), dtype=bool) if cluster == POOLED else clusters == cluster
+        fitted = pooled if cluster == POOLED else _fit(burden[members], churned[members])
+        intercept, slope, se = fitted or pooled
+        curves[cluster] = {
+            'intercept': round(intercept, 6),
+            'slope': round(slope, 6),
+            'slope_se': round(se, 6) if np.isfinite(se) else None,
+            'identified': bool(slope - settings.FEE_RESPONSE_SLOPE_Z * se > settings.FEE_RESPONSE_MIN_SLOPE),
+            'pooled': fitted is None,
+            'customers': int(members.sum()),
+            'churn_rate': round(float(churned[members].mean()), 4) if members.any() else 0.0,
+        }
+    return curves
+
+
+def _curve_arrays(curves, clusters):
+    ids = np.array([c for c in curves if c != POOLED], dtype=int)
+    intercepts = np.array([curves[c]['intercept'] for c in ids] + [curves[POOLED]['intercept']])
+    slopes = np.array([curves[c]['slope'] for c in ids] + [curves[POOLED]['slope']])
+    identified = np.array([curves[c]['identified'] for c in ids] + [curves[POOLED]['identified']], dtype=bool)
+    # Customers outside the fitted clusters (unassigned, or new since the fit) use the pooled curve
+    index = np.full(len(clusters), len(ids))
+    if len(ids):
+        position = np.minimum(np.searchsorted(ids, clusters), len(ids) - 1)
+        index = np.where(ids[position] == clusters, position, index)
+    return intercepts[index], slopes[index], identified[index]
+
+
+def optimal_fees(data, curves, policy=None, iterations=None):
+    """Each customer's revenue-maximizing fee within the rule's caps, next to the rule's own fee.
+
+    Returns a frame with current_fee / current_revenue (the rule under the fitted curves),
+    optimal_fee, churn_probability, expected_revenue and uplift per customer. Customers
+    whose curve is not identified keep the rule's fee, with churn taken as flat in the fee
+    and no uplift.
+    """
+    policy = {**DEFAULT_POLICY, **(policy or {})}
+    customers = customer_matrix(data)
+    income = np.maximum(customers['income'], 1)
+    intercept, slope, identified = _curve_arrays(curves, customers['cluster'].astype(int))
+    rate = np.where(identified, slope, 0.0) / income
+
+    # The same caps the rule applies: a share of income, within [min_fee, max_fee]
+    cap = income * np.where(customers['churn_risk'] > 0.5, policy['churn_cap_rate'], policy['cap_rate'])
+    low = np.full(len(income), float(policy['min_fee']))
+    high = np.maximum(low, np.minimum(cap, policy['max_fee']))
+
+    def excess(fee):
+        return rate * fee * _sigmoid(intercept + rate * fee) - 1
+
+    # Revenue is still rising at the cap, or already falling at the floor
+    at_high = excess(high) <= 0
+    at_low = excess(low) >= 0
+    lo, hi = low.copy(), high.copy()
+    for _ in range(iterations or settings.FEE_SOLVER_ITERATIONS):
+        mid = (lo + hi) / 2
+        rising = excess(mid) < 0
+        lo = np.where(rising, mid, lo)
+        hi = np.where(rising, hi, mid)
+        if (hi - lo).max(initial=0) < 0.005:
+            break
+    fee = np.where(at_high, high, np.where(at_low, low, (lo + hi) / 2)).round(2)
+
+    current_fee, _, _ = evaluate({key: [value] for key, value in policy.items()}, customers)
+    current_fee = current_fee[0]
+    fee = np.where(identified, fee, current_fee)
+    churn_probability = _sigmoid(intercept + rate * fee)
+    current_revenue = current_fee * (1 - _sigmoid(intercept + rate * current_fee))
+    revenue = fee * (1 - churn_probability)
+    return pd.DataFrame({
+        'customer_id': data['customer_id'].to_numpy(),
+        'cluster': customers['cluster'],
+        'current_fee': current_fee,
+        'current_revenue': current_revenue,
+        'optimal_fee': fee,
+        'churn_probability': churn_probability,
+        'expected_revenue': revenue,
+        'uplift': revenue - current_revenue,
+        'identified': identified,
+    })
+
+
+def solve(data, policy=None):
+    """Fit the curves and price every customer; returns (per-customer frame, summary)."""
+    curves = fit_response_curves(data, policy)
+    logger.info(f"Fitted churn response curves for {len(curves) - 1} clusters")
+    result = optimal_fees(data, curves, policy)
+
+    def totals(rows):
+        current, optimal = float(rows['current_revenue'].sum()), float(rows['expected_revenue'].sum())
+        return {
+            'customers': len(rows),
+            'priced': int(rows['identified'].sum()),
+            'avg_current_fee': round(float(rows['current_fee'].mean()), 2) if len(rows) else 0.0,
+            'avg_optimal_fee': round(float(rows['optimal_fee'].mean()), 2) if len(rows) else 0.0,
+            'expected_churn': round(float(rows['churn_probability'].sum()), 2),
+            'current_revenue': round(current, 2),
+            'expected_revenue': round(optimal, 2),
+            'uplift': round(optimal - current, 2),
+            'uplift_pct': round((optimal - current) / current * 100, 2) if current else None,
+        }
+
+    clusters = {}
+    for cluster, rows in result[result['cluster'] >= 0].groupby('cluster'):
+        clusters[f'Cluster {cluster}'] = {**totals(rows), 'curve': curves.get(int(cluster), curves[POOLED])}
+    return result, {
+        'portfolio': totals(result),
+        'clusters': clusters,
+        'pooled_curve': curves[POOLED],
+    }
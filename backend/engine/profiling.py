@@ -0,0 +1,425 @@
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from . import pgcopy
+
+# Mergeable streaming sketches: each one can be updated chunk by chunk and partial
+# results from parallel scans combined exactly (moments, histograms, distinct-count
+# registers) or within the sketch's error bound (quantiles).
+
+
+class Moments:
+    """Count, mean and central moments up to the 4th, merged with Pebay's formulas."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return
+        other = Moments()
+        other.n = len(values)
+        other.mean = float(values.mean())
+        deltas = values - other.mean
+        other.m2 = float((deltas ** 2).sum())
+        other.m3 = float((deltas ** 3).sum())
+        other.m4 = float((deltas ** 4).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        self.merge(other)
+
+    def merge(self, other):
+        if not other.n:
+            return self
+        if not self.n:
+            self.__dict__.update(other.__dict__)
+            return self
+        n_a, n_b = self.n, other.n
+        n = n_a + n_b
+        delta = other.mean - self.mean
+        delta_n = delta / n
+        m2 = self.m2 + other.m2 + delta * delta_n * n_a * n_b
+        m3 = (self.m3 + other.m3 + delta * delta_n ** 2 * n_a * n_b * (n_a - n_b)
+              + 3 * delta_n * (n_a * other.m2 - n_b * self.m2))
+        m4 = (self.m4 + other.m4
+              + delta * delta_n ** 3 * n_a * n_b * (n_a * n_a - n_a * n_b + n_b * n_b)
+              + 6 * delta_n ** 2 * (n_a * n_a * other.m2 + n_b * n_b * self.m2)
+              + 4 * delta_n * (n_a * other.m3 - n_b * self.m3))
+        self.n, self.mean, self.m2, self.m3, self.m4 = n, self.mean + delta_n * n_b, m2, m3, m4
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def to_dict(self):
+        if not self.n:
+            return {'count': 0}
+        variance = self.m2 / self.n
+        return {
+            'count': self.n,
+            'mean': self.mean,
+            'std': math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0,
+            'min': self.min,
+            'max': self.max,
+            'skewness': math.sqrt(self.n) * self.m3 / self.m2 ** 1.5 if self.m2 else 0.0,
+            'kurtosis': self.n * self.m4 / self.m2 ** 2 - 3 if self.m2 else 0.0,
+            '_variance': variance,
+        }
+
+
+class QuantileSketch:
+    """Relative-error quantile sketch (DDSketch): log-spaced buckets, merged by adding counts."""
+
+    def __init__(self, relative_accuracy=0.01):
+        self.alpha = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.n = 0
+
+    def _add(self, store, magnitudes):
+        keys, counts = np.unique(np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        tiny = 1e-12
+        self._add(self.positive, values[values > tiny])
+        self._add(self.negative, -values[values < -tiny])
+        self.zeros += int((np.abs(values) <= tiny).sum())
+
+    def merge(self, other):
+        for mine, theirs in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in theirs.items():
+                mine[key] = mine.get(key, 0) + count
+        self.zeros += other.zeros
+        self.n += other.n
+        return self
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        if not self.n:
+            return None
+        rank = q * (self.n - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive)) if self.positive else 0.0
+
+
+class HyperLogLog:
+    """Distinct-count sketch; merging takes the register-wise maximum."""
+
+    def __init__(self, precision=12):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+    def update(self, values):
+        values = pd.Series(values).dropna()
+        if not len(values):
+            return
+        hashes = pd.util.hash_array(values.to_numpy())
+        index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = (hashes << np.uint64(self.p)) & np.uint64(0xFFFFFFFFFFFFFFFF)
+        # Position of the leftmost 1-bit in the remaining 64 - p bits
+        bit_length = np.zeros(len(rest), dtype=np.int64)
+        nonzero = rest > 0
+        bit_length[nonzero] = np.floor(np.log2(rest[nonzero].astype(float))).astype(np.int64) + 1
+        rank = np.minimum(64 - bit_length + 1, 64 - self.p + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / np.sum(2.0 ** -self.registers.astype(float))
+        zeros = int((self.registers == 0).sum())
+        if estimate <= 2.5 * self.m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+
+class Histogram:
+    """Fixed-edge histogram, optionally with the count of positive targets per bin."""
+
+    def __init__(self, low, high, bins=20):
+        if high <= low:
+            high = low + 1
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.positives = np.zeros(bins, dtype=np.int64)
+
+    def update(self, values, target=None):
+        values = np.asarray(values, dtype=float)
+        keep = ~np.isnan(values)
+        bins = np.clip(np.searchsorted(self.edges, values[keep], side='right') - 1, 0, len(self.counts) - 1)
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+        if target is not None:
+            self.positives += np.bincount(bins, weights=np.asarray(target)[keep], minlength=len(self.counts)).astype(np.int64)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.positives += other.positives
+        return self
+
+    def to_dict(self, with_target):
+        result = {'edges': self.edges.round(6).tolist(), 'counts': self.counts.tolist()}
+        if with_target:
+            result['target_rate'] = [
+                round(p / c, 4) if c else None for p, c in zip(self.positives.tolist(), self.counts.tolist())
+            ]
+        return result
+
+
+class ColumnProfile:
+    def __init__(self, kind, bounds=None, target=None, bins=20):
+        self.kind = kind
+        self.nulls = 0
+        self.distinct = HyperLogLog()
+        self.target = target
+        if kind == 'numeric':
+            self.moments = Moments()
+            self.quantiles = QuantileSketch()
+            self.histogram = Histogram(*bounds, bins=bins) if bounds else None
+            # Moments split by target class give the exact point-biserial correlation
+            self.by_target = {0: Moments(), 1: Moments()} if target else None
+        else:
+            self.values = {}
+
+    def update(self, column, target_values=None):
+        self.nulls += int(column.isna().sum())
+        self.distinct.update(column)
+        if self.kind == 'numeric':
+            values = pd.to_numeric(column, errors='coerce').to_numpy(dtype=float)
+            present = ~np.isnan(values)
+            self.moments.update(values[present])
+            self.quantiles.update(values[present])
+            if self.histogram is not None:
+                self.histogram.update(values, target_values)
+            if self.by_target is not None and target_values is not None:
+                for label in (0, 1):
+                    self.by_target[label].update(values[present & (target_values == label)])
+        else:
+            for value, count in column.value_counts().items():
+                self.values[value] = self.values.get(value, 0) + int(count)
+
+    def merge(self, other):
+        self.nulls += other.nulls
+        self.distinct.merge(other.distinct)
+        if self.kind == 'numeric':
+            self.moments.merge(other.moments)
+            self.quantiles.merge(other.quantiles)
+            if self.histogram is not None:
+                self.histogram.merge(other.histogram)
+            if self.by_target is not None:
+                for label in (0, 1):
+                    self.by_target[label].merge(other.by_target[label])
+        else:
+            for value, count in other.values.items():
+                self.values[value] = self.values.get(value, 0) + count
+        return self
+
+    def to_dict(self):
+        result = {'nulls': self.nulls, 'distinct_estimate': self.distinct.estimate()}
+        if self.kind != 'numeric':
+            result['top_values'] = dict(sorted(self.values.items(), key=lambda item: -item[1])[:20])
+            return result
+        stats = self.moments.to_dict()
+        variance = stats.pop('_variance', None)
+        result.update(stats)
+        result['quantiles'] = {
+            f'p{int(q * 100):02d}': self.quantiles.quantile(q) for q in (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+        }
+        if self.histogram is not None:
+            result['histogram'] = self.histogram.to_dict(self.target is not None)
+        if self.by_target is not None and variance:
+            n0, n1 = self.by_target[0].n, self.by_target[1].n
+            if n0 and n1:
+                p = n1 / (n0 + n1)
+                result[f'correlation_with_{self.target}'] = (
+                    (self.by_target[1].mean - self.by_target[0].mean) * math.sqrt(p * (1 - p)) / math.sqrt(variance)
+                )
+        return result
+
+
+# Each table is scanned with one query per key range; numeric columns are cast to float8
+# in SQL so chunks arrive as floats rather than Decimal objects
+TABLES = {
+    'customers': {
+        'key': 'customer_id',
+        'query': """
+            SELECT customer_id, age::float8 AS age, income::float8 AS income, credit_score::float8 AS credit_score,
+                   is_diaspora::int::float8 AS is_diaspora, cluster::float8 AS cluster, segment, preferred_currency
+            FROM customers WHERE customer_id BETWEEN :low AND :high
+        """,
+        'numeric': ['age', 'income', 'credit_score', 'is_diaspora', 'cluster'],
+        'categorical': ['segment', 'preferred_currency'],
+    },
+    'savings_accounts': {
+        'key': 'account_id',
+        'query': """
+            SELECT account_id, savings_balance::float8 AS savings_balance,
+                   monthly_deposit::float8 AS monthly_deposit, activity_score::float8 AS activity_score
+            FROM savings_accounts WHERE account_id BETWEEN :low AND :high
+        """,
+        'numeric': ['savings_balance', 'monthly_deposit', 'activity_score'],
+        'categorical': [],
+    },
+    'card_transactions': {
+        'key': 'transaction_id',
+        'query': """
+            SELECT transaction_id, transaction_value::float8 AS transaction_value,
+                   is_fx_transaction::int::float8 AS is_fx_transaction, category
+            FROM card_transactions WHERE transaction_id BETWEEN :low AND :high
+        """,
+        'numeric': ['transaction_value', 'is_fx_transaction'],
+        'categorical': ['category'],
+    },
+    'loans': {
+        'key': 'loan_id',
+        'target': 'loan_default',
+        'query': """
+            SELECT l.loan_id, l.loan_amount::float8 AS loan_amount, l.interest_rate::float8 AS interest_rate,
+                   l.loan_tenure_months::float8 AS loan_tenure_months, c.income::float8 AS income,
+                   c.credit_score::float8 AS credit_score, s.activity_score::float8 AS activity_score,
+                   COALESCE(ct.total_card_value, 0)::float8 AS total_card_value,
+                   c.is_diaspora::int::float8 AS is_diaspora, c.age::float8 AS age, c.segment,
+                   l.loan_default::int AS loan_default
+            FROM loans l
+            JOIN customers c ON l.customer_id = c.customer_id
+            LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
+            LEFT JOIN (
+                SELECT customer_id, SUM(transaction_value) AS total_card_value
+                FROM card_transactions GROUP BY customer_id
+            ) ct ON ct.customer_id = c.customer_id
+            WHERE l.loan_id BETWEEN :low AND :high
+        """,
+        'numeric': ['loan_amount', 'interest_rate', 'loan_tenure_months', 'income', 'credit_score',
+                    'activity_score', 'total_card_value', 'is_diaspora', 'age'],
+        'categorical': ['segment'],
+    },
+}
+
+
+def _bounds_query(spec):
+    # Histogram edges come from an in-database MIN/MAX pass over the same rows
+    columns = ', '.join(f'MIN(q.{col}), MAX(q.{col})' for col in spec['numeric'])
+    return f"SELECT {columns} FROM ({spec['query']}) q"
+
+
+def key_ranges(conn, table, key, parts):
+    low, high = conn.execute(text(f'SELECT MIN({key}), MAX({key}) FROM {table}')).one()
+    if low is None:
+        return []
+    step = max(1, math.ceil((high - low + 1) / parts))
+    return [(start, min(start + step - 1, high)) for start in range(low, high + 1, step)]
+
+
+def profile_range(database_url, table, low, high, bounds, chunk_size, bins):
+    """Scan one key range of a table in chunks and return its partial profile."""
+    spec = TABLES[table]
+    target = spec.get('target')
+    columns = {col: ColumnProfile('numeric', bounds.get(col), target, bins) for col in spec['numeric']}
+    columns.update({col: ColumnProfile('categorical') for col in spec['categorical']})
+    target_counts = {0: 0, 1: 0}
+    rows = 0
+
+    engine = create_engine(database_url)
+    try:
+        with engine.connect().execution_options(stream_results=True, max_row_buffer=chunk_size) as conn:
+            params = {'low': low, 'high': high}
+            try:
+                # Free-text columns are not sent as codes here, so unexpected values stay visible
+                chunks = pgcopy.read_copy(spec['query'], params, bind=engine, chunk_rows=chunk_size)
+            except pgcopy.UnsupportedQuery:
+                chunks = pd.read_sql(text(spec['query']), conn, params=params, chunksize=chunk_size)
+            for chunk in chunks:
+                rows += len(chunk)
+                target_values = chunk[target].to_numpy() if target else None
+                if target:
+                    target_counts[1] += int(target_values.sum())
+                    target_counts[0] += int(len(target_values) - target_values.sum())
+                for col, profile in columns.items():
+                    profile.update(chunk[col], target_values)
+    finally:
+        engine.dispose()
+    return table, rows, columns, target_counts
+
+
+def profile_database(database_url, tables=None, workers=4, ranges_per_table=None, chunk_size=50000, bins=20):
+    """Profile tables in parallel key-range scans and merge the partial sketches."""
+    started = time.perf_counter()
+    tables = tables or list(TABLES)
+    ranges_per_table = ranges_per_table or workers
+    engine = create_engine(database_url)
+    tasks = []
+    with engine.connect() as conn:
+        for table in tables:
+            spec = TABLES[table]
+            ranges = key_ranges(conn, table, spec['key'], ranges_per_table)
+            if not ranges:
+                continue
+            values = conn.execute(text(_bounds_query(spec)), {'low': ranges[0][0], 'high': ranges[-1][1]}).one()
+            bounds = {
+                col: (values[2 * i], values[2 * i + 1])
+                for i, col in enumerate(spec['numeric']) if values[2 * i] is not None
+            }
+            tasks.extend((table, low, high, bounds) for low, high in ranges)
+    engine.dispose()
+
+    merged = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(profile_range, database_url, table, low, high, bounds, chunk_size, bins)
+                   for table, low, high, bounds in tasks]
+        for future in futures:
+            table, rows, columns, target_counts = future.result()
+            if table not in merged:
+                merged[table] = {'rows': rows, 'columns': columns, 'target_counts': target_counts}
+                continue
+            merged[table]['rows'] += rows
+            for label, count in target_counts.items():
+                merged[table]['target_counts'][label] += count
+            for col, profile in columns.items():
+                merged[table]['columns'][col].merge(profile)
+
+    profile = {'generated_at': pd.Timestamp.now(tz='UTC').isoformat(), 'tables': {}}
+    for table, result in merged.items():
+        entry = {'rows': result['rows'], 'columns': {col: p.to_dict() for col, p in result['columns'].items()}}
+        target = TABLES[table].get('target')
+        if target and result['rows']:
+            entry['class_distribution'] = {
+                str(label): round(count / result['rows'], 4) for label, count in result['target_counts'].items()
+            }
+        profile['tables'][table] = entry
+    profile['duration_seconds'] = round(time.perf_counter() - started, 3)
+    return profile
@@ -0,0 +1,170 @@
+import json
+import logging
+
+import pandas as pd
+from django.conf import settings
+from sqlalchemy import text
+
+from . import columnar, pgcopy, snapshots
+from .db import get_engine
+
+logger = logging.getLogger(__name__)
+
+SEGMENTS = ('High Net Worth', 'Low Income', 'Middle Class')
+CURRENCIES = ('KES', 'USD', 'EUR', 'GBP')
+
+# Compact dtypes for the columns the analytics queries return. Conversions are exact:
+# INTEGER columns become (nullable) 32/16-bit ints, small codes float32, and strings with
+# a known domain categoricals. Fractional model inputs (interest_rate, activity_score) stay
+# float64 because rounding them to float32 changes the model's scores.
+DTYPES = {
+    'customer_id': 'int32',
+    'loan_id': 'int32',
+    'account_id': 'int32',
+    'transaction_id': 'int32',
+    'income': 'Int32',
+    'loan_amount': 'Int32',
+    'savings_balance': 'Int32',
+    'monthly_deposit': 'Int32',
+    'credit_score': 'Int16',
+    'age': 'Int16',
+    'loan_tenure_months': 'Int16',
+    'transaction_count': 'int32',
+    'cluster': 'Int16',  # NA for unassigned; the views fill it with -1
+    'interest_rate': 'float64',
+    'activity_score': 'float64',
+    'total_card_value': 'float64',
+    'total_loan_amount': 'float64',
+    'transaction_value': 'float64',
+    'segment': pd.CategoricalDtype(SEGMENTS),
+    'preferred_currency': pd.CategoricalDtype(CURRENCIES),
+    'is_diaspora': 'bool',
+    'loan_default': 'bool',
+    'is_fx_transaction': 'bool',
+}
+
+# String columns with a known domain, read as categorical codes by the binary COPY reader
+CATEGORIES = {column: list(dtype.categories) for column, dtype in DTYPES.items()
+              if isinstance(dtype, pd.CategoricalDtype)}
+
+# Peak pandas working set relative to the raw row width (wide read, features, scaled copy)
+WORKING_SET_FACTOR = 4
+
+
+def compact(frame):
+    """Convert known columns to their compact dtypes in place and return the frame."""
+    for column in frame.columns:
+        dtype = DTYPES.get(column)
+        if dtype is None or frame[column].dtype == dtype:
+            continue
+        values = frame[column]
+        if values.dtype == object and not isinstance(dtype, pd.CategoricalDtype):
+            # Decimal objects from NUMERIC columns
+            values = pd.to_numeric(values, errors='coerce')
+        if dtype == 'bool' and values.isna().any():
+            values = values.fillna(False)
+        frame[column] = values.astype(dtype)
+    return frame
+
+
+def frame_bytes(frame):
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+
+def estimate(sql, params=None):
+    """(rows, bytes per row) from the planner, without running the query."""
+    mapped = snapshots.shape(sql, params)
+    if mapped is not None:
+        return mapped
+    with get_engine().connect() as conn:
+        plan = conn.execute(text(f'EXPLAIN (FORMAT JSON) {sql}'), params or {}).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    top = plan[0]['Plan']
+    return int(top['Plan Rows']), int(top['Plan Width'])
+
+
+def chunk_rows(sql, params=None, budget=None):
+    """Rows per chunk that keep processing within the memory budget, or None if it all fits."""
+    budget = budget or settings.ANALYTICS_MEMORY_BUDGET_MB * 1024 * 1024
+    try:
+        rows, width = estimate(sql, params)
+    except Exception as e:
+        logger.warning(f"Could not estimate query size, processing in chunks: {str(e)}")
+        return settings.ANALYTICS_CHUNK_ROWS
+    row_bytes = max(width, 8) * WORKING_SET_FACTOR
+    if rows * row_bytes <= budget:
+        return None
+    size = max(1000, budget // row_bytes)
+    logger.info(f"~{rows} rows x {row_bytes} B exceeds the {budget // (1024 * 1024)} MB budget; "
+                f"processing {size} rows at a time")
+    return size
+
+
+def copy_frames(sql, params=None, rows=None, bind=None):
+    """Binary COPY the query into NumPy columns, or None when its columns need the cursor path."""
+    if settings.ANALYTICS_READER != 'copy':
+        return None
+    try:
+        return pgcopy.read_copy(sql, params, bind=bind or get_engine(), categories=CATEGORIES, chunk_rows=rows)
+    except pgcopy.UnsupportedQuery as e:
+        logger.debug(f"Reading through a cursor instead of COPY: {str(e)}")
+        return None
+
+
+def iter_frames(sql, params=None, rows=None):
+    """Stream a query as compact DataFrames of at most ``rows`` rows.
+
+    The binary COPY reader holds the packed result (about the row width per row) and
+    converts one chunk at a time; queries it cannot read go through a server-side cursor.
+    In snapshot mode, registered queries are sliced from the memory-mapped snapshot instead,
+    and with the DuckDB engine they stream as Arrow batches of its join.
+    """
+    rows = rows or settings.ANALYTICS_CHUNK_ROWS
+    frames = columnar.frames(sql, params, rows)
+    if frames is None:
+        frames = snapshots.frames(sql, params, rows)
+    if frames is None:
+        frames = copy_frames(sql, params, rows)
+    if frames is not None:
+        for chunk in frames:
+            yield compact(chunk)
+        return
+    with get_engine().connect() as conn:
+        for chunk in pd.read_sql(text(sql), conn.execution_options(stream_results=True),
+                                 params=params or {}, chunksize=rows):
+            yield compact(chunk)
+
+
+def read_columns(sql, params=None, bind=None):
+    """Read a query without the compact dtypes: numbers as NumPy columns, integer columns with
+    NULLs as float64 like pandas' DB-API path (which is the fallback, Decimals included)."""
+    frame = columnar.frame(sql, params)
+    if frame is None:
+        frame = snapshots.frame(sql, params)
+    if frame is None:
+        frame = copy_frames(sql, params, bind=bind)
+    if frame is not None:
+        return frame
+    return pd.read_sql(text(sql), bind or get_engine(), params=params or {})
+
+
+def read_frame(sql, params=None):
+    """Read a whole query into one compact DataFrame.
+
+    Rows are fetched and converted chunk by chunk, so the wide object/Decimal form of the
+    result never exists for more than one chunk at a time.
+    """
+    frame = columnar.frame(sql, params)
+    if frame is None:
+        frame = snapshots.frame(sql, params)
+    if frame is None:
+        frame = copy_frames(sql, params)
+    if frame is not None:
+        return compact(frame)
+    parts = list(iter_frames(sql, params))
+    if not parts:
+        return pd.DataFrame()
+    if len(parts) == 1:
+        return parts[0]
+    return pd.concat(parts, ignore_index=True, copy=False)
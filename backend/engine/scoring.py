@@ -0,0 +1,200 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection
+
+from . import drift, snapshots
+
+logger = logging.getLogger(__name__)
+
+# Feature order the loan risk model and scaler were trained on (see train_model.py)
+FEATURES = ['loan_amount', 'interest_rate', 'loan_tenure_months', 'income', 'credit_score',
+            'activity_score', 'total_card_value', 'is_diaspora', 'age',
+            'segment_High Net Worth', 'segment_Low Income', 'segment_Middle Class']
+SEGMENT_COLUMNS = ['segment_High Net Worth', 'segment_Low Income', 'segment_Middle Class']
+RISK_CATEGORIES = ['Low', 'Medium', 'High']
+
+# Median age over the scored book (loans joined to their customers, as in training)
+AGE_MEDIAN_QUERY = """
+SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY c.age)
+FROM loans l
+JOIN customers c ON l.customer_id = c.customer_id
+"""
+
+_lock = threading.Lock()
+_artifacts = None
+_age_median = {'value': None, 'checked_at': None, 'source': None}
+
+
+class ModelArtifacts:
+    def __init__(self, model, scaler, version, stamp, load_seconds):
+        self.model = model
+        self.scaler = scaler
+        self.version = version
+        self.stamp = stamp
+        self.loaded_at = time.time()
+        self.load_seconds = load_seconds
+
+    def predict_proba(self, X):
+        """Default probability for each row of an unscaled feature matrix in FEATURES order."""
+        X_scaled = self.scaler.transform(pd.DataFrame(X, columns=FEATURES))
+        return self.model.predict_proba(X_scaled)[:, 1]
+
+
+def model_paths():
+    return (os.path.join(settings.MODELS_DIR, 'loan_risk_model.pkl'),
+            os.path.join(settings.MODELS_DIR, 'scaler.pkl'))
+
+
+def _file_stamp(paths):
+    return tuple((os.stat(p).st_mtime_ns, os.stat(p).st_size) for p in paths)
+
+
+def load_artifacts():
+    """Return the process-wide model and scaler, reloading them only when the files change."""
+    global _artifacts
+    model_path, scaler_path = model_paths()
+    if not os.path.exists(model_path) or not os.path.exists(scaler_path):
+        raise FileNotFoundError('Model or scaler not found')
+
+    stamp = _file_stamp((model_path, scaler_path))
+    with _lock:
+        if _artifacts is None or _artifacts.stamp != stamp:
+            logger.info(f"Loading model from {model_path} and scaler from {scaler_path}")
+            started = time.perf_counter()
+            digest = hashlib.sha1()
+            with open(model_path, 'rb') as f:
+                raw = f.read()
+                digest.update(raw)
+                model = pickle.loads(raw)
+            with open(scaler_path, 'rb') as f:
+                raw = f.read()
+                digest.update(raw)
+                scaler = pickle.loads(raw)
+            _artifacts = ModelArtifacts(model, scaler, digest.hexdigest()[:12], stamp,
+                                        time.perf_counter() - started)
+        return _artifacts
+
+
+def book_age_median():
+    """Median customer age over the whole loan book, re-read at most every AGE_MEDIAN_TTL seconds.
+
+    While reads are served from a snapshot it is the median of the snapshot's loans.
+    """
+    snapshot = snapshots.serving()
+    with _lock:
+        checked_at = _age_median['checked_at']
+        if (_age_median['source'] == snapshot and checked_at is not None
+                and (snapshot is not None or time.monotonic() - checked_at < settings.AGE_MEDIAN_TTL)):
+            return _age_median['value']
+    mapped = snapshots.mapped_dataset('loans') if snapshot is not None else None
+    if mapped is not None:
+        ages = pd.to_numeric(mapped.column('age').to_pandas(), errors='coerce')
+        value = ages.median() if ages.notna().any() else None
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(AGE_MEDIAN_QUERY)
+            value = cursor.fetchone()[0]
+    with _lock:
+        _age_median['value'] = float(value) if value is not None else None
+        _age_median['checked_at'] = time.monotonic()
+        _age_median['source'] = snapshot
+    return _age_median['value']
+
+
+def prepare_loan_features(data, age_median=None):
+    """Apply the training-time preprocessing to a loan/customer frame and return it.
+
+    Missing ages get ``age_median``, by default the median of ``data`` itself; callers
+    working on a chunk, a sample or a few applications pass book_age_median().
+    """
+    # Convert Decimal to float
+    for col in ['loan_amount', 'interest_rate', 'total_card_value']:
+        data[col] = pd.to_numeric(data[col], errors='coerce').astype(float)
+
+    # Fill missing values
+    data['activity_score'] = data['activity_score'].fillna(0)
+    data['total_card_value'] = data['total_card_value'].fillna(0)
+    if 'cluster' in data.columns:
+        data['cluster'] = data['cluster'].fillna(-1)
+    data['age'] = data['age'].astype(float)
+    data['age'] = data['age'].fillna(data['age'].median() if age_median is None else age_median)
+    if isinstance(data['segment'].dtype, pd.CategoricalDtype):
+        # Missing segments become all-zero dummies either way
+        data['segment'] = data['segment'].cat.add_categories('Unknown').fillna('Unknown')
+    else:
+        data['segment'] = data['segment'].fillna('Unknown')
+
+    # Encode categorical 'segment'
+    data = pd.get_dummies(data, columns=['segment'], prefix='segment')
+
+    # Ensure all segment columns exist
+    for col in SEGMENT_COLUMNS:
+        if col not in data.columns:
+            data[col] = 0
+
+    # Convert boolean to int
+    data['is_diaspora'] = data['is_diaspora'].astype(int)
+    return data
+
+
+def risk_category(probabilities):
+    probabilities = np.asarray(probabilities, dtype=float)
+    return np.where(probabilities > 0.5, 'High', np.where(probabilities > 0.2, 'Medium', 'Low'))
+
+
+def iter_scored(frames, artifacts, keep=None, age_median=None):
+    """Score an iterable of raw loan frames, yielding each chunk as soon as it is scored.
+
+    Only the ``keep`` columns (plus default_probability and risk_category) of each scored
+    chunk are retained, so the wide feature frame exists for one chunk at a time. Missing
+    ages are filled with ``age_median``, by default the median over the whole book.
+    """
+    # Scoring a snapshot's loans would count the same book twice in the drift histograms
+    monitored = snapshots.serving() is None
+    try:
+        for chunk in frames:
+            if chunk.empty:
+                continue
+            if age_median is None:
+                age_median = book_age_median()
+            chunk = prepare_loan_features(chunk, age_median)
+            X = chunk[FEATURES].astype(float)
+            if monitored:
+                drift.monitor.record(X.to_numpy(), artifacts.version, 'book')
+            X_scaled = artifacts.scaler.transform(X)
+            chunk['default_probability'] = artifacts.model.predict_proba(X_scaled)[:, 1].round(3)
+            chunk['risk_category'] = pd.Categorical(risk_category(chunk['default_probability']),
+                                                    categories=RISK_CATEGORIES)
+            if keep is not None:
+                chunk = chunk[list(keep) + ['default_probability', 'risk_category']]
+            yield chunk
+    finally:
+        drift.monitor.flush()
+
+
+def score_frames(frames, artifacts, keep=None, age_median=None):
+    """Score an iterable of raw loan frames chunk by chunk into one frame (see iter_scored)."""
+    parts = list(iter_scored(frames, artifacts, keep=keep, age_median=age_median))
+    if not parts:
+        return pd.DataFrame(columns=list(keep or []) + ['default_probability', 'risk_category'])
+    return parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True, copy=False)
+
+
+def feature_importance(model, features=FEATURES):
+    try:
+        if hasattr(model, 'feature_importances_'):
+            return {feature: float(imp) for feature, imp in zip(features, model.feature_importances_)}
+        if hasattr(model, 'coef_'):
+            return {feature: float(coef) for feature, coef in zip(features, model.coef_[0])}
+        logger.warning("Model has no feature importance attribute")
+    except Exception as e:
+        logger.error(f"Error extracting feature importance: {str(e)}")
+    return {feature: 0.0 for feature in features}
@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import changelog, feature_store, locks
+
+logger = logging.getLogger(__name__)
+
+# Features CustomerSegmentationView clusters on, in order
+FEATURES = ['income', 'credit_score', 'savings_balance', 'total_card_value', 'total_loan_amount']
+
+# Inputs of a full refit, merged per customer by CustomerSegmentationView. KMeans depends on
+# the row order, so customers come in id order rather than in whatever order saving the
+# last labels left the heap (as columnar.REFIT_QUERY does)
+REFIT_CUSTOMERS_QUERY = "SELECT customer_id, income, credit_score, is_diaspora FROM customers ORDER BY customer_id"
+REFIT_SAVINGS_QUERY = "SELECT customer_id, savings_balance, activity_score FROM savings_accounts"
+REFIT_CARDS_QUERY = """
+SELECT customer_id, SUM(transaction_value) AS total_card_value,
+       COUNT(transaction_id) AS transaction_count
+FROM card_transactions GROUP BY customer_id
+"""
+REFIT_LOANS_QUERY = """
+SELECT customer_id, SUM(loan_amount) AS total_loan_amount,
+       SUM(interest_rate) / COUNT(loan_id) AS avg_interest_rate
+FROM loans GROUP BY customer_id
+"""
+
+# Customers with no cluster yet, or whose inputs changed since the last run
+TARGETS_QUERY = """
+SELECT customer_id FROM customers WHERE cluster IS NULL OR updated_at > %(since)s
+UNION SELECT customer_id FROM savings_accounts WHERE updated_at > %(since)s
+UNION SELECT customer_id FROM loans WHERE updated_at > %(since)s
+UNION SELECT customer_id FROM card_transactions WHERE created_at > %(since)s
+"""
+
+FEATURES_QUERY = """
+SELECT c.customer_id, c.income::float8 AS income, c.credit_score::float8 AS credit_score,
+       COALESCE(s.savings_balance, 0)::float8 AS savings_balance,
+       COALESCE(ct.total_card_value, 0)::float8 AS total_card_value,
+       COALESCE(l.total_loan_amount, 0)::float8 AS total_loan_amount
+FROM customers c
+LEFT JOIN savings_accounts s ON s.customer_id = c.customer_id
+LEFT JOIN (
+    SELECT customer_id, SUM(transaction_value) AS total_card_value
+    FROM card_transactions WHERE customer_id = ANY(%(ids)s) GROUP BY customer_id
+) ct ON ct.customer_id = c.customer_id
+LEFT JOIN (
+    SELECT customer_id, SUM(loan_amount) AS total_loan_amount
+    FROM loans WHERE customer_id = ANY(%(ids)s) GROUP BY customer_id
+) l ON l.customer_id = c.customer_id
+WHERE c.customer_id = ANY(%(ids)s)
+"""
+
+
+def model_path():
+    return os.path.join(settings.MODELS_DIR, 'segmentation.json')
+
+
+def _db_now():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT LOCALTIMESTAMP")
+        return cursor.fetchone()[0].isoformat()
+
+
+def _write_state(state):
+    os.makedirs(settings.MODELS_DIR, exist_ok=True)
+    tmp_path = model_path() + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, model_path())
+
+
+def save_model(scaler, kmeans, X_scaled, labels, fee_model=None):
+    """Persist centroids, scaler parameters and the fit's dispersion for incremental assignment."""
+    sq_distances = ((X_scaled - kmeans.cluster_centers_[labels]) ** 2).sum(axis=1)
+    k = len(kmeans.cluster_centers_)
+    counts = np.bincount(labels, minlength=k)
+    fitted_at = _db_now()
+    state = {
+        'features': FEATURES,
+        'mean': scaler.mean_.tolist(),
+        'scale': scaler.scale_.tolist(),
+        'centroids': kmeans.cluster_centers_.tolist(),
+        'fitted_at': fitted_at,
+        'assigned_through': fitted_at,
+        'n_customers': int(len(labels)),
+        'cluster_shares': (counts / max(len(labels), 1)).tolist(),
+        'mean_sq_distance': float(sq_distances.mean()) if len(sq_distances) else 0.0,
+        # Running totals over customers assigned incrementally since this fit
+        'assigned_since_fit': 0,
+        'sq_distance_since_fit': 0.0,
+        'cluster_counts_since_fit': [0] * k,
+    }
+    if fee_model is not None:
+        # Linear fee regression, so summaries can evaluate it at cluster means
+        state['fee_model'] = {
+            'features': list(fee_model.feature_names_in_),
+            'coef': fee_model.coef_.tolist(),
+            'intercept': float(fee_model.intercept_),
+        }
+    _write_state(state)
+    return state
+
+
+def load_model():
+    path = model_path()
+    if not os.path.exists(path):
+        raise FileNotFoundError('Segmentation model not found; run segmentation first')
+    with open(path) as f:
+        return json.load(f)
+
+
+def nearest_centroids(X, mean, scale, centroids):
+    """Return (cluster, squared distance) for each row of the unscaled matrix X."""
+    X_scaled = (X - mean) / scale
+    # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, computed for all centroids at once
+    distances = ((X_scaled ** 2).sum(axis=1)[:, None]
+                 - 2 * X_scaled @ centroids.T
+                 + (centroids ** 2).sum(axis=1)[None, :])
+    labels = distances.argmin(axis=1)
+    return labels, np.maximum(distances[np.arange(len(labels)), labels], 0)
+
+
+def drift(state):
+    """Compare customers assigned since the last fit against the fit itself."""
+    assigned = state['assigned_since_fit']
+    baseline = state['mean_sq_distance'] or 1e-12
+    if assigned:
+        dispersion_ratio = state['sq_distance_since_fit'] / assigned / baseline
+        shares = np.array(state['cluster_counts_since_fit']) / assigned
+        share_shift = 0.5 * float(np.abs(shares - np.array(state['cluster_shares'])).sum())
+    else:
+        dispersion_ratio, share_shift = 1.0, 0.0
+    new_fraction = assigned / max(state['n_customers'], 1)
+    # Dispersion and mix are too noisy to act on until enough customers were assigned
+    enough = assigned >= settings.SEGMENTATION_DRIFT_MIN_ASSIGNED
+    return {
+        'assigned_since_fit': assigned,
+        'new_fraction': round(new_fraction, 4),
+        'dispersion_ratio': round(dispersion_ratio, 4),
+        'share_shift': round(share_shift, 4),
+        'fitted_at': state['fitted_at'],
+        'refit_recommended': bool(
+            (enough and dispersion_ratio > settings.SEGMENTATION_DRIFT_DISPERSION_RATIO)
+            or (enough and share_shift > settings.SEGMENTATION_DRIFT_SHARE_SHIFT)
+            or new_fraction > settings.SEGMENTATION_DRIFT_NEW_FRACTION
+        ),
+    }
+
+
+def save_clusters(customer_ids, labels):
+    """Write cluster labels back to the customers table in one statement."""
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE customers SET cluster = a.cluster "
+            "FROM unnest(%s::int[], %s::int[]) AS a(customer_id, cluster) "
+            "WHERE customers.customer_id = a.customer_id",
+            [np.asarray(customer_ids, dtype=int).tolist(), np.asarray(labels, dtype=int).tolist()]
+        )
+
+
+def assign(customer_ids=None, batch_size=None):
+    """Assign new/changed (or the given) customers to their nearest persisted centroid."""
+    # Waits out a refit on any node, so old centroids never overwrite its fresh labels
+    with locks.advisory_lock(locks.SEGMENTATION):
+        return _assign(customer_ids, batch_size)
+
+
+def _assign(customer_ids, batch_size):
+    started = time.perf_counter()
+    state = load_model()
+    batch_size = batch_size or settings.SEGMENTATION_ASSIGN_BATCH_SIZE
+    mean, scale = np.array(state['mean']), np.array(state['scale'])
+    centroids = np.array(state['centroids'])
+    run_started_at = _db_now()
+
+    if customer_ids is None:
+        with connection.cursor() as cursor:
+            cursor.execute(TARGETS_QUERY, {'since': state['assigned_through']})
+            customer_ids = [row[0] for row in cursor.fetchall()]
+    customer_ids = sorted(set(int(i) for i in customer_ids))
+
+    counts = np.zeros(len(centroids), dtype=int)
+    sq_distance_total = 0.0
+    assigned = 0
+    for start in range(0, len(customer_ids), batch_size):
+        batch_ids = customer_ids[start:start + batch_size]
+        with connection.cursor() as cursor:
+            cursor.execute(FEATURES_QUERY, {'ids': batch_ids})
+            rows = cursor.fetchall()
+        if not rows:
+            continue
+        data = pd.DataFrame(rows, columns=['customer_id'] + FEATURES).drop_duplicates('customer_id')
+        labels, sq_distances = nearest_centroids(data[FEATURES].to_numpy(dtype=float), mean, scale, centroids)
+
+        save_clusters(data['customer_id'], labels)
+        try:
+            store = feature_store.get_store(create=False)
+            if store is not None:
+                store.set_column('cluster', data['customer_id'], labels)
+        except Exception as e:
+            logger.warning(f"Failed to update feature store clusters: {str(e)}")
+
+        counts += np.bincount(labels, minlength=len(centroids))
+        sq_distance_total += float(sq_distances.sum())
+        assigned += len(data)
+
+    if assigned:
+        # API workers elsewhere pick the new labels up from the change log
+        changelog.publish('segmentation', clusters=customer_ids)
+    state['assigned_through'] = run_started_at
+    state['assigned_since_fit'] += assigned
+    state['sq_distance_since_fit'] += sq_distance_total
+    state['cluster_counts_since_fit'] = (np.array(state['cluster_counts_since_fit']) + counts).tolist()
+    _write_state(state)
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Assigned {assigned} customers to clusters in {elapsed:.3f}s")
+    return {
+        'assigned': assigned,
+        'clusters': {f'Cluster {i}': int(n) for i, n in enumerate(counts)},
+        'mean_sq_distance': round(sq_distance_total / assigned, 4) if assigned else None,
+        'duration_seconds': round(elapsed, 3),
+        'drift': drift(state),
+    }
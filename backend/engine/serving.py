@@ -0,0 +1,125 @@
+import fcntl
+import gc
+import io
+import logging
+import os
+import sys
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import feature_store
+from . import db
+from .scoring import load_artifacts
+
+logger = logging.getLogger(__name__)
+
+_refresh_lock = None
+
+
+def pin_threads(threads):
+    """Cap BLAS/OpenMP pools and the model's XGBoost threads in an already running process."""
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        logger.warning("threadpoolctl not installed; relying on the thread environment variables")
+    try:
+        model = load_artifacts().model
+    except FileNotFoundError:
+        return
+    if hasattr(model, 'set_params') and 'n_jobs' in model.get_params():
+        model.set_params(n_jobs=threads)
+
+
+def preload():
+    """Load what every worker needs before forking, so they share the pages copy-on-write."""
+    started = time.perf_counter()
+    loaded = []
+    try:
+        artifacts = load_artifacts()
+        loaded.append(f'model {artifacts.version}')
+    except FileNotFoundError:
+        logger.warning("Model or scaler not found; workers will load it once it exists")
+    # The master scores single-threaded: an OpenMP pool started here (by the warm-up) does not
+    # survive the fork, and workers scoring with several threads would wait on it forever.
+    # Each worker sets its own thread count in after_fork
+    pin_threads(1)
+    try:
+        if feature_store.get_store() is not None:
+            loaded.append('feature store')
+    except Exception as e:
+        logger.warning(f"Feature store unavailable at startup: {str(e)}")
+    logger.info(f"Preloaded {', '.join(loaded) or 'nothing'} in {time.perf_counter() - started:.3f}s")
+
+
+def _get(application, path):
+    path, _, query = path.partition('?')
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'HTTP_HOST': 'localhost',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    result = {}
+
+    def start_response(status, headers, exc_info=None):
+        result['status'] = status
+
+    body = application(environ, start_response)
+    try:
+        for _ in body:
+            pass
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return result.get('status', '')
+
+
+def warm_up(application, paths=None):
+    """Request each warm-up path once in-process, so imports, caches and query plans are ready."""
+    for path in settings.SERVE_WARMUP_PATHS if paths is None else paths:
+        started = time.perf_counter()
+        try:
+            status = _get(application, path)
+            logger.info(f"Warm-up {path}: {status} in {time.perf_counter() - started:.3f}s")
+        except Exception as e:
+            logger.warning(f"Warm-up {path} failed: {str(e)}")
+
+
+def before_fork():
+    """Drop connections that must not be shared and freeze the heap so workers keep it shared."""
+    connections.close_all()
+    db.dispose()
+    # Objects that survive to here live for the server's lifetime; moving them out of the
+    # collector's generations keeps gc passes from touching (and un-sharing) their pages
+    gc.collect()
+    gc.freeze()
+
+
+def after_fork(threads):
+    """Per-worker setup: own database connections, pinned threads, feature store refresh duty."""
+    global _refresh_lock
+    db.dispose(close=False)
+    pin_threads(threads)
+    # Exactly one live worker refreshes the shared feature store; when it exits its lock is
+    # released and the next worker to start takes over
+    if feature_store.get_store(create=False) is not None:
+        handle = open(os.path.join(settings.SERVE_LOCK_DIR, f'{settings.FEATURE_STORE_NAME}.refresh.lock'), 'w')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+        else:
+            _refresh_lock = handle
+            feature_store.claim_refresh()
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
+
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+from pyarrow import feather
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import pgcopy, schema
+from .db import database_url, get_engine
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ('postgres', 'snapshot')
+LATEST = 'latest'
+MANIFEST = 'manifest.json'
+
+CUSTOMERS_TABLE_QUERY = "SELECT customer_id, age, income, credit_score, is_diaspora, segment, cluster FROM customers"
+LOANS_TABLE_QUERY = """
+SELECT loan_id, customer_id, loan_amount, loan_tenure_months, interest_rate, loan_default FROM loans
+"""
+
+_local = threading.local()
+_lock = threading.Lock()
+_mapped = {'directory': None, 'tables': {}}
+
+
+def datasets():
+    """Name -> SQL of the whole-table analytics reads a snapshot can answer."""
+    from . import fees, segmentation
+
+    return {
+        'loans': fees.LOAN_QUERY.format(where=''),
+        'customers': fees.CUSTOMER_QUERY.format(sample=''),
+        'refit_customers': segmentation.REFIT_CUSTOMERS_QUERY,
+        'refit_savings': segmentation.REFIT_SAVINGS_QUERY,
+        'refit_cards': segmentation.REFIT_CARDS_QUERY,
+        'refit_loans': segmentation.REFIT_LOANS_QUERY,
+        # Base relations for the columnar engine (engine/columnar.py); savings and card
+        # totals are the refit datasets above
+        'customers_table': CUSTOMERS_TABLE_QUERY,
+        'loans_table': LOANS_TABLE_QUERY,
+    }
+
+
+def _normalize(sql):
+    return ' '.join(sql.split())
+
+
+@lru_cache(maxsize=1)
+def _names():
+    return {_normalize(sql): name for name, sql in datasets().items()}
+
+
+def active_source():
+    return getattr(_local, 'source', None) or settings.ANALYTICS_SOURCE
+
+
+@contextmanager
+def using(source):
+    """Read from ``source`` ('postgres' or 'snapshot') in this thread for the block."""
+    previous = getattr(_local, 'source', None)
+    _local.source = source
+    try:
+        yield
+    finally:
+        _local.source = previous
+
+
+def selectable(get):
+    """Let a view's GET pick its data source with ?source=postgres|snapshot."""
+    @wraps(get)
+    def wrapper(self, request, *args, **kwargs):
+        source = getattr(request, 'query_params', {}).get('source') or None
+        if source is not None and source not in SOURCES:
+            return Response({'error': f"source must be one of {', '.join(SOURCES)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        with using(source):
+            return get(self, request, *args, **kwargs)
+    return wrapper
+
+
+def latest_directory():
+    try:
+        return os.path.realpath(os.path.join(settings.SNAPSHOT_DIR, LATEST), strict=True)
+    except OSError:
+        return None
+
+
+def manifest():
+    """Manifest of the latest snapshot, or None when none has been exported."""
+    directory = latest_directory()
+    if directory is None:
+        return None
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return json.load(f)
+
+
+def serving():
+    """Name of the snapshot this thread's analytics reads are answered from, or None.
+
+    None while the source is Postgres, or no snapshot has been exported yet (reads then
+    fall back to Postgres).
+    """
+    if active_source() != 'snapshot':
+        return None
+    directory = latest_directory()
+    return os.path.basename(directory) if directory is not None else None
+
+
+def dataset_name(sql):
+    """Name of the registered dataset ``sql`` reads, or None."""
+    return _names().get(_normalize(sql))
+
+
+def table(sql, params=None):
+    """Memory-mapped Arrow table answering ``sql`` from the latest snapshot, or None.
+
+    Only used while the active source is 'snapshot', and only for the registered
+    parameterless queries; everything else keeps going to Postgres.
+    """
+    if params or active_source() != 'snapshot':
+        return None
+    name = dataset_name(sql)
+    if name is None:
+        return None
+    return mapped_dataset(name)
+
+
+def mapped_dataset(name):
+    """Memory-mapped Arrow table of one dataset of the latest snapshot, or None."""
+    directory = latest_directory()
+    if directory is None:
+        logger.warning("No snapshot exported yet; reading from Postgres")
+        return None
+    with _lock:
+        if _mapped['directory'] != directory:
+            # A newer snapshot: map its files from now on; frames still using the old
+            # mappings keep them alive until they are dropped
+            _mapped['directory'] = directory
+            _mapped['tables'] = {}
+        mapped = _mapped['tables'].get(name)
+        if mapped is None:
+            mapped = feather.read_table(os.path.join(directory, f'{name}.feather'), memory_map=True)
+            _mapped['tables'][name] = mapped
+    return mapped
+
+
+def frame(sql, params=None):
+    """The snapshot's result of ``sql`` as a DataFrame, or None to query Postgres.
+
+    Numeric columns without nulls are views on the mapped pages, shared by every
+    process that maps the same file, so they are read-only.
+    """
+    mapped = table(sql, params)
+    if mapped is None:
+        return None
+    return mapped.to_pandas(split_blocks=True)
+
+
+def frames(sql, params=None, rows=None):
+    """The snapshot's result of ``sql`` as DataFrames of at most ``rows`` rows, or None."""
+    mapped = table(sql, params)
+    if mapped is None:
+        return None
+    rows = rows or settings.ANALYTICS_CHUNK_ROWS
+    return (mapped.slice(start, rows).to_pandas(split_blocks=True) for start in range(0, mapped.num_rows, rows))
+
+
+def shape(sql, params=None):
+    """(rows, bytes per row) of the snapshot's result of ``sql``, or None."""
+    mapped = table(sql, params)
+    if mapped is None:
+        return None
+    return mapped.num_rows, mapped.nbytes // max(mapped.num_rows, 1)
+
+
+def _to_arrow(data):
+    # Float columns keep NaN as a value instead of becoming nullable, so they map back
+    # into pandas without a copy
+    arrays = [
+        pa.array(data[column].to_numpy(), from_pandas=False) if data[column].dtype.kind == 'f'
+        else pa.Array.from_pandas(data[column])
+        for column in data.columns
+    ]
+    return pa.Table.from_arrays(arrays, names=list(data.columns))
+
+
+def _read(conn, sql):
+    try:
+        return pgcopy.read_copy(sql, bind=get_engine(), categories=schema.CATEGORIES, connection=conn)
+    except pgcopy.UnsupportedQuery:
+        with conn.cursor() as cursor:
+            cursor.execute(sql)
+            return pd.DataFrame(cursor.fetchall(), columns=[col.name for col in cursor.description])
+
+
+def export(keep=None):
+    """Write every dataset as of one database snapshot and make it the latest.
+
+    All queries run in a single REPEATABLE READ transaction, so the files agree with each
+    other. Older snapshots beyond ``keep`` are removed. Returns the manifest.
+    """
+    started = time.perf_counter()
+    keep = settings.SNAPSHOT_KEEP if keep is None else keep
+    root = settings.SNAPSHOT_DIR
+    os.makedirs(root, exist_ok=True)
+    created_at = datetime.now(timezone.utc)
+    name = created_at.strftime('%Y%m%dT%H%M%S%fZ')
+    partial = os.path.join(root, f'.{name}.partial')
+    os.makedirs(partial)
+    try:
+        conn = psycopg2.connect(database_url())
+        try:
+            conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            written = {}
+            for dataset, sql in datasets().items():
+                data = _to_arrow(_read(conn, sql))
+                feather.write_feather(data, os.path.join(partial, f'{dataset}.feather'), compression='uncompressed')
+                written[dataset] = {'rows': data.num_rows, 'bytes': data.nbytes}
+                logger.info(f"Snapshot {name}: {dataset} {data.num_rows} rows")
+            conn.rollback()
+        finally:
+            conn.close()
+        result = {
+            'name': name,
+            'created_at': created_at.isoformat(),
+            'datasets': written,
+            'duration_seconds': round(time.perf_counter() - started, 3),
+        }
+        with open(os.path.join(partial, MANIFEST), 'w') as f:
+            json.dump(result, f, indent=2)
+        os.rename(partial, os.path.join(root, name))
+    except Exception:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    # Swap the link in one rename so readers never see a half-written snapshot
+    link = os.path.join(root, f'.{LATEST}.{os.getpid()}')
+    os.symlink(name, link)
+    os.replace(link, os.path.join(root, LATEST))
+
+    finished = sorted(entry for entry in os.listdir(root)
+                      if not entry.startswith('.') and entry != LATEST and os.path.isdir(os.path.join(root, entry)))
+    for old in finished[:-max(keep, 1)]:
+        # Processes still mapping these files keep reading them until they move on
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    logger.info(f"Exported snapshot {name} in {result['duration_seconds']}s")
+    return result
@@ -0,0 +1,166 @@
+import logging
+import os
+import resource
+import time
+
+from django.db import connection
+
+from . import cache, feature_store, jobqueue, segmentation, snapshots
+from .db import get_engine
+from .scoring import load_artifacts
+
+logger = logging.getLogger(__name__)
+
+STARTED_AT = time.time()
+
+# Only the small columns (and the scoring row count) of the recompute snapshots, so a poll
+# never pulls the stored segmentation response
+RUNS_QUERY = """
+SELECT name, started_at, completed_at, duration_seconds,
+       CASE WHEN name = 'batch_scoring' THEN (payload::jsonb ->> 'loans')::bigint END
+FROM recompute_snapshots
+"""
+
+# Planner estimates instead of COUNT(*), summing the partitions of partitioned tables;
+# reltuples is -1 (reported as null) until a table has been analyzed
+ROW_ESTIMATES_QUERY = """
+SELECT parent.relname,
+       COALESCE(SUM(NULLIF(child.reltuples, -1)), NULLIF(MAX(parent.reltuples), -1))::bigint
+FROM pg_class parent
+LEFT JOIN pg_inherits i ON i.inhparent = parent.oid
+LEFT JOIN pg_class child ON child.oid = i.inhrelid
+WHERE parent.relname = ANY(%s) AND parent.relnamespace = 'public'::regnamespace
+GROUP BY parent.relname
+"""
+
+TABLES = ['customers', 'loans', 'savings_accounts', 'card_transactions']
+
+
+def _timed(check):
+    started = time.perf_counter()
+    try:
+        result = check()
+    except Exception as e:
+        return {'ok': False, 'error': str(e).splitlines()[0] if str(e) else type(e).__name__}
+    return {'ok': True, **(result or {}), 'latency_ms': round((time.perf_counter() - started) * 1000, 2)}
+
+
+def ping_database():
+    def check():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+    return _timed(check)
+
+
+def model():
+    def check():
+        artifacts = load_artifacts()
+        return {
+            'version': artifacts.version,
+            'loaded_at': artifacts.loaded_at,
+            'load_seconds': round(artifacts.load_seconds, 3),
+        }
+    return _timed(check)
+
+
+def pool():
+    """Checkout state of the shared SQLAlchemy pool used by the analytics reads."""
+    current = get_engine().pool
+    if not hasattr(current, 'checkedout'):
+        return {'class': type(current).__name__}
+    size, checked_out = current.size(), current.checkedout()
+    return {
+        'class': type(current).__name__,
+        'size': size,
+        'checked_in': current.checkedin(),
+        'checked_out': checked_out,
+        'overflow': current.overflow(),
+        'utilisation': round(checked_out / size, 3) if size else None,
+    }
+
+
+def cache_stats():
+    counts = dict(cache.stats)
+    lookups = counts['hits'] + counts['not_modified'] + counts['misses']
+    return {**counts, 'hit_ratio': round((counts['hits'] + counts['not_modified']) / lookups, 4) if lookups else None}
+
+
+def jobs():
+    """Last segmentation and scoring runs, with row counts, and the job queue, from cheap reads only."""
+    with connection.cursor() as cursor:
+        cursor.execute(RUNS_QUERY)
+        runs = {
+            name: {
+                'started_at': started_at,
+                'completed_at': completed_at,
+                'duration_seconds': round(duration, 3) if duration is not None else None,
+                **({'rows': rows} if rows is not None else {}),
+            }
+            for name, started_at, completed_at, duration, rows in cursor.fetchall()
+        }
+        cursor.execute(ROW_ESTIMATES_QUERY, [TABLES])
+        tables = dict(cursor.fetchall())
+
+    try:
+        state = segmentation.load_model()
+        runs.setdefault('segmentation', {}).update({
+            'fitted_at': state['fitted_at'],
+            'rows': state['n_customers'],
+            'assigned_since_fit': state['assigned_since_fit'],
+        })
+    except FileNotFoundError:
+        pass
+    return {'runs': runs, 'estimated_rows': tables, 'queue': jobqueue.stats()}
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def process():
+    return {
+        'pid': os.getpid(),
+        'uptime_seconds': round(time.time() - STARTED_AT, 1),
+        'rss_bytes': _rss_bytes(),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def readiness():
+    """Cheap checks for the container healthcheck: (ready, body).
+
+    Only an unreachable database makes the worker unready; a missing model still lets the
+    other endpoints serve, so it is reported as degraded.
+    """
+    database = ping_database()
+    loaded = model()
+    state = 'ready' if database['ok'] and loaded['ok'] else 'degraded' if database['ok'] else 'unavailable'
+    return database['ok'], {'status': state, 'database': database, 'model': loaded}
+
+
+def report(batcher=None):
+    """Operational state of this worker and the jobs it shares with the others."""
+    ready, body = readiness()
+    body['pool'] = pool()
+    body['cache'] = cache_stats()
+    try:
+        body['jobs'] = jobs() if ready else None
+    except Exception as e:
+        logger.warning(f"Could not read job state: {str(e)}")
+        body['jobs'] = {'error': str(e)}
+    latest = snapshots.manifest()
+    body['snapshot'] = {'name': latest['name'], 'created_at': latest['created_at']} if latest else None
+    body['feature_store'] = feature_store.describe()
+    if batcher is not None:
+        body['batcher'] = batcher.metrics()['totals']
+    body['process'] = process()
+    return ready, body
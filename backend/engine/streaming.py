@@ -0,0 +1,160 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import StreamingHttpResponse
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import aggregates, changes
+from .scoring import feature_importance
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('ndjson',)
+CONTENT_TYPE = 'application/x-ndjson'
+
+
+def requested_format(request):
+    """The ?stream= format asked for, or None. Raises ValueError for unknown formats."""
+    value = str(getattr(request, 'query_params', {}).get('stream', '')).strip().lower()
+    if not value:
+        return None
+    if value not in FORMATS:
+        raise ValueError(f"stream must be one of {', '.join(FORMATS)}")
+    return value
+
+
+def _line(record):
+    return json.dumps(record, cls=JSONEncoder, allow_nan=not api_settings.STRICT_JSON,
+                      separators=(',', ':')) + '\n'
+
+
+def ndjson_response(records, label):
+    """Stream an iterable of records as one JSON document per line.
+
+    The status line is sent before the first record exists, so a failure half way through
+    is reported as a final {"type": "error"} record instead of an HTTP error.
+    """
+    def generate():
+        started = time.perf_counter()
+        try:
+            for record in records:
+                yield _line(record)
+        except Exception as e:
+            logger.error(f"Error streaming {label}: {str(e)}", exc_info=True)
+            yield _line({'type': 'error', 'error': str(e)})
+            return
+        logger.info(f"Streamed {label} in {time.perf_counter() - started:.3f}s")
+
+    response = StreamingHttpResponse(generate(), content_type=CONTENT_TYPE)
+    response['Cache-Control'] = 'no-cache'
+    # Keep proxies such as nginx from buffering the batches back into one body
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def row_batches(query, params=None, batch_rows=None):
+    """Yield lists of row dicts from a server-side cursor, ``batch_rows`` at a time."""
+    batch_rows = batch_rows or settings.STREAM_BATCH_ROWS
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(query, params)
+        rows = cursor.fetchmany(batch_rows)
+        # Named cursors only describe their columns once the first rows are fetched
+        columns = [col[0] for col in cursor.description] if cursor.description else []
+        while rows:
+            yield [dict(zip(columns, row)) for row in rows]
+            rows = cursor.fetchmany(batch_rows)
+
+
+def _rows(kind, query, params, counts):
+    for batch in row_batches(query, params):
+        counts[kind] = counts.get(kind, 0) + len(batch)
+        yield {'type': kind, 'rows': batch}
+
+
+def _header(artifacts, rescoring):
+    return {'type': 'header', 'model_version': artifacts.version, 'rescoring': rescoring}
+
+
+def _loan_rows(scored):
+    """A freshly scored chunk as the rows LOAN_ROWS_QUERY would return for it."""
+    # Widen the model's float32 probabilities the way persist_scores stores them
+    rows = scored.assign(loan_amount=scored['loan_amount'].astype(float),
+                         default_probability=scored['default_probability'].astype(float),
+                         risk_category=scored['risk_category'].astype(str),
+                         cluster=scored['cluster'].fillna(-1).astype(int))
+    return rows[['loan_id', 'customer_id', 'loan_amount', 'default_probability', 'risk_category',
+                 'cluster']].to_dict(orient='records')
+
+
+def _loan_risk_summary(artifacts):
+    summary = aggregates.loan_risk_summary(artifacts.version)
+    return {'type': 'summary', 'data': {
+        'clusters': summary['clusters'],
+        'portfolio': summary['portfolio'],
+        'feature_importance': feature_importance(artifacts.model),
+        'cluster_summary': aggregates.customer_counts_by_cluster(),
+    }}
+
+
+def loan_risk_records(artifacts):
+    """LoanRiskView's response as records: a header, the summary, then loan and customer
+    row batches.
+
+    Rows come from the persisted scores. When those are stale the book is re-scored in
+    bounded chunks and each chunk's loans are streamed as soon as it is scored; the
+    summary, which needs every score, follows them.
+    """
+    counts = {}
+    if aggregates.scores_current(artifacts.version):
+        yield _header(artifacts, False)
+        yield _loan_risk_summary(artifacts)
+        yield from _rows('loans', aggregates.LOAN_ROWS_QUERY, [artifacts.version], counts)
+    else:
+        logger.info("Persisted scores are stale; streaming loans as the book is re-scored")
+        yield _header(artifacts, True)
+        for scored in changes.rescore_chunks(keep=['loan_amount', 'cluster']):
+            counts['loans'] = counts.get('loans', 0) + len(scored)
+            yield {'type': 'loans', 'rows': _loan_rows(scored)}
+        yield _loan_risk_summary(artifacts)
+    yield from _rows('customers', aggregates.LOAN_CUSTOMER_ROWS_QUERY, [artifacts.version], counts)
+    yield {'type': 'end', 'rows': counts}
+
+
+def fee_records(artifacts):
+    """FeeOptimizationView's response as records: a header, the summary, then customer row batches.
+
+    Customer rows average over all of a customer's loans, so when the persisted scores are
+    stale a {"type": "progress"} record follows each re-scored chunk until they are current.
+    """
+    rescoring = not aggregates.scores_current(artifacts.version)
+    yield _header(artifacts, rescoring)
+    if rescoring:
+        logger.info("Persisted scores are stale; re-scoring the book before streaming customers")
+        scored = 0
+        for chunk in changes.rescore_chunks():
+            scored += len(chunk)
+            yield {'type': 'progress', 'loans_scored': scored}
+    yield {'type': 'summary', 'data': aggregates.fee_summary(artifacts.version)}
+    counts = {}
+    yield from _rows('customers', aggregates.FEE_CUSTOMER_ROWS_QUERY, {'model_version': artifacts.version}, counts)
+    yield {'type': 'end', 'rows': counts}
+
+
+def segmentation_records(fee_model=None):
+    """The persisted segmentation as records: the summary, then cluster and customer row batches.
+
+    Streams the current cluster labels rather than refitting, like ?summary=1.
+    """
+    yield {'type': 'summary', 'data': {'summary': aggregates.segmentation_summary(fee_model)}}
+    counts = {}
+    for batch in row_batches(aggregates.SEGMENTATION_CUSTOMER_ROWS_QUERY):
+        counts['customers'] = counts.get('customers', 0) + len(batch)
+        yield {'type': 'clusters', 'rows': [{'customer_id': row['customer_id'], 'cluster': row['cluster']}
+                                            for row in batch]}
+        yield {'type': 'customers', 'rows': [{key: value for key, value in row.items() if key != 'cluster'}
+                                             for row in batch]}
+    yield {'type': 'end', 'rows': counts}
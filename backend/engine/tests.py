@@ -1,3 +1,1652 @@
-from django.test import TestCase
+import gc
+import io
+import json
+import os
+import select
+import shutil
+import signal
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import psycopg2
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.core.management import call_command
+from django.core.wsgi import get_wsgi_application
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+from . import (approx, cache, changelog, changes, columnar, db, drift, explain, feature_store, fees, jobqueue, locks,
+               mapreduce, pgcopy, pricing, schema, segmentation, serving, snapshots, streaming, views)
+from .batching import MicroBatcher
+from .cache import cached_response
+from .db import get_engine
+from .feature_store import CustomerFeatureStore
+from .fees import DEFAULT_POLICY
+from .profiling import Histogram, HyperLogLog, Moments, QuantileSketch
+from .scoring import FEATURES, load_artifacts, prepare_loan_features
+
+
+def _customers(customer_ids, value=0.0):
+    """Encoded store rows whose numeric columns all hold ``value``."""
+    customer_ids = np.asarray(customer_ids, dtype=np.int64)
+    data = pd.DataFrame({'customer_id': customer_ids})
+    for name, dtype in feature_store.COLUMNS:
+        data[name] = np.full(len(customer_ids), value).astype(dtype)
+    return data
+
+
+class FeatureStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.store = CustomerFeatureStore.create(f'rvm_test_{os.getpid()}', capacity=64, index_size=256)
+        self.store.header[feature_store.MAGIC] = feature_store.MAGIC_VALUE
+
+    def tearDown(self):
+        self.store.unlink()
+        self.store.close()
+
+    def test_upsert_and_lookup(self):
+        self.store.upsert(_customers([5, 9], value=1))
+        self.store.upsert(_customers([9, 200], value=2))
+
+        values = self.store.lookup([200, 5, 9, 7, 1000], columns=['income', 'cluster'])
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(values['found'].tolist(), [True, True, True, False, False])
+        self.assertEqual(values['income'][:3].tolist(), [2.0, 1.0, 2.0])
+        self.assertEqual(values['cluster'].dtype, np.int16)
+
+    def test_batches_match_a_single_upsert(self):
+        data = _customers(np.arange(40) * 3)
+        data['income'] = np.arange(40) * 100.0
+        data['cluster'] = (np.arange(40) % 3).astype(np.int16)
+
+        other = CustomerFeatureStore.create(f'rvm_test_{os.getpid()}_whole', capacity=64, index_size=256)
+        try:
+            other.upsert(data)
+            for part in np.array_split(data.sample(frac=1, random_state=0), 4):
+                self.store.upsert(part)
+            ids = data['customer_id']
+            pd.testing.assert_frame_equal(self.store.frame(ids, decode=False), other.frame(ids, decode=False))
+        finally:
+            other.unlink()
+            other.close()
+
+    def test_set_column_adds_to_known_customers_only(self):
+        self.store.upsert(_customers([1, 2], value=10))
+        updated = self.store.set_column('total_card_value', [1, 2, 3], [5.0, 7.0, 9.0], add=True)
+
+        self.assertEqual(updated, 2)
+        self.assertEqual(self.store.lookup([1, 2], ['total_card_value'])['total_card_value'].tolist(), [15.0, 17.0])
+
+    def test_attached_store_sees_writes(self):
+        attached = CustomerFeatureStore.attach(self.store.name)
+        try:
+            self.store.upsert(_customers([3], value=4))
+            self.assertEqual(attached.lookup([3], ['age'])['age'].tolist(), [4.0])
+        finally:
+            attached.close()
+
+    def test_readers_never_see_torn_rows(self):
+        ids = np.arange(50)
+        self.store.upsert(_customers(ids))
+        stop = threading.Event()
+
+        def write():
+            value = 0
+            while not stop.is_set():
+                value += 1
+                self.store.upsert(_customers(ids, value=value % 100))
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            for _ in range(2000):
+                values = self.store.lookup(ids, ['income', 'spend_365d', 'txn_count_30d'])
+                self.assertEqual(len(set(values['income'].tolist())), 1)
+                self.assertTrue((values['income'] == values['spend_365d']).all())
+                self.assertTrue((values['income'] == values['txn_count_30d']).all())
+        finally:
+            stop.set()
+            writer.join()
+        self.assertEqual(self.store.header[feature_store.GENERATION] % 2, 0)
+
+
+def _merged(sketch, parts):
+    """One sketch per partition, merged in order."""
+    merged = sketch()
+    for part in parts:
+        partial = sketch()
+        partial.update(part)
+        merged.merge(partial)
+    return merged
+
+
+class SketchTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.values = np.concatenate([rng.lognormal(8, 1.5, 20000), -rng.exponential(50, 3000), np.zeros(500)])
+        rng.shuffle(self.values)
+        # Uneven partitions, including an empty one
+        self.parts = np.split(self.values, [0, 17, 9000, 9001, 21000])
+
+    def test_moments_merge_equals_single_pass(self):
+        whole = Moments()
+        whole.update(self.values)
+        merged = _merged(Moments, self.parts)
+
+        self.assertEqual(merged.n, len(self.values))
+        for name in ('mean', 'm2', 'm3', 'm4'):
+            self.assertAlmostEqual(getattr(merged, name) / getattr(whole, name), 1.0, places=9, msg=name)
+        self.assertEqual((merged.min, merged.max), (self.values.min(), self.values.max()))
+
+        deltas = self.values - self.values.mean()
+        stats = merged.to_dict()
+        self.assertAlmostEqual(stats['std'] / self.values.std(ddof=1), 1.0, places=9)
+        skewness = (deltas ** 3).mean() / (deltas ** 2).mean() ** 1.5
+        self.assertAlmostEqual(stats['skewness'] / skewness, 1.0, places=9)
+
+    def test_quantile_sketch_merge_equals_single_pass(self):
+        whole = QuantileSketch()
+        whole.update(self.values)
+        merged = _merged(QuantileSketch, self.parts)
+
+        self.assertEqual((merged.positive, merged.negative, merged.zeros, merged.n),
+                         (whole.positive, whole.negative, whole.zeros, whole.n))
+        ordered = np.sort(self.values)
+        for q in (0.0, 0.01, 0.1, 0.25, 0.5, 0.9, 0.99, 1.0):
+            exact = ordered[int(q * (len(ordered) - 1))]
+            self.assertLessEqual(abs(merged.quantile(q) - exact), whole.alpha * abs(exact) + 1e-9, msg=q)
+
+    def test_hyperloglog_merge_equals_single_pass(self):
+        ids = np.random.default_rng(3).integers(0, 40000, 100000)
+        parts = np.array_split(ids, 7)
+        whole = HyperLogLog()
+        whole.update(ids)
+        merged = _merged(HyperLogLog, parts)
+
+        np.testing.assert_array_equal(merged.registers, whole.registers)
+        distinct = len(np.unique(ids))
+        self.assertLess(abs(merged.estimate() - distinct) / distinct, 0.05)
+
+    def test_histogram_merge_equals_single_pass(self):
+        target = (self.values > 1000).astype(int)
+        whole = Histogram(-500, 50000)
+        whole.update(self.values, target)
+        merged = Histogram(-500, 50000)
+        for low, high in ((0, 100), (100, 15000), (15000, len(self.values))):
+            partial = Histogram(-500, 50000)
+            partial.update(self.values[low:high], target[low:high])
+            merged.merge(partial)
+
+        np.testing.assert_array_equal(merged.counts, whole.counts)
+        np.testing.assert_array_equal(merged.positives, whole.positives)
+        self.assertEqual(merged.counts.sum(), len(self.values))
+
+
+COPY_QUERY = """
+SELECT * FROM (VALUES
+    (1::int4, 10::int8, 2::int2, 1.5::float4, 2.25::float8, 12.345::numeric, true, '2024-02-29'::date,
+     '2024-03-01 12:34:56.789'::timestamp, '2024-03-01 12:00:00+03'::timestamptz, 'KES'::text),
+    (2, NULL, 3, NULL, -1.0, NULL, NULL, NULL, NULL, NULL, 'GBP'),
+    (3, 30, NULL, 0.5, NULL, 7, false, '1999-12-31', '1970-01-01', NULL, NULL)
+) v(id, big, small, f4, f8, num, flag, day, at, at_tz, currency)
+WHERE id >= :low
+ORDER BY id
+"""
+
+
+class BinaryCopyTests(TestCase):
+    def read(self, sql=COPY_QUERY, **kwargs):
+        connection.ensure_connection()
+        return pgcopy.read_copy(sql, {'low': 1}, bind=get_engine(), categories={'currency': ('KES', 'USD')},
+                                connection=connection.connection, **kwargs)
+
+    def test_round_trip(self):
+        data = self.read()
+
+        self.assertEqual(data.columns.tolist(),
+                         ['id', 'big', 'small', 'f4', 'f8', 'num', 'flag', 'day', 'at', 'at_tz', 'currency'])
+        self.assertEqual(data['id'].dtype, np.int32)
+        self.assertEqual(data['id'].tolist(), [1, 2, 3])
+        # Integer columns with NULLs come back as float64 with NaN, like the DB-API path
+        np.testing.assert_array_equal(data['big'], [10.0, np.nan, 30.0])
+        np.testing.assert_array_equal(data['small'], [2.0, 3.0, np.nan])
+        np.testing.assert_array_equal(data['f4'], np.array([1.5, np.nan, 0.5], dtype=np.float32))
+        np.testing.assert_array_equal(data['f8'], [2.25, -1.0, np.nan])
+        np.testing.assert_array_equal(data['num'], [12.345, np.nan, 7.0])
+        self.assertEqual(data['flag'].tolist(), [True, pd.NA, False])
+        self.assertEqual(data['day'].tolist(), [pd.Timestamp('2024-02-29'), pd.NaT, pd.Timestamp('1999-12-31')])
+        self.assertEqual(data['at'].tolist(),
+                         [pd.Timestamp('2024-03-01 12:34:56.789'), pd.NaT, pd.Timestamp('1970-01-01')])
+        self.assertEqual(data['at_tz'][0], pd.Timestamp('2024-03-01 09:00:00', tz='UTC'))
+        self.assertTrue(data['at_tz'][1:].isna().all())
+        # Strings outside the known values arrive as missing
+        self.assertEqual(data['currency'].cat.categories.tolist(), ['KES', 'USD'])
+        self.assertEqual(data['currency'].isna().tolist(), [False, True, True])
+        self.assertEqual(data['currency'][0], 'KES')
+
+    def test_chunks_match_the_whole_result(self):
+        whole = self.read()
+        for rows in (1, 2, 3, 10):
+            chunks = list(self.read(chunk_rows=rows))
+            self.assertEqual([len(chunk) for chunk in chunks][:1], [min(rows, 3)])
+            # A chunk without NULLs keeps its integer / float32 dtype, as with the DB-API path
+            pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), whole, check_dtype=False)
+
+    def test_empty_result(self):
+        data = self.read(COPY_QUERY.replace(':low', ':low + 10'))
+        self.assertEqual(len(data), 0)
+        self.assertEqual(len(data.columns), 11)
+
+    def test_unsupported_column(self):
+        with self.assertRaises(pgcopy.UnsupportedQuery):
+            self.read("SELECT 'x'::text AS name, :low AS low")
+
+
+def _fee_customers(n, seed, income=11.0):
+    """Customers shaped like the repo's book: fee burdens of a few percent, churn around 30%."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'customer_id': np.arange(n),
+        'income': rng.lognormal(income, 0.6, n).round(2),
+        'savings_balance': rng.lognormal(10.5, 1.5, n).round(2),
+        'total_card_value': rng.lognormal(9, 1, n).round(2),
+        'avg_default_probability': rng.uniform(0, 0.6, n),
+        'cluster': rng.choice([0, 1, 2], n),
+        'churn_risk': (rng.random(n) < 0.3).astype(int),
+    })
+
+
+def _caps(data):
+    rate = np.where(data['churn_risk'] > 0.5, DEFAULT_POLICY['churn_cap_rate'], DEFAULT_POLICY['cap_rate'])
+    return np.maximum(DEFAULT_POLICY['min_fee'],
+                      np.minimum(data['income'] * rate, DEFAULT_POLICY['max_fee'])).round(2)
+
+
+class OptimalFeeTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        n = 300
+        self.data = pd.DataFrame({
+            'customer_id': np.arange(n),
+            'income': rng.lognormal(10, 1, n).round(2),
+            'savings_balance': rng.lognormal(9, 1.5, n).round(2),
+            'total_card_value': rng.lognormal(8, 1, n).round(2),
+            'avg_default_probability': rng.uniform(0, 0.8, n),
+            # -1 is unassigned and 5 has no fitted curve; both price on the pooled curve
+            'cluster': rng.choice([-1, 0, 1, 2, 5], n),
+            'churn_risk': rng.integers(0, 2, n),
+        })
+        curve = lambda intercept, slope: {'intercept': intercept, 'slope': slope, 'identified': slope > 0}
+        self.curves = {
+            pricing.POOLED: curve(-2.0, 40.0),
+            0: curve(-3.0, 0.0),
+            1: curve(-1.0, 5.0),
+            2: curve(-2.5, 400.0),
+        }
+
+    def brute_force(self, customer):
+        """Best revenue over every cent from the rule's floor to its cap, rounded as the rule rounds it."""
+        policy = DEFAULT_POLICY
+        fitted = self.curves.get(int(customer['cluster']), self.curves[pricing.POOLED])
+        income = max(customer['income'], 1)
+        rate = policy['churn_cap_rate'] if customer['churn_risk'] > 0.5 else policy['cap_rate']
+        low = float(policy['min_fee'])
+        high = round(max(low, min(income * rate, policy['max_fee'])), 2)
+        fees = np.append(np.arange(low, high, 0.01), high)
+        revenue = fees * (1 - 1 / (1 + np.exp(-(fitted['intercept'] + fitted['slope'] / income * fees))))
+        return revenue.max()
+
+    def test_matches_brute_force_grid(self):
+        result = pricing.optimal_fees(self.data, self.curves)
+        priced = (self.data['cluster'] != 0).to_numpy()
+        best = np.array([self.brute_force(customer) for _, customer in self.data[priced].iterrows()])
+
+        np.testing.assert_allclose(result['expected_revenue'][priced], best, rtol=1e-6, atol=1e-3)
+        # The rule's own fee can never beat the optimum under the same curves
+        self.assertTrue((result['uplift'] >= -1e-3).all())
+        self.assertTrue((result['optimal_fee'] >= DEFAULT_POLICY['min_fee']).all())
+        self.assertTrue((result['optimal_fee'] <= DEFAULT_POLICY['max_fee']).all())
+
+    def test_flat_curve_keeps_the_rule_fee(self):
+        result = pricing.optimal_fees(self.data, self.curves)
+        flat = (self.data['cluster'] == 0).to_numpy()
+
+        np.testing.assert_array_equal(result['optimal_fee'][flat], result['current_fee'][flat])
+        self.assertTrue((result['uplift'][flat] == 0).all())
+        self.assertFalse(result['identified'][flat].any())
+
+    def test_unresponsive_churn_stays_below_the_cap(self):
+        # Churn unrelated to the fee, as in the repo's data: the fitted slopes are noise
+        data = _fee_customers(1000, seed=1)
+        result, summary = pricing.solve(data)
+        below = result['current_fee'].to_numpy() < _caps(data)
+
+        self.assertTrue(below.any())
+        self.assertTrue((result['optimal_fee'].to_numpy()[below] < _caps(data)[below]).all())
+        self.assertEqual(summary['portfolio']['uplift'], 0.0)
+        self.assertFalse(any(cluster['curve']['identified'] for cluster in summary['clusters'].values()))
+
+    def test_responsive_churn_is_priced_inside_the_caps(self):
+        data = _fee_customers(4000, seed=6, income=9.5)
+        burden = pricing.fee_burden(data)
+        churn = 1 / (1 + np.exp(-(-2.0 + 60.0 * burden)))
+        data['churn_risk'] = (np.random.default_rng(7).random(len(data)) < churn).astype(int)
+
+        curves = pricing.fit_response_curves(data)
+        result = pricing.optimal_fees(data, curves)
+        self.assertTrue(curves[pricing.POOLED]['identified'])
+        self.assertTrue(result['identified'].all())
+        self.assertLess(abs(curves[pricing.POOLED]['slope'] - 60.0), 3 * curves[pricing.POOLED]['slope_se'])
+        # The optimum burden is about 3.3%, inside the 10% cap and mostly under max_fee
+        interior = result['optimal_fee'].to_numpy() < _caps(data) - 0.01
+        self.assertGreater(interior.mean(), 0.5)
+        self.assertTrue((result['uplift'] >= -1e-3).all())
+
+
+class FeeSimulationTests(SimpleTestCase):
+    def setUp(self):
+        self.data = _fee_customers(500, seed=3)
+        self.grid = {'base_rate': [0.0005, 0.001, 0.002], 'cap_rate': [0.05, 0.1], 'min_fee': [50, 100]}
+
+    def test_grid_is_the_cartesian_product_over_the_defaults(self):
+        policies = fees.expand_grid(self.grid)
+
+        self.assertEqual({len(values) for values in policies.values()}, {12})
+        self.assertTrue((policies['max_fee'] == DEFAULT_POLICY['max_fee']).all())
+        self.assertTrue((policies['fee_elasticity'] == fees.simulation_defaults()['fee_elasticity']).all())
+        combos = set(zip(policies['base_rate'], policies['cap_rate'], policies['min_fee']))
+        self.assertEqual(len(combos), 12)
+
+    def test_grid_rejects_out_of_range_values(self):
+        for grid in ({'min_fee': [500], 'max_fee': [100]},
+                     {'min_fee': [100, 600], 'max_fee': [500, 1000]},
+                     {'base_rate': [-0.001]},
+                     {'cap_rate': [1.5]},
+                     {'churn_haircut': [2]},
+                     {'high_risk_multiplier': [-1]},
+                     {'max_fee': [float('nan')]},
+                     {'fee_elasticity': [0]},
+                     {'surcharge': [1]}):
+            with self.subTest(grid=grid), self.assertRaises(ValueError):
+                fees.expand_grid(grid)
+
+    def test_view_returns_400_for_an_invalid_grid(self):
+        response = self.client.post('/api/fee-optimization/simulate/',
+                                    {'policies': {'min_fee': [500], 'max_fee': [100]}},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('min_fee', response.json()['error'])
+
+    def test_outcomes_match_applying_each_policy(self):
+        result = fees.simulate(self.grid, self.data, workers=1)
+
+        self.assertEqual(result['policies_evaluated'], 12)
+        for outcome in result['frontier'] + [result['best_policy'], result['baseline']]:
+            revenue = fees.apply_policy(self.data.copy(), outcome['policy'])['expected_revenue'].sum()
+            self.assertAlmostEqual(outcome['total_revenue'], revenue, places=1)
+        self.assertEqual(result['baseline']['policy'], {key: float(value)
+                                                         for key, value in fees.simulation_defaults().items()})
+
+    def test_chunks_match_a_single_pass(self):
+        whole = fees.simulate(self.grid, self.data, workers=1)
+        with self.settings(FEE_SIMULATOR_CHUNK_CELLS=len(self.data) * 5):
+            chunked = fees.simulate(self.grid, self.data, workers=1)
+        self.assertEqual(chunked, whole)
+
+    def test_frontier_is_not_dominated(self):
+        result = fees.simulate(self.grid, self.data, workers=1)
+        frontier = result['frontier']
+
+        self.assertIn(result['best_policy'], frontier)
+        # Along the frontier more churn always buys more revenue
+        for low, high in zip(frontier, frontier[1:]):
+            self.assertLessEqual(low['expected_churn'], high['expected_churn'])
+            self.assertLess(low['total_revenue'], high['total_revenue'])
+
+
+class JobQueueTests(TransactionTestCase):
+    def setUp(self):
+        self.connections = []
+
+    def tearDown(self):
+        for conn in self.connections:
+            conn.close()
+
+    def worker(self):
+        worker = jobqueue.Worker(poll=0)
+        worker._connect()
+        self.connections.append(worker.conn)
+        return worker
+
+    def handle(self, handler):
+        return mock.patch.dict(jobqueue.HANDLERS, {'export_snapshot': handler})
+
+    def test_enqueue_merges_into_the_queued_job(self):
+        first, created = jobqueue.enqueue('export_snapshot', {'keep': 2}, delay=60)
+        second, merged = jobqueue.enqueue('export_snapshot', {'keep': 2}, priority=5)
+        other, _ = jobqueue.enqueue('export_snapshot', {'keep': 3})
+
+        self.assertEqual((first, created, merged), (second, True, False))
+        self.assertNotEqual(other, first)
+        job = jobqueue.get(first)
+        self.assertEqual(job['priority'], 5)
+        self.assertLessEqual(job['run_after'], job['created_at'] + pd.Timedelta(seconds=1))
+
+    def test_claim_skips_jobs_locked_by_another_worker(self):
+        low, _ = jobqueue.enqueue('export_snapshot', {'keep': 1})
+        high, _ = jobqueue.enqueue('export_snapshot', {'keep': 2}, priority=1)
+        first, second = self.worker(), self.worker()
+
+        first.conn.autocommit = False
+        try:
+            self.assertEqual(first.claim()['id'], high)
+            # The first claim is not committed, so its row is still locked
+            self.assertEqual(second.claim()['id'], low)
+            self.assertIsNone(second.claim())
+        finally:
+            first.conn.rollback()
+        self.assertEqual(jobqueue.get(high)['status'], 'queued')
+
+    def test_a_key_runs_once_at_a_time(self):
+        job_id, _ = jobqueue.enqueue('export_snapshot', key='snapshot')
+        worker = self.worker()
+        self.assertEqual(worker.claim()['id'], job_id)
+
+        again, created = jobqueue.enqueue('export_snapshot', key='snapshot')
+        self.assertTrue(created)
+        self.assertIsNone(self.worker().claim())
+        self.assertEqual(jobqueue.get(again)['status'], 'queued')
+
+    def test_failures_retry_with_backoff_then_fail(self):
+        job_id, _ = jobqueue.enqueue('export_snapshot', max_attempts=2)
+        worker = self.worker()
+
+        def fail(payload):
+            raise jobqueue.JobError('disk full')
+
+        with self.handle(fail):
+            outcome = worker.run(worker.claim())
+            self.assertEqual(outcome['status'], 'queued')
+            # Not due again until the backoff has passed
+            self.assertIsNone(worker.claim())
+
+            with connection.cursor() as cursor:
+                cursor.execute("UPDATE jobs SET run_after = now() WHERE id = %s", [job_id])
+            outcome = worker.run(worker.claim())
+        job = jobqueue.get(job_id)
+        self.assertEqual((outcome['status'], job['status'], job['attempts']), ('failed', 'failed', 2))
+        self.assertEqual(job['last_error'], 'disk full')
+
+    def test_failed_job_superseded_by_a_newer_request(self):
+        job_id, _ = jobqueue.enqueue('export_snapshot', key='snapshot')
+        worker = self.worker()
+        newer = []
+
+        def fail(payload):
+            newer.append(jobqueue.enqueue('export_snapshot', key='snapshot')[0])
+            raise jobqueue.JobError('stale')
+
+        with self.handle(fail):
+            outcome = worker.run(worker.claim())
+        self.assertEqual(outcome['status'], 'failed')
+        self.assertEqual(jobqueue.get(newer[0])['status'], 'queued')
+
+    def test_stopped_job_goes_back_without_counting_the_attempt(self):
+        job_id, _ = jobqueue.enqueue('export_snapshot', key='snapshot')
+        worker = self.worker()
+
+        def stop(payload):
+            raise KeyboardInterrupt
+
+        with self.handle(stop), self.assertRaises(KeyboardInterrupt):
+            worker.run(worker.claim())
+        job = jobqueue.get(job_id)
+        self.assertEqual((job['status'], job['attempts']), ('queued', 0))
+
+        # With a newer request already queued the stopped job is superseded instead
+        claimed = worker.claim()
+        newer, _ = jobqueue.enqueue('export_snapshot', key='snapshot')
+        with self.handle(stop), self.assertRaises(KeyboardInterrupt):
+            worker.run(claimed)
+        self.assertEqual(claimed['id'], job_id)
+        self.assertEqual(jobqueue.get(job_id)['status'], 'failed')
+        self.assertEqual(jobqueue.get(newer)['status'], 'queued')
+
+    def test_burst_runs_every_ready_job_in_priority_order(self):
+        ids = [jobqueue.enqueue('export_snapshot', {'keep': keep}, priority=keep)[0] for keep in (1, 3, 2)]
+        ran = []
+
+        with self.handle(lambda payload: ran.append(payload['keep']) or {'keep': payload['keep']}):
+            self.worker().work(burst=True)
+        self.assertEqual(ran, [3, 2, 1])
+        self.assertEqual([jobqueue.get(job_id)['result'] for job_id in ids], [{'keep': 1}, {'keep': 3}, {'keep': 2}])
+
+    def test_reaper_requeues_jobs_of_dead_workers(self):
+        job_id, _ = jobqueue.enqueue('export_snapshot')
+        self.worker().claim()
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE jobs SET heartbeat_at = now() - interval '1 day' WHERE id = %s", [job_id])
+
+        self.worker()._maintain()
+        job = jobqueue.get(job_id)
+        self.assertEqual(job['status'], 'queued')
+        self.assertIn('stopped sending heartbeats', job['last_error'])
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+
+    def predict(self, X):
+        self.calls.append(len(X))
+        if np.isnan(X).any():
+            raise ValueError('Input contains NaN')
+        return X.sum(axis=1), {'model_version': 'test'}
+
+    def test_concurrent_requests_share_one_predict_call(self):
+        batcher = MicroBatcher(self.predict, window_ms=500)
+        start = threading.Barrier(6)
+        results = {}
+
+        def request(i):
+            start.wait()
+            results[i] = batcher.score(np.full((2, 3), float(i)))
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.calls, [12])
+        for i, (probabilities, info) in results.items():
+            # Each caller gets back its own rows of the shared call
+            self.assertEqual(probabilities.tolist(), [3.0 * i, 3.0 * i])
+            self.assertEqual((info['batch_size'], info['batch_requests'], info['model_version']), (12, 6, 'test'))
+        self.assertEqual(batcher.metrics()['totals'], {'batches': 1, 'requests': 6, 'rows': 12, 'errors': 0})
+
+    def test_full_batch_is_scored_before_the_window_ends(self):
+        batcher = MicroBatcher(self.predict, max_batch_size=4, window_ms=60000)
+        futures = [batcher.submit(np.ones((2, 3))) for _ in range(2)]
+
+        self.assertEqual(futures[1].result(timeout=5)[1]['batch_requests'], 2)
+        self.assertEqual(self.calls, [4])
+
+    def test_bad_input_fails_only_its_own_request(self):
+        batcher = MicroBatcher(self.predict, window_ms=500)
+        good = batcher.submit(np.ones((2, 3)))
+        bad = batcher.submit(np.array([[1.0, np.nan, 1.0]]))
+        other = batcher.submit(np.full((1, 3), 2.0))
+
+        self.assertEqual(good.result(timeout=5)[0].tolist(), [3.0, 3.0])
+        self.assertEqual(other.result(timeout=5)[0].tolist(), [6.0])
+        with self.assertRaisesMessage(ValueError, 'NaN'):
+            bad.result(timeout=5)
+        # One failed batch call, then each request on its own
+        self.assertEqual(self.calls, [4, 2, 1, 1])
+        self.assertEqual(batcher.metrics()['totals']['errors'], 1)
+
+
+class CountingView(APIView):
+    calls = 0
+
+    @cached_response('counting')
+    def get(self, request):
+        CountingView.calls += 1
+        if request.GET.get('fail'):
+            return Response({'error': 'failed'}, status=500)
+        return Response({'calls': CountingView.calls})
+
+
+@override_settings(RESPONSE_CACHE_ENABLED=True)
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        django_cache.clear()
+        CountingView.calls = 0
+        self.version = 'v1'
+        patches = [mock.patch.object(cache, 'data_version', side_effect=lambda force=False: self.version),
+                   mock.patch.object(cache, 'model_version', return_value='model')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def get(self, path='/counting/', **headers):
+        return CountingView.as_view()(APIRequestFactory().get(path, **headers))
+
+    def test_hit_after_miss(self):
+        first, second = self.get(), self.get()
+
+        self.assertEqual((first['X-Cache'], second['X-Cache']), ('MISS', 'HIT'))
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertEqual(CountingView.calls, 1)
+        # Other query parameters are another entry
+        self.assertEqual(self.get('/counting/?page=2')['X-Cache'], 'MISS')
+
+    def test_matching_etag_gets_304_without_running_the_handler(self):
+        etag = self.get()['ETag']
+        for header in (etag, f'W/{etag}', f'"other", {etag}', '*'):
+            with self.subTest(header=header):
+                response = self.get(HTTP_IF_NONE_MATCH=header)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], etag)
+                self.assertEqual(response.content, b'')
+        self.assertEqual(CountingView.calls, 1)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_watermark_change_invalidates(self):
+        etag = self.get()['ETag']
+        self.version = 'v2'
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual((response.status_code, response['X-Cache']), (200, 'MISS'))
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content), {'calls': 2})
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_errors_are_not_cached(self):
+        self.get('/counting/?fail=1')
+        response = self.get('/counting/?fail=1')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertNotIn('ETag', response)
+        self.assertEqual(CountingView.calls, 2)
+
+
+def _partition_frame():
+    rng = np.random.default_rng(5)
+    n = 2000
+    data = pd.DataFrame({
+        'customer_id': np.arange(1, n + 1),
+        'cluster': rng.choice([-1, 0, 1, 2], n),
+        'income': rng.lognormal(10, 1, n),
+        'churn_risk': rng.integers(0, 2, n).astype(float),
+    })
+    data.loc[rng.random(n) < 0.05, 'income'] = np.nan
+    return data
+
+
+PARTITION_FRAME = _partition_frame()
+
+
+def _partition_partial(low, high):
+    data = PARTITION_FRAME[PARTITION_FRAME['customer_id'].between(low, high)]
+    partial = mapreduce.Partial().add(data, ['income', 'churn_risk'])
+    return partial.add(data[data['cluster'] != -1], ['income', 'churn_risk'], by='cluster')
+
+
+class MapReduceTests(SimpleTestCase):
+    def assertSamePartial(self, merged, whole):
+        self.assertEqual(dict(merged.counts), dict(whole.counts))
+        self.assertEqual(set(merged.moments), set(whole.moments))
+        for key, moments in whole.moments.items():
+            self.assertEqual(merged.moments[key].n, moments.n, msg=key)
+            self.assertAlmostEqual(merged.moments[key].mean / moments.mean, 1.0, places=9, msg=key)
+            self.assertAlmostEqual(merged.moments[key].m2 / moments.m2, 1.0, places=9, msg=key)
+
+    def test_partials_merge_like_a_single_pass(self):
+        whole = _partition_partial(1, len(PARTITION_FRAME))
+        merged = mapreduce.Partial()
+        # Uneven ranges, including empty ones
+        for low, high in ((1, 1), (2, 700), (701, 700), (701, 1999), (2000, 5000)):
+            merged.merge(_partition_partial(low, high))
+
+        self.assertSamePartial(merged, whole)
+        expected = PARTITION_FRAME[PARTITION_FRAME['cluster'] != -1].groupby('cluster')
+        self.assertEqual(merged.groups(), [0, 1, 2])
+        for cluster, rows in expected:
+            self.assertEqual(merged.counts[('rows', cluster)], len(rows))
+            # Missing incomes are skipped, as AVG() skips NULLs
+            self.assertAlmostEqual(merged.mean(cluster, 'income'), rows['income'].mean(), places=6)
+            self.assertAlmostEqual(merged.total(cluster, 'churn_risk'), rows['churn_risk'].sum(), places=6)
+
+    def test_run_matches_a_single_pass_in_and_across_processes(self):
+        whole = _partition_partial(1, len(PARTITION_FRAME))
+        ranges = [(low, low + 249) for low in range(1, len(PARTITION_FRAME) + 1, 250)]
+        with mock.patch.object(mapreduce, 'key_ranges', return_value=ranges), \
+                mock.patch.object(mapreduce.db, 'get_engine'):
+            for workers in (1, 3):
+                with self.subTest(workers=workers):
+                    self.assertSamePartial(mapreduce.run(_partition_partial, workers=workers), whole)
+
+
+class LockTests(TransactionTestCase):
+    def in_thread(self, target, *args):
+        """Run ``target`` in a thread with its own connections; join() returns (result, error)."""
+        outcome = {}
+
+        def run():
+            try:
+                outcome['result'] = target(*args)
+            except Exception as e:
+                outcome['error'] = e
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+
+        def join():
+            thread.join(timeout=30)
+            self.assertFalse(thread.is_alive())
+            return outcome.get('result'), outcome.get('error')
+        return join
+
+    def wait_for_waiters(self, count=1):
+        for _ in range(300):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM pg_locks WHERE locktype = 'advisory' AND NOT granted")
+                if cursor.fetchone()[0] >= count:
+                    return
+            threading.Event().wait(0.01)
+        self.fail('Nobody waited for the lock')
+
+    def hold(self, name, started, release):
+        with locks.advisory_lock(name):
+            started.set()
+            release.wait(30)
+
+    def test_advisory_lock_excludes_other_sessions(self):
+        started, release = threading.Event(), threading.Event()
+        holder = self.in_thread(self.hold, 'test', started, release)
+        started.wait(30)
+
+        with self.assertRaises(locks.LockTimeout):
+            with locks.advisory_lock('test', timeout=0.2):
+                pass
+        # Another name is independent
+        with locks.advisory_lock('other', timeout=0.2):
+            pass
+
+        def wait():
+            with locks.advisory_lock('test'):
+                return 'ran'
+
+        waiter = self.in_thread(wait)
+        self.wait_for_waiters()
+        release.set()
+        self.assertEqual(holder(), (None, None))
+        self.assertEqual(waiter(), ('ran', None))
+
+    def test_advisory_lock_is_reentrant_in_a_thread(self):
+        with locks.advisory_lock('test'):
+            with locks.advisory_lock('test', timeout=0.2):
+                pass
+        with locks.advisory_lock('test', timeout=0.2):
+            pass
+
+    def test_holders_never_overlap(self):
+        inside, overlaps = [], []
+
+        def critical():
+            with locks.advisory_lock('test'):
+                inside.append(1)
+                overlaps.append(len(inside))
+                threading.Event().wait(0.02)
+                inside.pop()
+
+        joins = [self.in_thread(critical) for _ in range(6)]
+        for join in joins:
+            self.assertEqual(join(), (None, None))
+        self.assertEqual(overlaps, [1] * 6)
+
+    def test_waiter_takes_the_running_result(self):
+        started, release, calls = threading.Event(), threading.Event(), []
+
+        def compute(value):
+            calls.append(value)
+            started.set()
+            release.wait(30)
+            return {'value': value}
+
+        first = self.in_thread(locks.single_flight, 'test', lambda: compute('first'))
+        started.wait(30)
+        second = self.in_thread(lambda: locks.single_flight('test', lambda: compute('second'), mode='wait'))
+        self.wait_for_waiters()
+        release.set()
+
+        self.assertEqual(first(), (({'value': 'first'}, 'computed'), None))
+        self.assertEqual(second(), (({'value': 'first'}, 'waited'), None))
+        self.assertEqual(calls, ['first'])
+
+    def test_snapshot_mode_returns_the_last_result_without_waiting(self):
+        self.assertEqual(locks.single_flight('test', lambda: {'run': 1}), ({'run': 1}, 'computed'))
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(30)
+            return {'run': 2}
+
+        running = self.in_thread(locks.single_flight, 'test', slow)
+        started.wait(30)
+        try:
+            self.assertEqual(locks.single_flight('test', lambda: {'run': 3}, mode='snapshot'),
+                             ({'run': 1}, 'snapshot'))
+        finally:
+            release.set()
+        self.assertEqual(running(), (({'run': 2}, 'computed'), None))
+        self.assertEqual(locks.latest_snapshot('test')[0], {'run': 2})
+
+    def test_waiter_recomputes_after_a_failed_run(self):
+        started, release = threading.Event(), threading.Event()
+
+        def failing():
+            started.set()
+            release.wait(30)
+            return None
+
+        first = self.in_thread(locks.single_flight, 'test', failing, lambda result: result)
+        started.wait(30)
+        second = self.in_thread(lambda: locks.single_flight('test', lambda: {'retry': True}, mode='wait'))
+        self.wait_for_waiters()
+        release.set()
+
+        self.assertEqual(first(), ((None, 'computed'), None))
+        self.assertEqual(second(), (({'retry': True}, 'computed'), None))
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Source tables in load order, with their serial keys
+SOURCE_TABLES = {'customers': 'customer_id', 'savings_accounts': 'account_id', 'loans': 'loan_id',
+                 'card_transactions': 'transaction_id', 'fx_transactions': 'fx_id'}
+
+
+def load_source_tables():
+    """Create the db.sql tables (which migrations do not manage) and load the shipped CSVs."""
+    with open(os.path.join(BACKEND_DIR, 'db.sql')) as f:
+        ddl = f.read()
+    with connection.cursor() as cursor:
+        cursor.execute(ddl)
+        cursor.execute("ALTER TABLE customers ADD COLUMN cluster INTEGER")
+        for table, key in SOURCE_TABLES.items():
+            with open(os.path.join(BACKEND_DIR, 'data', f'{table}.csv')) as f:
+                columns = f.readline().strip()
+                cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", f)
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{key}'), MAX({key})) FROM {table}")
+        cursor.execute("ANALYZE " + ', '.join(SOURCE_TABLES))
+
+
+def drop_source_tables():
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS " + ', '.join(reversed(list(SOURCE_TABLES))) + " CASCADE")
+        cursor.execute("DROP FUNCTION IF EXISTS engine_notify_change()")
+
+
+class SourceDataTestCase(TransactionTestCase):
+    """Runs against the shipped sample book (db.sql and backend/data), with the shipped models
+    copied to a scratch MODELS_DIR so fits and snapshots never touch the real ones."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.scratch = tempfile.mkdtemp()
+        models_dir = os.path.join(cls.scratch, 'models')
+        shutil.copytree(os.path.join(BACKEND_DIR, 'models'), models_dir)
+        cls.overrides = override_settings(
+            MODELS_DIR=models_dir, SNAPSHOT_DIR=os.path.join(cls.scratch, 'snapshots'),
+            RESPONSE_CACHE_ENABLED=False, FEATURE_STORE_ENABLED=False, SUMMARY_WORKERS=1,
+        )
+        cls.overrides.enable()
+        load_source_tables()
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            drop_source_tables()
+        finally:
+            # Pooled SQLAlchemy connections would keep the test database from being dropped
+            db.dispose()
+            cls.overrides.disable()
+            shutil.rmtree(cls.scratch, ignore_errors=True)
+            super().tearDownClass()
+
+    def refit(self):
+        response, source = views.CustomerSegmentationView().refit(mode='wait')
+        self.assertEqual((response.status_code, source), (200, 'computed'))
+        return response.data
+
+    def clusters(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT customer_id, cluster FROM customers ORDER BY customer_id")
+            return dict(cursor.fetchall())
+
+    def get(self, path):
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, response.content[:300])
+        return response.json()
+
+    def book_features(self):
+        """The unscaled model inputs of every loan."""
+        data = prepare_loan_features(pd.read_sql(fees.LOAN_QUERY.format(where=''), get_engine()))
+        return data[FEATURES].astype(float)
+
+    def assertSameSummary(self, summary, full):
+        """Equal keys and types, and values equal up to the float32 probabilities of the model."""
+        if isinstance(full, dict):
+            self.assertEqual(sorted(summary), sorted(full))
+            for key in full:
+                self.assertSameSummary(summary[key], full[key])
+        elif isinstance(full, list):
+            self.assertEqual(len(summary), len(full))
+            for left, right in zip(summary, full):
+                self.assertSameSummary(left, right)
+        elif isinstance(full, float):
+            self.assertIsInstance(summary, (int, float))
+            self.assertAlmostEqual(summary, full, delta=1e-6 * max(1.0, abs(full)))
+        else:
+            self.assertEqual((type(summary), summary), (type(full), full))
+
+
+class ClusterAssignmentTests(SourceDataTestCase):
+    def test_assignment_reproduces_the_fitted_labels(self):
+        fitted = {row['customer_id']: row['cluster'] for row in self.refit()['clusters']}
+        self.assertEqual(self.clusters(), fitted)
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE customers SET cluster = NULL WHERE customer_id % 7 = 0")
+
+        # Without ids, the customers with no cluster are the ones assigned
+        result = segmentation.assign()
+        self.assertEqual(result['assigned'], len([i for i in fitted if i % 7 == 0]))
+        self.assertEqual(self.clusters(), fitted)
+        self.assertFalse(result['drift']['refit_recommended'])
+
+    def test_new_customer_joins_the_nearest_centroid(self):
+        self.refit()
+        state = segmentation.load_model()
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO customers (age, income, credit_score, segment, preferred_currency) "
+                           "VALUES (40, 900000, 800, 'High Net Worth', 'USD') RETURNING customer_id")
+            customer_id = cursor.fetchone()[0]
+            cursor.execute("INSERT INTO savings_accounts (customer_id, savings_balance, monthly_deposit, "
+                           "activity_score) VALUES (%s, 500000, 1000, 0.9)", [customer_id])
+
+        response = self.client.post('/api/segmentation/assign/', {'customer_ids': [customer_id]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['assigned'], 1)
+        features = np.array([[900000, 800, 500000, 0, 0]], dtype=float)
+        scaled = (features - np.array(state['mean'])) / np.array(state['scale'])
+        nearest = int(np.argmin(((scaled - np.array(state['centroids'])) ** 2).sum(axis=1)))
+        self.assertEqual(self.clusters()[customer_id], nearest)
+        self.assertEqual(segmentation.load_model()['assigned_since_fit'], 1)
+
+
+class SummaryTests(SourceDataTestCase):
+    def setUp(self):
+        self.refit()
+
+    def test_segmentation(self):
+        full = self.get('/api/segmentation/')['summary']
+        summary = self.get('/api/segmentation/?summary=1')['summary']
+        # The refit averages fees rounded to cents; SQL evaluates the regression at the means
+        for name, cluster in full.items():
+            self.assertAlmostEqual(summary[name].pop('recommended_fee'), cluster.pop('recommended_fee'), delta=0.005)
+        self.assertSameSummary(summary, full)
+
+    def test_loan_risk_from_persisted_and_stale_scores(self):
+        full = self.get('/api/loan-risk/')
+        expected = {key: full[key] for key in ('clusters', 'portfolio', 'feature_importance', 'cluster_summary')}
+        self.assertSameSummary(self.get('/api/loan-risk/?summary=true'), expected)
+
+        # Stale scores are recomputed by customer partition instead
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM loan_scores")
+        with self.settings(SUMMARY_WORKERS=2, SUMMARY_PARALLEL_MIN_ROWS=0):
+            self.assertSameSummary(self.get('/api/loan-risk/?summary=true'), expected)
+
+    def test_fee_optimization_from_persisted_and_stale_scores(self):
+        full = self.get('/api/fee-optimization/')
+        expected = {key: full[key] for key in ('clusters', 'portfolio')}
+        self.assertSameSummary(self.get('/api/fee-optimization/?summary=true'), expected)
+
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM loan_scores")
+        self.assertSameSummary(self.get('/api/fee-optimization/?summary=true'), expected)
+
+
+class ApproxTests(SourceDataTestCase):
+    SEEDS = range(1, 101)
+
+    def setUp(self):
+        self.refit()
+        # Stratum weights come from pg_stats, which must see the new cluster labels
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE customers")
+
+    def coverage(self, path, exact, keys):
+        """Share of the seeded samples whose intervals contain the exact values.
+
+        ``exact`` maps the location of each group of estimates in the response to its exact values.
+        """
+        covered = total = 0
+        for seed in self.SEEDS:
+            with self.settings(APPROX_SAMPLE_SEED=seed):
+                estimate = self.get(path)
+            self.assertFalse(estimate['approximation']['exact'])
+            for location, values in exact.items():
+                group = estimate
+                for name in location:
+                    group = group[name]
+                for key in keys:
+                    low, high = group[f'{key}_ci']
+                    covered += low - 1e-9 <= values[key] <= high + 1e-9
+                    total += 1
+        return covered / total
+
+    def test_segmentation_intervals_cover_the_exact_summary(self):
+        exact = {('summary', name): values for name, values in self.get('/api/segmentation/?summary=1')['summary'].items()}
+        # Cluster counts are exact: the clusters are the strata and pg_stats gives their sizes
+        self.assertEqual(self.coverage('/api/segmentation/?approx=300', exact, ['count']), 1.0)
+        keys = ['avg_income', 'avg_credit_score', 'avg_savings_balance', 'avg_card_value', 'churn_risk']
+        self.assertGreaterEqual(self.coverage('/api/segmentation/?approx=300', exact, keys), 0.85)
+
+    def test_portfolio_intervals_cover_the_exact_portfolio(self):
+        exact = {('portfolio',): self.get('/api/loan-risk/?summary=1')['portfolio']}
+        keys = ['avg_default_probability', 'high_risk_loans', 'medium_risk_loans', 'low_risk_loans']
+        self.assertGreaterEqual(self.coverage('/api/loan-risk/?approx=300', exact, keys), 0.85)
+
+        exact = {('portfolio',): self.get('/api/fee-optimization/?summary=1')['portfolio']}
+        keys = ['total_revenue', 'avg_recommended_fee', 'avg_churn_risk']
+        self.assertGreaterEqual(self.coverage('/api/fee-optimization/?approx=300', exact, keys), 0.85)
+
+    def test_rows_are_sampled_independently_unless_pages_are_asked_for(self):
+        size, clause, fraction = approx.plan('customers', 250)
+        self.assertEqual((size, fraction), (1000, 0.25))
+        self.assertTrue(clause.startswith('TABLESAMPLE BERNOULLI (25.000000)'), clause)
+        with self.settings(APPROX_SAMPLE_METHOD='system'):
+            self.assertTrue(approx.plan('customers', 250)[1].startswith('TABLESAMPLE SYSTEM'))
+        # A sample as large as the table reads all of it, and the estimates are exact
+        self.assertEqual(approx.plan('customers', 5000), (1000, '', 1.0))
+
+
+class SnapshotTests(SourceDataTestCase):
+    def setUp(self):
+        shutil.rmtree(settings.SNAPSHOT_DIR, ignore_errors=True)
+
+    def segmentation(self, source):
+        response = self.client.get(f'/api/segmentation/?source={source}')
+        self.assertEqual(response.status_code, 200, response.content[:300])
+        return response.json()
+
+    def test_unknown_source_is_rejected(self):
+        response = self.client.get('/api/segmentation/?source=parquet')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'source must be one of postgres, snapshot'})
+
+    def test_snapshot_source_without_a_snapshot_reads_postgres(self):
+        self.assertIsNone(snapshots.manifest())
+        self.assertEqual(self.segmentation('snapshot')['summary'], self.segmentation('postgres')['summary'])
+
+    def test_snapshot_answers_as_of_its_export(self):
+        before = self.segmentation('postgres')
+        manifest = snapshots.export()
+        self.assertEqual(manifest['datasets']['customers_table']['rows'], 1000)
+        self.assertEqual(snapshots.manifest()['name'], manifest['name'])
+
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE customers SET income = income * 10 WHERE customer_id <= 200")
+        self.addCleanup(self.restore_incomes)
+        labels = self.clusters()
+
+        snapshot = self.segmentation('snapshot')
+        self.assertEqual(snapshot['summary'], before['summary'])
+        self.assertEqual(snapshot['customers'], before['customers'])
+        self.assertEqual(snapshot['clusters'], before['clusters'])
+        # A refit of a snapshot is a what-if and leaves the live labels alone
+        self.assertEqual(self.clusters(), labels)
+        self.assertNotEqual(self.segmentation('postgres')['summary'], before['summary'])
+
+    def restore_incomes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE customers SET income = income / 10 WHERE customer_id <= 200")
+
+    def test_export_keeps_the_newest_snapshots(self):
+        names = [snapshots.export(keep=2)['name'] for _ in range(3)]
+        kept = sorted(entry for entry in os.listdir(settings.SNAPSHOT_DIR) if not entry.startswith('.'))
+        self.assertEqual(kept, sorted(names[1:] + [snapshots.LATEST]))
+        self.assertEqual(os.path.basename(snapshots.latest_directory()), names[-1])
+
+
+class ColumnarTests(SourceDataTestCase):
+    PATHS = ['/api/segmentation/', '/api/loan-risk/', '/api/fee-optimization/']
+
+    def setUp(self):
+        shutil.rmtree(settings.SNAPSHOT_DIR, ignore_errors=True)
+
+    def test_group_agg_matches_pandas(self):
+        data = pd.DataFrame({
+            'cluster': [0, 1, 0, 2, np.nan, 1, 2, 0],
+            'income': [10.5, np.nan, 30.0, np.nan, 99.0, 20.0, np.nan, 5.25],
+            'loans': np.array([1, 2, 3, 4, 5, 6, 7, 8], dtype=np.int64),
+            'is_diaspora': [True, False, True, True, False, False, True, False],
+        })
+        aggregations = {'income': 'mean', 'loans': 'sum', 'is_diaspora': 'mean'}
+        counts = {'income': 'count', 'is_diaspora': 'sum'}
+        for how in (aggregations, counts, {'income': 'sum'}):
+            expected = data.groupby('cluster').agg(how)
+            with override_settings(ANALYTICS_ENGINE='duckdb'):
+                self.assertTrue(columnar.enabled())
+                result = columnar.group_agg(data, 'cluster', how)
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_index_type=False)
+            # Integer sums stay integral
+            for column, aggregation in how.items():
+                if aggregation == 'sum' and data[column].dtype != float:
+                    self.assertEqual(result[column].dtype.kind, 'i')
+
+    def test_snapshot_responses_match_pandas(self):
+        self.refit()
+        snapshots.export()
+        for path in self.PATHS:
+            expected = self.get(f'{path}?source=snapshot')
+            with override_settings(ANALYTICS_ENGINE='duckdb'), \
+                    mock.patch.object(columnar, 'group_agg', wraps=columnar.group_agg) as group_agg:
+                self.assertSameSummary(self.get(f'{path}?source=snapshot'), expected)
+            self.assertTrue(group_agg.called, path)
+
+    def test_unreachable_database_falls_back_to_pandas(self):
+        self.refit()
+        unavailable = columnar.ColumnarUnavailable('DuckDB cannot attach the database: offline')
+        for path in self.PATHS:
+            expected = self.get(path)
+            with override_settings(ANALYTICS_ENGINE='duckdb'), \
+                    mock.patch.object(columnar, '_attach_postgres', side_effect=unavailable), \
+                    self.assertLogs('engine.columnar', 'WARNING') as logs:
+                self.assertSameSummary(self.get(path), expected)
+            self.assertIn('DuckDB cannot attach the database: offline', logs.output[0])
+
+
+class StreamingTests(SourceDataTestCase):
+    def setUp(self):
+        self.refit()
+
+    def stream(self, path):
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], streaming.CONTENT_TYPE)
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def rows(self, records, kind):
+        return [row for record in records if record['type'] == kind for row in record['rows']]
+
+    def assertEnds(self, records, **counts):
+        self.assertEqual(records[-1], {'type': 'end', 'rows': counts})
+        for kind, count in counts.items():
+            self.assertEqual(len(self.rows(records, kind)), count)
+
+    def test_unknown_format_is_rejected(self):
+        response = self.client.get('/api/loan-risk/?stream=csv')
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'stream must be one of ndjson'}))
+
+    def test_loan_risk_from_persisted_scores(self):
+        full = self.get('/api/loan-risk/')
+        records = self.stream('/api/loan-risk/?stream=ndjson')
+        self.assertEqual([record['type'] for record in records[:2]], ['header', 'summary'])
+        self.assertFalse(records[0]['rescoring'])
+        self.assertSameSummary(records[1]['data'], {key: full[key] for key in records[1]['data']})
+        self.assertSameSummary(self.rows(records, 'loans'), sorted(full['loans'], key=lambda row: row['loan_id']))
+        self.assertEnds(records, loans=800, customers=len(full['customers']))
+
+    def test_stale_scores_stream_loans_before_the_summary(self):
+        changes.rescore()
+        fresh = self.stream('/api/loan-risk/?stream=ndjson')
+        self.assertFalse(fresh[0]['rescoring'])
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM loan_scores")
+
+        # Chunks are at least 1000 rows, more than the sample book has
+        with mock.patch.object(changes.schema, 'chunk_rows', return_value=250):
+            records = self.stream('/api/loan-risk/?stream=ndjson')
+        self.assertTrue(records[0]['rescoring'])
+        types = [record['type'] for record in records]
+        # Re-scored in several chunks, each streamed before the summary that needs them all
+        self.assertGreater(types.count('loans'), 1)
+        self.assertLess(max(i for i, kind in enumerate(types) if kind == 'loans'), types.index('summary'))
+        self.assertEqual(sorted(self.rows(records, 'loans'), key=lambda row: row['loan_id']), self.rows(fresh, 'loans'))
+        self.assertEqual(records[types.index('summary')], fresh[1])
+        self.assertEqual(self.rows(records, 'customers'), self.rows(fresh, 'customers'))
+        self.assertEnds(records, loans=800, customers=len(self.rows(fresh, 'customers')))
+
+    def test_fee_progress_while_rescoring(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM loan_scores")
+        with mock.patch.object(changes.schema, 'chunk_rows', return_value=250):
+            records = self.stream('/api/fee-optimization/?stream=ndjson')
+        self.assertTrue(records[0]['rescoring'])
+        progress = [record['loans_scored'] for record in records if record['type'] == 'progress']
+        self.assertEqual(progress, [250, 500, 750, 800])
+        summary = records[len(progress) + 1]
+        self.assertEqual(summary['type'], 'summary')
+        self.assertSameSummary(summary['data'], self.get('/api/fee-optimization/?summary=1'))
+        self.assertEnds(records, customers=1000)
+
+    def test_segmentation_streams_the_persisted_labels(self):
+        records = self.stream('/api/segmentation/?stream=ndjson')
+        self.assertEqual(records[0], {'type': 'summary', 'data': self.get('/api/segmentation/?summary=1')})
+        self.assertEqual({row['customer_id']: row['cluster'] for row in self.rows(records, 'clusters')}, self.clusters())
+        self.assertEnds(records, customers=1000)
+
+
+class DriftTests(SourceDataTestCase):
+    def setUp(self):
+        if os.path.exists(drift.reference_path()):
+            os.remove(drift.reference_path())
+        # Drops counts left pending by earlier tests
+        drift.monitor.flush()
+        self.version = load_artifacts().version
+
+    def write_reference(self, X):
+        """The histograms train_model.py writes, here of ``X``: cuts at the deciles of each feature."""
+        reference = {'created_at': '2024-01-01T00:00:00+00:00', 'n': len(X), 'features': {}}
+        for feature in FEATURES:
+            values = X[feature].dropna().to_numpy()
+            cuts = np.unique(np.quantile(values, np.linspace(0.1, 0.9, 9)))
+            counts = np.bincount(np.searchsorted(cuts, values, side='right'), minlength=len(cuts) + 1)
+            reference['features'][feature] = {'cuts': cuts.tolist(), 'counts': counts.tolist()}
+        with open(drift.reference_path(), 'w') as f:
+            json.dump(reference, f)
+
+    def test_missing_reference(self):
+        response = self.client.get('/api/loan-risk/drift/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_invalid_window(self):
+        self.write_reference(self.book_features())
+        for days in ('0', 'week'):
+            response = self.client.get(f'/api/loan-risk/drift/?days={days}')
+            self.assertEqual(response.status_code, 400, days)
+
+    def test_book_scored_against_itself_is_stable(self):
+        self.write_reference(self.book_features())
+        self.assertEqual(changes.rescore(), 800)
+
+        report = self.get('/api/loan-risk/drift/')
+        self.assertEqual((report['model_version'], report['window_days']), (self.version, 7))
+        self.assertEqual(report['reference']['samples'], 800)
+        book = report['sources']['book']
+        self.assertEqual(book['samples'], 800)
+        self.assertEqual(sorted(book['features']), sorted(FEATURES))
+        self.assertEqual({(f['psi'], f['ks'], f['status']) for f in book['features'].values()}, {(0.0, 0.0, 'stable')})
+        self.assertFalse(book['retrain_recommended'])
+
+    def test_shifted_requests_recommend_a_retrain(self):
+        X = self.book_features()
+        self.write_reference(X)
+        changes.rescore()
+        shifted = X.assign(income=X['income'] * 10)
+        drift.monitor.record(shifted.to_numpy(), self.version, 'requests')
+
+        report = self.get('/api/loan-risk/drift/')
+        self.assertEqual(sorted(report['sources']), ['book', 'requests'])
+        requests = report['sources']['requests']
+        self.assertEqual(requests['drifted_features'], ['income'])
+        self.assertEqual(requests['max_psi'], requests['features']['income']['psi'])
+        self.assertGreater(requests['max_psi'], settings.DRIFT_PSI_RETRAIN)
+        self.assertEqual(requests['features']['credit_score']['status'], 'stable')
+        self.assertTrue(requests['retrain_recommended'])
+        with self.settings(DRIFT_MIN_SAMPLES=801):
+            self.assertFalse(self.get('/api/loan-risk/drift/')['sources']['requests']['retrain_recommended'])
+
+        # ?source= narrows the report to one source
+        self.assertEqual(sorted(self.get('/api/loan-risk/drift/?source=book')['sources']), ['book'])
+
+
+class CompactFrameTests(SourceDataTestCase):
+    def setUp(self):
+        self.refit()
+
+    def test_loans_read_with_compact_dtypes(self):
+        query = fees.LOAN_QUERY.format(where='')
+        compacted = schema.read_frame(query)
+        self.assertEqual(
+            {column: str(compacted[column].dtype) for column in ('loan_id', 'income', 'credit_score', 'age',
+                                                                 'cluster', 'segment', 'is_diaspora', 'interest_rate')},
+            {'loan_id': 'int32', 'income': 'Int32', 'credit_score': 'Int16', 'age': 'Int16', 'cluster': 'Int16',
+             'segment': 'category', 'is_diaspora': 'bool', 'interest_rate': 'float64'})
+        plain = pd.read_sql(query, get_engine())
+        self.assertLess(schema.frame_bytes(compacted), schema.frame_bytes(plain) / 2)
+        # Every conversion is exact
+        pd.testing.assert_frame_equal(compacted.astype(object).where(compacted.notna(), None),
+                                      plain.astype(object).where(plain.notna(), None), check_dtype=False)
+
+    def test_chunk_size_follows_the_memory_budget(self):
+        query = fees.LOAN_QUERY.format(where='')
+        rows, width = schema.estimate(query)
+        self.assertIsNone(schema.chunk_rows(query, budget=rows * width * schema.WORKING_SET_FACTOR))
+        # Never fewer than 1000 rows a chunk
+        self.assertEqual(schema.chunk_rows(query, budget=1), 1000)
+        with mock.patch.object(schema, 'estimate', return_value=(1_000_000, 100)):
+            self.assertIsNone(schema.chunk_rows(query, budget=400_000_000))
+            self.assertEqual(schema.chunk_rows(query, budget=40_000_000), 100_000)
+
+    def test_responses_do_not_depend_on_chunking_or_reader(self):
+        for path in ('/api/loan-risk/', '/api/fee-optimization/'):
+            single = self.get(path)
+            # Chunks are at least 1000 rows, more than the sample book has
+            with mock.patch.object(schema, 'chunk_rows', return_value=250):
+                self.assertEqual(self.get(path), single, path)
+            with self.settings(ANALYTICS_READER='cursor'):
+                self.assertEqual(self.get(path), single, path)
+
+
+class ChangeFeedTests(SourceDataTestCase):
+    def setUp(self):
+        self.refit()
+        with connection.cursor() as cursor:
+            changes.install_triggers(cursor)
+        self.listener = psycopg2.connect(db.database_url())
+        self.listener.autocommit = True
+        self.listener.cursor().execute(f'LISTEN {changes.CHANNEL}')
+        self.addCleanup(self.listener.close)
+
+    def execute(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+    def notifications(self, expected):
+        """The next ``expected`` notifications, in the order the statements committed."""
+        received = []
+        while len(received) < expected and select.select([self.listener], [], [], 5)[0]:
+            self.listener.poll()
+            while self.listener.notifies:
+                received.append(json.loads(self.listener.notifies.pop(0).payload))
+        return received
+
+    def test_one_notification_per_statement_with_its_customers(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT customer_id FROM loans ORDER BY customer_id LIMIT 3")
+            borrowers = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT customer_id FROM card_transactions ORDER BY transaction_id LIMIT 1")
+            cardholder = cursor.fetchone()[0]
+        # Every loan of the borrowers, several per customer for some
+        self.execute(f"UPDATE loans SET loan_amount = loan_amount + 1 WHERE customer_id IN {tuple(borrowers)}")
+        self.execute(f"DELETE FROM card_transactions WHERE customer_id = {cardholder}")
+        self.assertEqual(self.notifications(2), [
+            {'table': 'loans', 'op': 'UPDATE', 'customer_ids': borrowers},
+            {'table': 'card_transactions', 'op': 'DELETE', 'customer_ids': [cardholder]},
+        ])
+
+    def test_updates_of_ignored_columns_are_not_published(self):
+        # Labels written by segmentation, touched timestamps and no-op updates change nothing derived
+        self.execute("UPDATE customers SET cluster = 0, updated_at = now() WHERE customer_id <= 10")
+        self.execute("UPDATE savings_accounts SET savings_balance = savings_balance WHERE customer_id = 1")
+        self.execute("UPDATE customers SET income = income + 1 WHERE customer_id IN (2, 4)")
+        self.assertEqual(self.notifications(1), [{'table': 'customers', 'op': 'UPDATE', 'customer_ids': [2, 4]}])
+
+    def test_batch_merges_notifications(self):
+        batch = changes.ChangeBatch()
+        batch.add(json.dumps({'table': 'card_transactions', 'op': 'INSERT', 'customer_ids': [1, 2]}))
+        batch.add(json.dumps({'table': 'card_transactions', 'op': 'UPDATE', 'customer_ids': [2, 3]}))
+        batch.add(json.dumps({'table': 'loans', 'op': 'UPDATE', 'customer_ids': [4]}))
+        batch.add('not json')
+        self.assertEqual((batch.events, batch.affected, batch.card_inserts, batch.card_rewrites),
+                         (3, {1, 2, 3, 4}, True, {2, 3}))
+        # A statement too big to list its customers affects everyone
+        batch.add(json.dumps({'table': 'customers', 'op': 'UPDATE', 'customer_ids': None}))
+        self.assertIsNone(batch.affected)
+
+    def test_apply_changes_rescores_and_reassigns_the_changed_customers(self):
+        changes.rescore()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT customer_id, COUNT(*) FROM loans GROUP BY customer_id ORDER BY customer_id LIMIT 1")
+            customer_id, loan_count = cursor.fetchone()
+        self.execute(f"UPDATE customers SET income = income * 10 WHERE customer_id = {customer_id}")
+
+        batch = changes.ChangeBatch()
+        for notification in self.notifications(1):
+            batch.add(json.dumps(notification))
+        generation = changelog.latest()
+        result = changes.apply_changes(batch)
+        self.assertEqual((result['events'], result['customers'], result['rescored'], result['reassigned']),
+                         (1, 1, loan_count, 1))
+        self.assertNotIn('errors', result)
+        self.assertGreater(changelog.latest(), generation)
+
+        # Scores and labels now match a full pass over the changed data
+        expected_scores = self.scores()
+        changes.rescore()
+        self.assertEqual(self.scores(), expected_scores)
+        # Writing the new scores and labels did not wake the listener again
+        self.execute("UPDATE customers SET income = income + 1 WHERE customer_id = 2")
+        self.assertEqual(self.notifications(1), [{'table': 'customers', 'op': 'UPDATE', 'customer_ids': [2]}])
+
+    def scores(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT loan_id, default_probability FROM loan_scores ORDER BY loan_id")
+            return cursor.fetchall()
+
+
+class PartitionedSummaryTests(SourceDataTestCase):
+    def setUp(self):
+        self.refit()
+        # Fill values must come from the whole book, not from each partition
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE customers SET age = NULL WHERE customer_id % 5 = 0")
+            cursor.execute("UPDATE customers SET income = NULL WHERE customer_id % 7 = 0")
+
+    def test_summaries_match_the_single_pass(self):
+        loan_risk = self.get('/api/loan-risk/')
+        fee = self.get('/api/fee-optimization/')
+        for workers in (1, 3):
+            with self.subTest(workers=workers):
+                self.assertSameSummary(mapreduce.loan_risk_summary(workers=workers),
+                                       {'clusters': loan_risk['clusters'], 'portfolio': loan_risk['portfolio']})
+                self.assertSameSummary(mapreduce.fee_summary(workers=workers),
+                                       {'clusters': fee['clusters'], 'portfolio': fee['portfolio']})
+
+
+class ExplanationTests(SourceDataTestCase):
+    def explain(self, query):
+        return self.get(f'/api/loan-risk/explain/?{query}')
+
+    def test_contributions_add_up_to_the_prediction(self):
+        X = self.book_features()
+        artifacts = load_artifacts()
+        margins = explain.contributions(artifacts, X).sum(axis=1)
+        np.testing.assert_allclose(1 / (1 + np.exp(-margins)), artifacts.predict_proba(X.to_numpy()), atol=1e-5)
+
+        scored = {row['loan_id']: row for row in self.get('/api/loan-risk/')['loans']}
+        response = self.explain(f'loan_ids=7,3,11&top_k={len(FEATURES)}')
+        self.assertEqual([loan['loan_id'] for loan in response['loans']], [7, 3, 11])
+        for loan in response['loans']:
+            self.assertEqual(len(loan['drivers']), len(FEATURES))
+            margin = loan['base_value'] + sum(driver['contribution'] for driver in loan['drivers'])
+            self.assertAlmostEqual(1 / (1 + np.exp(-margin)), loan['default_probability'], delta=6e-4)
+            self.assertAlmostEqual(loan['default_probability'], scored[loan['loan_id']]['default_probability'], places=6)
+            self.assertEqual(loan['risk_category'], scored[loan['loan_id']]['risk_category'])
+
+    def test_top_drivers_by_absolute_contribution(self):
+        full = self.explain(f'loan_ids=5&top_k={len(FEATURES)}')['loans'][0]['drivers']
+        top = self.explain('loan_ids=5&top_k=3')['loans'][0]['drivers']
+        self.assertEqual(top, full[:3])
+        magnitudes = [abs(driver['contribution']) for driver in full]
+        self.assertEqual(magnitudes, sorted(magnitudes, reverse=True))
+
+    def test_contributions_are_cached_until_the_inputs_change(self):
+        self.assertEqual(self.explain('loan_ids=1,2,3')['cache'], {'cached': 0, 'computed': 3})
+        before = self.explain('loan_ids=1,2,3')
+        self.assertEqual(before['cache'], {'cached': 3, 'computed': 0})
+
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE loans SET loan_amount = loan_amount * 3 WHERE loan_id = 2")
+        after = self.explain('loan_ids=1,2,3')
+        self.assertEqual(after['cache'], {'cached': 2, 'computed': 1})
+        self.assertEqual([after['loans'][0], after['loans'][2]], [before['loans'][0], before['loans'][2]])
+        self.assertNotEqual(after['loans'][1]['drivers'], before['loans'][1]['drivers'])
+
+    def test_pages_and_errors(self):
+        page = self.explain('page=2&page_size=3')
+        self.assertEqual([loan['loan_id'] for loan in page['loans']], [4, 5, 6])
+        for query, code in (('page=1000', 404), ('loan_ids=1,999999', 404), ('loan_ids=1,x', 400),
+                            ('top_k=0', 400), (f'page_size={settings.EXPLAIN_MAX_LOANS + 1}', 400)):
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get(f'/api/loan-risk/explain/?{query}').status_code, code)
+
+
+class ServingTests(SourceDataTestCase):
+    def setUp(self):
+        self.refit()
+
+    def test_master_scores_single_threaded_and_workers_with_their_share(self):
+        serving.preload()
+        model = load_artifacts().model
+        self.assertEqual(model.get_params()['n_jobs'], 1)
+        X = self.book_features().to_numpy()
+        load_artifacts().predict_proba(X)
+        # A worker forked after the master scored can still use several threads
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            serving.pin_threads(2)
+            os.write(write, str(len(load_artifacts().predict_proba(X))).encode())
+            os._exit(0)
+        os.close(write)
+        self.addCleanup(os.close, read)
+        ready = select.select([read], [], [], 30)[0]
+        if not ready:
+            os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        self.assertTrue(ready, 'the forked worker hung scoring with two threads')
+        self.assertEqual(os.read(read, 16), str(len(X)).encode())
+
+    def test_warm_up_requests_every_path_in_process(self):
+        application = get_wsgi_application()
+        with self.assertLogs('engine.serving', 'INFO') as logs:
+            serving.warm_up(application)
+        statuses = [line.split(': ', 1)[1].split(' in ')[0] for line in logs.output if 'Warm-up' in line]
+        self.assertEqual(statuses, ['200 OK'] * len(settings.SERVE_WARMUP_PATHS))
+        # A failing path is logged and the others still run
+        with self.assertLogs('engine.serving', 'INFO') as logs:
+            serving.warm_up(application, ['/api/loan-risk/explain/?loan_ids=x', '/health/'])
+        self.assertIn('400 Bad Request', logs.output[0])
+        self.assertIn('200 OK', logs.output[1])
+
+    def test_before_fork_closes_connections_and_freezes_the_heap(self):
+        self.addCleanup(gc.unfreeze)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        serving.before_fork()
+        self.assertIsNone(connection.connection)
+        self.assertGreater(gc.get_freeze_count(), 0)
+
+    def test_after_fork_pins_threads_and_hands_out_one_refresh_duty(self):
+        self.addCleanup(lambda: serving._refresh_lock and serving._refresh_lock.close())
+        with self.settings(SERVE_LOCK_DIR=self.scratch), \
+                mock.patch.object(serving.feature_store, 'get_store', return_value=object()), \
+                mock.patch.object(serving.feature_store, 'claim_refresh') as claim_refresh:
+            serving.after_fork(2)
+            first = serving._refresh_lock
+            # Later workers find the lock held
+            serving.after_fork(2)
+            self.assertIs(serving._refresh_lock, first)
+            self.assertEqual(claim_refresh.call_count, 1)
+            # ... until its holder exits
+            first.close()
+            serving.after_fork(2)
+            self.assertIsNot(serving._refresh_lock, first)
+            self.assertEqual(claim_refresh.call_count, 2)
+        self.assertEqual(load_artifacts().model.get_params()['n_jobs'], 2)
+
+
+class SegmentationLockTests(SourceDataTestCase):
+    def hold_segmentation_lock(self):
+        """Take the segmentation lock in another session, as a refit on another node would."""
+        holder = psycopg2.connect(db.database_url())
+        holder.autocommit = True
+        holder.cursor().execute("SELECT pg_advisory_lock(%s)", [locks.lock_key(locks.SEGMENTATION)])
+        return holder
+
+    def populate_clusters(self):
+        out = io.StringIO()
+        call_command('populate_clusters', stdout=out)
+        return out.getvalue()
+
+    def test_populate_clusters_saves_the_refit_labels(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE customers SET cluster = NULL")
+        self.assertIn('Successfully populated 1000 clusters (computed)', self.populate_clusters())
+        fitted = {row['customer_id']: row['cluster'] for row in locks.latest_snapshot(locks.SEGMENTATION)[0]['clusters']}
+        self.assertEqual(self.clusters(), fitted)
+
+    def test_callers_behind_a_running_refit(self):
+        previous = self.refit()
+        holder = self.hold_segmentation_lock()
+        self.addCleanup(holder.close)
+        with self.settings(RECOMPUTE_LOCK_TIMEOUT_SECONDS=0.2):
+            # ?snapshot=1 answers from the last completed refit straight away
+            self.assertEqual(self.get('/api/segmentation/?snapshot=1'), json.loads(json.dumps(previous)))
+            # Everyone else waits, up to the timeout
+            response = self.client.get('/api/segmentation/')
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('still running elsewhere', response.json()['error'])
+            response = self.client.post('/api/segmentation/assign/', {'customer_ids': [1]}, content_type='application/json')
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Failed to populate clusters: segmentation is still running elsewhere', self.populate_clusters())
+
+        holder.close()
+        self.assertIn('Successfully populated 1000 clusters (computed)', self.populate_clusters())
+
+
+class StatusTests(SourceDataTestCase):
+    def setUp(self):
+        shutil.rmtree(settings.SNAPSHOT_DIR, ignore_errors=True)
+
+    def database_down(self):
+        unreachable = mock.MagicMock()
+        unreachable.cursor.side_effect = OperationalError('could not connect to server\ndetails')
+        return mock.patch('engine.status.connection', unreachable)
+
+    def test_ready(self):
+        body = self.get('/health/ready/')
+        self.assertEqual(body['status'], 'ready')
+        self.assertTrue(body['database']['ok'])
+        self.assertEqual(body['model']['version'], load_artifacts().version)
+
+    def test_missing_model_is_degraded_but_ready(self):
+        with mock.patch('engine.status.load_artifacts', side_effect=FileNotFoundError('no model')):
+            body = self.get('/health/ready/')
+        self.assertEqual(body['status'], 'degraded')
+        self.assertEqual(body['model'], {'ok': False, 'error': 'no model'})
+
+    def test_unreachable_database_is_unavailable(self):
+        with self.database_down(), self.assertLogs('engine.views', 'ERROR'):
+            response = self.client.get('/health/ready/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'unavailable')
+        self.assertEqual(response.json()['database'], {'ok': False, 'error': 'could not connect to server'})
+
+        with self.database_down():
+            response = self.client.get('/api/status/')
+        self.assertEqual(response.status_code, 503)
+        self.assertIsNone(response.json()['jobs'])
+
+    def test_status_reports_runs_and_snapshot(self):
+        self.refit()
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE customers, loans")
+        body = self.get('/api/status/')
+        self.assertEqual(body['status'], 'ready')
+        self.assertEqual(
+            sorted(body),
+            ['batcher', 'cache', 'database', 'feature_store', 'jobs', 'model', 'pool', 'process', 'snapshot', 'status'],
+        )
+        segmentation_run = body['jobs']['runs']['segmentation']
+        self.assertEqual(segmentation_run['rows'], 1000)
+        self.assertIsNotNone(segmentation_run['completed_at'])
+        self.assertEqual(body['jobs']['estimated_rows']['customers'], 1000)
+        self.assertEqual(body['jobs']['estimated_rows']['loans'], 800)
+        self.assertEqual(body['process']['pid'], os.getpid())
+        self.assertIsNone(body['snapshot'])
+
+        manifest = snapshots.export()
+        self.assertEqual(self.get('/api/status/')['snapshot'],
+                         {'name': manifest['name'], 'created_at': manifest['created_at']})
@@ -1,13 +1,21 @@
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine
 from xgboost import XGBClassifier
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import roc_auc_score
+import json
 import pickle
 import os
+from datetime import datetime, timezone
 from decimal import Decimal
 
+try:
+    from engine.pgcopy import UnsupportedQuery, read_copy
+except ImportError:  # run directly as engine/<script>.py
+    from pgcopy import UnsupportedQuery, read_copy
+
 # Database connection
 engine = create_engine('postgresql://postgres:2003@db:5432/revenue')
 
@@ -25,12 +33,18 @@ FROM loans l
 JOIN customers c ON l.customer_id = c.customer_id
 LEFT JOIN savings_accounts s ON c.customer_id = s.customer_id
 """
-data = pd.read_sql(query, engine)
+try:
+    # Binary COPY straight into NumPy columns; segments arrive as categorical codes
+    data = read_copy(query, bind=engine, categories={'segment': ['High Net Worth', 'Low Income', 'Middle Class']})
+    data['segment'] = data['segment'].astype(object)
+except UnsupportedQuery:
+    data = pd.read_sql(query, engine)
 
 # Convert Decimal to float
 decimal_columns = ['loan_amount', 'interest_rate', 'total_card_value']
 for col in decimal_columns:
-    data[col] = data[col].apply(lambda x: float(x) if isinstance(x, Decimal) else x)
+    if data[col].dtype == object:
+        data[col] = data[col].apply(lambda x: float(x) if isinstance(x, Decimal) else x)
 
 # Fill missing values
 data['activity_score'] = data['activity_score'].fillna(0)
@@ -87,4 +101,15 @@ with open('/app/models/loan_risk_model.pkl', 'wb') as f:
 with open('/app/models/scaler.pkl', 'wb') as f:
     pickle.dump(scaler, f)
 
-print("Model and scaler saved successfully")
\ No newline at end of file
+# Reference histograms of the raw training features for the drift monitor (engine/drift.py):
+# cut points at the deciles, so each feature has up to 11 bins of roughly equal mass
+reference = {'created_at': datetime.now(timezone.utc).isoformat(), 'n': len(X_train), 'features': {}}
+for feature in features:
+    values = X_train[feature].dropna().to_numpy()
+    cuts = np.unique(np.quantile(values, np.linspace(0.1, 0.9, 9)))
+    counts = np.bincount(np.searchsorted(cuts, values, side='right'), minlength=len(cuts) + 1)
+    reference['features'][feature] = {'cuts': cuts.tolist(), 'counts': counts.tolist()}
+with open('/app/models/feature_reference.json', 'w') as f:
+    json.dump(reference, f)
+
+print("Model, scaler and feature reference saved successfully")
\ No newline at end of file
@@ -3,6 +3,16 @@ from . import views
 
 urlpatterns = [
     path('segmentation/', views.CustomerSegmentationView.as_view(), name='segmentation'),
+    path('segmentation/assign/', views.ClusterAssignmentView.as_view(), name='segmentation-assign'),
     path('loan-risk/', views.LoanRiskView.as_view(), name='loan-risk'),
+    path('loan-risk/drift/', views.feature_drift, name='loan-risk-drift'),
+    path('loan-risk/explain/', views.LoanExplanationView.as_view(), name='loan-risk-explain'),
     path('fee-optimization/', views.FeeOptimizationView.as_view(), name='fee-optimization'),
+    path('fee-optimization/optimal/', views.OptimalFeeView.as_view(), name='fee-optimal'),
+    path('fee-optimization/simulate/', views.FeeSimulationView.as_view(), name='fee-simulation'),
+    path('loan-applications/score/', views.LoanApplicationScoringView.as_view(), name='loan-application-score'),
+    path('loan-applications/metrics/', views.loan_scoring_metrics, name='loan-application-metrics'),
+    path('status/', views.service_status, name='status'),
+    path('jobs/', views.jobs, name='jobs'),
+    path('jobs/<int:job_id>/', views.job_detail, name='job-detail'),
 ]
\ No newline at end of file
@@ -0,0 +1,38 @@
+# Production server: python -m gunicorn -c gunicorn.conf.py config.wsgi:application
+#
+# The app, model artifacts and feature store are loaded once in the master and shared
+# copy-on-write by the forked workers; every view is warmed up before the first request.
+import multiprocessing
+import os
+
+# Native thread pools sized per worker, set before the app (and numpy) is imported
+threads_per_worker = int(os.getenv('SERVE_THREADS_PER_WORKER', '1'))
+for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+             'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS'):
+    os.environ.setdefault(name, str(threads_per_worker))
+
+bind = os.getenv('SERVE_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('SERVE_WORKERS', str(max(1, multiprocessing.cpu_count() // threads_per_worker))))
+timeout = int(os.getenv('SERVE_TIMEOUT', '120'))
+max_requests = int(os.getenv('SERVE_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+preload_app = True
+accesslog = '-'
+
+
+def when_ready(server):
+    # Runs in the master after the app was imported and before any worker is forked
+    from django.core.wsgi import get_wsgi_application
+    from engine import serving
+
+    application = get_wsgi_application()
+    serving.preload()
+    if os.getenv('SERVE_WARMUP', 'true').lower() == 'true':
+        serving.warm_up(application)
+    serving.before_fork()
+
+
+def post_fork(server, worker):
+    from engine import serving
+
+    serving.after_fork(threads_per_worker)